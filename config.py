@@ -42,9 +42,9 @@ BLOG = {
     "send_comment_notification": True,
 
     # If you want to use legacy ID mapping for your former blog platform,
-    # define it here and insert the necessary mapping code in the
-    # legacy_id_mapping() function in ArticleHandler (blog.py).
-    # Currently only "Drupal" is supported.
+    # define it here and add its url pattern to legacy_id_pattern and
+    # legacy_id_for_path() in the blog handler (blog.py).
+    # Currently "Drupal" and "Serendipity" are supported.
     "legacy_blog_software": None,
     #"legacy_blog_software": "Drupal",
     #"legacy_blog_software": "Serendipity",
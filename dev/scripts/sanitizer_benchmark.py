@@ -0,0 +1,112 @@
+#!/usr/bin/env python
+# encoding: utf-8
+#
+# The MIT License
+# 
+# Copyright (c) 2008 William T. Katz
+# 
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to 
+# deal in the Software without restriction, including without limitation 
+# the rights to use, copy, modify, merge, publish, distribute, sublicense, 
+# and/or sell copies of the Software, and to permit persons to whom the 
+# Software is furnished to do so, subject to the following conditions:
+# 
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+# 
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING
+# FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER 
+# DEALINGS IN THE SOFTWARE.
+
+"""Benchmarks the tree-building and streaming html sanitizers.
+
+Runs sanitizer.sanitize_html (BeautifulSoup) and
+sanitizer.stream_sanitize_html over synthetic comments and long article
+bodies, checks that they keep the same markup, and reports kilobytes
+per second for each.
+
+Run from the application directory:
+
+  python dev/scripts/sanitizer_benchmark.py [num_documents]
+"""
+
+import logging
+import random
+import sys
+import time
+
+sys.path.insert(0, '.')
+sys.path.insert(0, 'utils')
+
+from utils import sanitizer
+
+NUM_DOCUMENTS = 200
+
+WORDS = ['memcache', 'datastore', 'template', 'python', 'the', 'and',
+         'with', 'query', 'render', 'Tom &amp; Jerry', 'x &lt; y', 'AT&T']
+MARKUP = ['<p>', '</p>', '<a href="http://example.com/%d">', '</a>',
+          '<strong>', '</strong>', '<em>', '</em>', '<br />',
+          '<img src="http://example.com/%d.png" alt="pic" />',
+          '<span class="note" onclick="hide()">', '</span>',
+          '<blockquote>', '</blockquote>', '<ul><li>', '</li></ul>',
+          '<!-- draft -->', '<font color="red">', '</font>']
+CODE_BLOCK = '<pre name="code" class="python">%s</pre>'
+
+def make_document(rand, num_words):
+    parts = []
+    for i in range(num_words):
+        if rand.random() < 0.15:
+            markup = rand.choice(MARKUP)
+            if '%d' in markup:
+                markup = markup % i
+            parts.append(markup)
+        else:
+            parts.append(rand.choice(WORDS))
+    if num_words > 500:
+        parts.append(CODE_BLOCK % '\n'.join(
+            ['    return x &lt; y and %d' % i for i in range(40)]))
+    return ' '.join(parts)
+
+def measure(name, sanitize, documents, **kwargs):
+    start = time.time()
+    results = [sanitize(html, **kwargs) for html in documents]
+    elapsed = time.time() - start
+    kilobytes = sum([len(html) for html in documents]) / 1024.0
+    print '  %-12s %7.1f KB/s, %.3f s' % (name, kilobytes / elapsed, elapsed)
+    return results, elapsed
+
+def compare(title, documents, **kwargs):
+    print '%s (%d documents):' % (title, len(documents))
+    tree, tree_time = measure('BeautifulSoup', sanitizer.sanitize_html,
+                              documents, **kwargs)
+    stream, stream_time = measure('Streaming',
+                                  sanitizer.stream_sanitize_html,
+                                  documents, **kwargs)
+    print '  %.1fx faster' % (tree_time / stream_time)
+    # Text is escaped by the streaming sanitizer, so compare with
+    # references decoded.
+    decode = lambda html: sanitizer.entity_matcher.sub(
+                              sanitizer.convert_entity, html)
+    different = len([1 for a, b in zip(tree, stream)
+                     if decode(a) != decode(b)])
+    if different:
+        print '  %d documents sanitized differently!' % different
+
+def main(argv):
+    logging.disable(logging.DEBUG)
+    num_documents = NUM_DOCUMENTS
+    if len(argv) > 1:
+        num_documents = int(argv[1])
+    rand = random.Random(2008)
+    comments = [make_document(rand, 60) for i in range(num_documents * 5)]
+    articles = [make_document(rand, 3000) for i in range(num_documents)]
+    compare('Comments', comments)
+    compare('Articles from trusted source', articles, trusted_source=True)
+
+if __name__ == '__main__':
+    main(sys.argv)
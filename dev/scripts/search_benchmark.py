@@ -0,0 +1,144 @@
+#!/usr/bin/env python
+# encoding: utf-8
+#
+# The MIT License
+# 
+# Copyright (c) 2008 William T. Katz
+# 
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to 
+# deal in the Software without restriction, including without limitation 
+# the rights to use, copy, modify, merge, publish, distribute, sublicense, 
+# and/or sell copies of the Software, and to permit persons to whom the 
+# Software is furnished to do so, subject to the following conditions:
+# 
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+# 
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING
+# FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER 
+# DEALINGS IN THE SOFTWARE.
+
+"""Benchmarks the full-text tokenizer on a synthetic corpus.
+
+Compares the original tokenizer (punctuation split, no markup handling,
+no stemming) with SearchableEntity._FullTextTerms, with and without
+indexing code blocks, reporting tokens per second and the size of the
+resulting index.  A third of the articles embed code blocks.  Each
+tokenizer runs over the corpus several times and the best run is
+reported, along with the first run.
+
+Run from the application directory with the App Engine SDK on the path:
+
+  PYTHONPATH=<sdk>:. python dev/scripts/search_benchmark.py [num_articles]
+"""
+
+import random
+import re
+import string
+import sys
+import time
+
+sys.path.insert(0, '.')
+
+from models import search
+from models import searchindex
+
+NUM_ARTICLES = 10000
+WORDS_PER_ARTICLE = 400
+RUNS = 5
+
+STEMS = ['cach', 'index', 'render', 'templat', 'queri', 'stor', 'post',
+         'comment', 'search', 'feed', 'tag', 'deploy', 'handl', 'request',
+         'respons', 'memor', 'shard', 'count', 'build', 'pars', 'writ',
+         'read', 'archiv', 'sitemap', 'engin', 'python', 'django', 'blog']
+SUFFIXES = ['e', 'es', 'ed', 'ing', 'er', 'ers', 'ation', 'ations', 's']
+FILLER = ['the', 'and', 'with', 'from', 'into', 'about', 'that', 'this']
+MARKUP = ['<p class="entry">', '</p>', '<a href="http://example.com/%s">',
+          '</a>', '<strong>', '</strong>', '<img src="/static/%s.png" />',
+          '&nbsp;', '<br />']
+
+CODE_WORDS = ['self', 'def', 'return', 'import', 'memcache', 'db', 'key',
+              'put', 'get', 'fetch', 'query', 'entity', 'template', 'render']
+CODE_BLOCK = '<pre name="code" class="python">\n%s\n</pre>'
+CODE_BLOCK_LINES = 40
+
+PUNCTUATION_REGEX = re.compile('[' + re.escape(string.punctuation) + ']')
+
+def original_terms(text):
+    """The tokenizer before markup skipping and stemming."""
+    text = PUNCTUATION_REGEX.sub(' ', text)
+    stop_words = search.SearchableEntity._FULL_TEXT_STOP_WORDS
+    return [word for word in text.lower().split()
+            if len(word) >= 4 and word not in stop_words]
+
+def make_corpus(num_articles, seed=2008):
+    rand = random.Random(seed)
+    words = [stem + suffix for stem in STEMS for suffix in SUFFIXES]
+    words += ['%s%d' % (rand.choice(STEMS), i) for i in range(2000)]
+    corpus = []
+    for i in range(num_articles):
+        parts = []
+        for j in range(WORDS_PER_ARTICLE):
+            choice = rand.random()
+            if choice < 0.1:
+                markup = rand.choice(MARKUP)
+                if '%s' in markup:
+                    markup = markup % rand.choice(words)
+                parts.append(markup)
+            elif choice < 0.35:
+                parts.append(rand.choice(FILLER))
+            else:
+                parts.append(rand.choice(words))
+        if rand.random() < 0.33:
+            lines = []
+            for j in range(CODE_BLOCK_LINES):
+                lines.append('    %s = %s.%s(%s_%d)' % tuple(
+                    [rand.choice(CODE_WORDS) for k in range(4)] + [j]))
+            parts.append(CODE_BLOCK % '\n'.join(lines))
+        corpus.append(u' '.join(parts))
+    return corpus
+
+def measure(name, tokenize, corpus, runs=RUNS):
+    times = []
+    for i in range(runs):
+        start = time.time()
+        documents = [tokenize(text) for text in corpus]
+        times.append(time.time() - start)
+    # The first run also fills the tokenizer's memo of stems.
+    elapsed = min(times)
+    tokens = sum([len(terms) for terms in documents])
+    postings = {}
+    for doc_id, terms in enumerate(documents):
+        for term in set(terms):
+            postings.setdefault(term, []).append(doc_id + 1)
+    entries = sum([len(ids) for ids in postings.values()])
+    encoded = sum([len(searchindex.encode_postings(ids)) 
+                   for ids in postings.values()])
+    print '%s:' % name
+    print '  %d articles/s, %d tokens in %.2f s, %d tokens/s' % (
+        len(corpus) / elapsed, tokens, elapsed, tokens / elapsed)
+    print '  first run %.2f s' % times[0]
+    print '  %d distinct terms, %d index entries, %.1f per article' % (
+        len(postings), entries, float(entries) / len(corpus))
+    print '  %d bytes of encoded posting lists' % encoded
+
+def main(argv):
+    num_articles = NUM_ARTICLES
+    if len(argv) > 1:
+        num_articles = int(argv[1])
+    print 'Building %d synthetic articles...' % num_articles
+    corpus = make_corpus(num_articles)
+    measure('Original tokenizer', original_terms, corpus)
+    measure('Prose-only stemming tokenizer', 
+            search.SearchableEntity._FullTextTerms, corpus)
+    measure('Prose with code: terms', 
+            lambda text: search.SearchableEntity._FullTextTerms(text, True),
+            corpus)
+
+if __name__ == '__main__':
+    main(sys.argv)
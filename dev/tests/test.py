@@ -1,7 +1,10 @@
+import datetime
+import random
 import unittest
 import urllib
 from utils import template
 from google.appengine.api import apiproxy_stub_map
+from google.appengine.api import memcache
 from google.appengine.api import datastore_file_stub
 from google.appengine.api import user_service_stub
 from google.appengine.api import urlfetch_stub
@@ -23,7 +26,13 @@ os.environ['USER_IS_ADMIN'] = '1'
 time.tzset()
 
 from handlers.bloog import blog
+import feeds
 import models.blog
+from models import search
+from models import searchindex
+from models import similarity
+from utils import sanitizer
+import view
 
 class BloogTest(unittest.TestCase):
 
@@ -54,6 +63,9 @@ class BloogTest(unittest.TestCase):
         apiproxy_stub_map.apiproxy.RegisterStub(
          'memcache', memcache_stub.MemcacheServiceStub())
 
+        # Drop term dictionaries held by the search index
+        searchindex.dictionaries.clear()
+
         # Create a fake remplate renderer
         self.render_calls = []
         def template_render(filename, params, debug, template_dirs):
@@ -110,8 +122,8 @@ class BloogTest(unittest.TestCase):
                                                          '/articles')
         articles.get()
         self.failUnlessEqual(len(self.render_calls), 1)
-        self.failUnlessEqual(self.render_calls[0]['articles'][0].key(),
-                             article.key())
+        self.failUnlessEqual(
+            self.render_calls[0]['articles'][0].article_key(), article.key())
         
         handler, request, response = self.createHandler(blog.ArticleHandler,
                                                         '/Test-post')
@@ -148,8 +160,8 @@ class BloogTest(unittest.TestCase):
         root, request, response = self.createHandler(blog.RootHandler, '/')
         root.get()
         self.failUnlessEqual(len(self.render_calls), 1)
-        self.failUnlessEqual(self.render_calls[0]['articles'][0].key(),
-                             article.key())
+        self.failUnlessEqual(
+            self.render_calls[0]['articles'][0].article_key(), article.key())
 
         handler, request, response = self.createHandler(blog.BlogEntryHandler,
                                                         '/2008/1/Test-blog-post')
@@ -158,6 +170,498 @@ class BloogTest(unittest.TestCase):
         self.failUnlessEqual(self.render_calls[1]['article'].key(),
                              article.key())
 
+    def testFeedEntryEdit(self):
+        root, request, response = self.createHandler(blog.MonthHandler,
+                                                     '2008/1', {
+            'CONTENT_TYPE': 'application/x-www-form-urlencoded',
+            'REQUEST_METHOD': 'POST',
+        })
+        request.body = urllib.urlencode({
+            'title': 'Feed entry',
+            'body': 'Original feed body',
+            'format': 'html',
+            'published': '2008-01-01 12:00:00',
+            'updated': '',
+        })
+        root.post('2008', '01')
+        self.failUnless('Original feed body' in feeds.get_head_document())
+
+        # An edit that doesn't send an updated time.
+        handler, request, response = self.createHandler(
+            blog.BlogEntryHandler, '/2008/1/Feed-entry', {
+            'CONTENT_TYPE': 'application/x-www-form-urlencoded',
+            'REQUEST_METHOD': 'PUT',
+        })
+        request.body = urllib.urlencode({'body': 'Edited feed body',
+                                         'format': 'html'})
+        handler.put('2008', '1', 'Feed-entry')
+        document = feeds.get_head_document()
+        self.failUnless('Edited feed body' in document)
+        self.failIf('Original feed body' in document)
+
+    def testTagFeedEdit(self):
+        root, request, response = self.createHandler(blog.RootHandler, '/', {
+            'CONTENT_TYPE': 'application/x-www-form-urlencoded',
+            'REQUEST_METHOD': 'POST',
+        })
+        request.body = urllib.urlencode({'title': 'Tagged article',
+                                         'body': 'Original tagged body',
+                                         'format': 'html', 'published': '',
+                                         'updated': '', 'tags': 'foo'})
+        root.post()
+        self.failUnless('Original tagged body' in
+                        feeds.get_tag_document('foo'))
+
+        handler, request, response = self.createHandler(
+            blog.ArticleHandler, '/Tagged-article', {
+            'CONTENT_TYPE': 'application/x-www-form-urlencoded',
+            'REQUEST_METHOD': 'PUT',
+        })
+        request.body = urllib.urlencode({'body': 'Edited tagged body',
+                                         'format': 'html'})
+        handler.put('Tagged-article')
+        document = feeds.get_tag_document('foo')
+        self.failUnless('Edited tagged body' in document)
+        self.failIf('Original tagged body' in document)
+
+    def testPageCache(self):
+        os.environ['USER_EMAIL'] = ''    # Only anonymous views are cached
+        article = models.blog.Article(permalink='Cached', title='Cached',
+                                      article_type='article', body='Body',
+                                      format='html')
+        article.put()
+        memcache.set('Unrelated', 1)
+        def get_pages():
+            root, request, response = self.createHandler(blog.RootHandler,
+                                                         '/')
+            root.get()
+            handler, request, response = self.createHandler(
+                blog.ArticleHandler, '/Cached')
+            handler.get('Cached')
+            return handler
+        handler = get_pages()
+        get_pages()
+        self.failUnlessEqual(len(self.render_calls), 2)
+        # A comment drops the article's page and the listings.
+        view.invalidate_cache(handler, article, site_wide=False)
+        get_pages()
+        self.failUnlessEqual(len(self.render_calls), 4)
+        view.invalidate_cache(handler)
+        get_pages()
+        self.failUnlessEqual(len(self.render_calls), 6)
+        self.failUnlessEqual(memcache.get('Unrelated'), 1)
+
+    def testPageToken(self):
+        start = (datetime.datetime(2008, 5, 1, 12, 30, 15, 250), 3)
+        token = view.encode_page_token('a', start)
+        self.failUnlessEqual(view.decode_page_token(token), ('a', start))
+        for skip in [-1, view.MAX_PAGE_SKIP + 1]:
+            token = view.encode_page_token('b', (u'Title', skip))
+            self.failUnlessEqual(view.decode_page_token(token), None)
+        self.failUnlessEqual(view.decode_page_token('garbage'), None)
+
+    def testThreadStrings(self):
+        article = models.blog.Article(permalink='Threads', title='Threads',
+                                      article_type='article', body='Body',
+                                      format='html')
+        article.put()
+        self.failUnlessEqual(article.next_comment_thread_string(), '001')
+        self.failUnlessEqual(article.next_comment_thread_string(), '002')
+        comment = models.blog.Comment(article=article, thread='002',
+                                      body='Reply to me')
+        comment.put()
+        self.failUnlessEqual(comment.next_child_thread_string(), '002.001')
+        self.failUnlessEqual(comment.next_child_thread_string(), '002.002')
+        self.failUnlessEqual(article.next_comment_thread_string(), '003')
+
+    def testDerivedProperties(self):
+        article = models.blog.Article(permalink='Derived', title='Derived',
+                                      article_type='article', format='html',
+                                      body='<p>Tom & Jerry</p>',
+                                      html='<p>Tom & Jerry</p>')
+        article.put()
+        article = models.blog.Article.get(article.key())
+        self.failUnlessEqual(article.description, 'Tom & Jerry')
+        self.failUnlessEqual(article.atom_html, '<p>Tom &amp; Jerry</p>')
+        self.failUnlessEqual(article.has_media, False)
+        self.failIf(article.derived_properties_stale())
+        next_key, scanned, written = models.blog.Article.backfill_derived()
+        self.failUnlessEqual((next_key, scanned, written), (None, 1, 0))
+
+    def testArchive(self):
+        for day, title in [(3, 'First'), (20, 'Second')]:
+            article = models.blog.Article(
+                permalink=title, title=title, article_type='blog entry',
+                body='Body', format='html',
+                published=datetime.datetime(2008, 2, day))
+            article.put()
+        handler, request, response = self.createHandler(blog.MonthHandler,
+                                                        '/2008/2')
+        handler.get('2008', '2')
+        self.failUnlessEqual(
+            [summary.title for summary in self.render_calls[0]['articles']],
+            ['Second', 'First'])
+        years = models.blog.ArchiveMonth.get_archive_years()
+        self.failUnlessEqual(years[0]['count'], 2)
+        article.delete()
+        self.failUnlessEqual(
+            models.blog.ArchiveMonth.get_month(2008, 2).count, 1)
+
+    def testCommentCount(self):
+        article = models.blog.Article(
+            permalink='Counted', title='Counted', article_type='article',
+            body='Body', format='html')
+        article.put()
+        models.blog.ArticleSummary.add_comment(article)
+        models.blog.ArticleSummary.add_comment(article)
+        self.failUnlessEqual(
+            models.blog.ArticleSummary.comment_count(article), 2)
+        article = models.blog.Article.get(article.key())
+        self.failUnlessEqual(article.num_comments, 0)
+        article.title = 'Edited'
+        article.put()
+        self.failUnlessEqual(
+            models.blog.ArticleSummary.comment_count(article), 2)
+
+    def testIncrementalIndex(self):
+        article = models.blog.Article(
+            permalink='Indexed', title='Indexed', article_type='article',
+            body='Searchable words here', format='html')
+        article.put()
+        skipped = search.INDEX_STATS['skipped']
+        article.updated = datetime.datetime.now()
+        article.put()
+        self.failUnlessEqual(search.INDEX_STATS['skipped'], skipped + 1)
+        article.body = 'Different searchable words'
+        article.put()
+        self.failUnlessEqual(search.INDEX_STATS['skipped'], skipped + 1)
+        self.failUnlessEqual(models.blog.Article.search('different'),
+                             [article.key()])
+        self.failUnlessEqual(models.blog.Article.search('missing OR words'),
+                             [article.key()])
+        self.failUnlessEqual(models.blog.Article.search('missing words'), [])
+
+    def testStemmedSearch(self):
+        article = models.blog.Article(
+            permalink='Stemmed', title='Stemmed', article_type='article',
+            body='<p class="caption">Caching pages</p>', format='html')
+        article.put()
+        self.failUnlessEqual(models.blog.Article.search('cached'),
+                             [article.key()])
+        self.failUnlessEqual(models.blog.Article.search('caption'), [])
+        article.body = ('<p>Prose words</p>'
+                        '<pre name="code">memcache_client.flush()</pre>')
+        article.put()
+        self.failUnlessEqual(models.blog.Article.search('prose'),
+                             [article.key()])
+        self.failUnlessEqual(models.blog.Article.search('flush'), [])
+        # memcache, client, flush, and the name and code of the markup
+        document = searchindex.SearchDocument.get(
+            searchindex.SearchDocument.key_for(article.key()))
+        self.failUnlessEqual(document.dropped_terms, 5)
+        article.body = '<p>Flush <code>memcache</code> first</p>'
+        article.put()
+        self.failUnlessEqual(models.blog.Article.search('memcache'),
+                             [article.key()])
+        # Words too long for a key name, like base64 data, are skipped.
+        article.body = '<p>Encoded data %s</p>' % ('QUJD' * 200)
+        article.put()
+        self.failUnlessEqual(models.blog.Article.search('encoded'),
+                             [article.key()])
+
+    def testPhraseSearch(self):
+        article = models.blog.Article(
+            permalink='Phrase', title='Google', article_type='article',
+            body='Deploying to App Engine, then happily caching in memcache.',
+            format='html')
+        article.put()
+        models.blog.Article(
+            permalink='Engine', title='Engine', article_type='article',
+            body='The engine of an app.', format='html').put()
+        search = models.blog.Article.search
+        self.failUnlessEqual(search('"app engine"'), [article.key()])
+        self.failUnlessEqual(search('"engine app"'), [])
+        # Title and body are positioned apart.
+        self.failUnlessEqual(search('"google app"'), [])
+        self.failUnlessEqual(search('memc*'), [article.key()])
+        self.failUnlessEqual(search('happy*'), [article.key()])
+        self.failUnlessEqual(search('cached*'), [article.key()])
+        self.failUnlessEqual(search('memx*'), [])
+        article.body = 'Nothing to see.'
+        article.put()
+        self.failUnlessEqual(search('memc*'), [])
+
+    def testRankedSearch(self):
+        for title, body in [('Once', 'Memcache appears here once among '
+                                     'plenty of other unrelated words'),
+                            ('Often', 'Memcache memcache memcache')]:
+            models.blog.Article(permalink=title, title=title, body=body,
+                                article_type='article', format='html').put()
+        keys = searchindex.ranked_search(models.blog.Article, 'memcache')
+        self.failUnlessEqual([models.blog.Article.get(key).title 
+                              for key in keys], ['Often', 'Once'])
+        keys = searchindex.ranked_search(models.blog.Article, 'memc*')
+        self.failUnlessEqual([models.blog.Article.get(key).title 
+                              for key in keys], ['Often', 'Once'])
+        corpus = searchindex.SearchCorpus.get_by_key_name('Article')
+        self.failUnlessEqual(corpus.num_docs, 2)
+        # Ranking reads frequencies from the postings and lengths from
+        # DocumentLengths, so an edit that only repeats a term updates
+        # them.
+        article = models.blog.Article.get(keys[1])
+        article.body = 'Memcache memcache memcache memcache'
+        article.put()
+        postings = searchindex.TermPostings.get(
+            searchindex.TermPostings.key_for('Article', 'memcach'))
+        ids = postings.get_ids()
+        self.failUnlessEqual(sorted(postings.get_frequencies(ids)), [3, 4])
+        lengths = searchindex.DocumentLengths.get(
+            searchindex.DocumentLengths.key_for('Article')).get_lengths()
+        self.failUnlessEqual(sorted(lengths), ids)
+        self.failUnlessEqual(sum(lengths.values()),
+                             searchindex.SearchCorpus.get_by_key_name(
+                                 'Article').total_length)
+        keys = searchindex.ranked_search(models.blog.Article, 'memcache')
+        self.failUnlessEqual([models.blog.Article.get(key).title 
+                              for key in keys], ['Once', 'Often'])
+
+    def testSortedSearch(self):
+        for day, title in [(3, 'Older'), (20, 'Newer')]:
+            models.blog.Article(permalink=title, title=title,
+                                body='Datastore postings', format='html',
+                                article_type='blog entry',
+                                published=datetime.datetime(2008, 2, day)
+                                ).put()
+        keys = searchindex.sorted_search(models.blog.Article, 'postings')
+        self.failUnlessEqual([models.blog.Article.get(key).title
+                              for key in keys], ['Newer', 'Older'])
+        self.failUnlessEqual(searchindex.sorted_search(
+            models.blog.Article, 'postings', limit=1), keys[:1])
+        postings = searchindex.TermPostings.get(
+            searchindex.TermPostings.key_for('Article', 'post'))
+        self.failUnlessEqual(postings.df, 2)
+        models.blog.Article.get(keys[0]).delete()
+        self.failUnlessEqual(searchindex.get_document_frequencies(
+            'Article', ['post', 'datastor']), {'post': 1, 'datastor': 1})
+
+    def testSearchCache(self):
+        def make(title):
+            article = models.blog.Article(permalink=title, title=title,
+                                          body='Cached search words',
+                                          article_type='article',
+                                          format='html')
+            article.put()
+            return article.key()
+        first = make('First')
+        search = lambda query: searchindex.cached_keys(
+            models.blog.Article, query, 'id',
+            lambda: models.blog.Article.search(query))
+        self.failUnlessEqual(search('Words CACHED'), [first])
+        second = make('Second')
+        self.failUnlessEqual(search('cached words'), [first, second])
+
+    def testSuggest(self):
+        article = models.blog.Article(
+            permalink='Suggested', title='Memcache tuning',
+            article_type='article', body='Memcache and memory',
+            format='html')
+        article.put()
+        suggestions = models.blog.Article.suggest('MEM')
+        self.failUnlessEqual(sorted(suggestions['terms']),
+                             ['memcache', 'memory'])
+        self.failUnlessEqual(suggestions['suggestions'],
+                             [{'title': 'Memcache tuning',
+                               'url': '/Suggested'}])
+        # Losing the memcache copy keeps this instance's dictionary and
+        # puts it back, without reading the datastore.
+        memcache.flush_all()
+        searchindex.dictionaries['Article'].checked = 0
+        suggestions = models.blog.Article.suggest('mem')
+        self.failUnlessEqual(sorted(suggestions['terms']),
+                             ['memcache', 'memory'])
+        self.failUnless(memcache.get(
+            searchindex.dictionary_memcache_key('Article')))
+        # An instance without one rebuilds it from the datastore.
+        memcache.flush_all()
+        searchindex.dictionaries.clear()
+        self.failUnlessEqual(
+            sorted(models.blog.Article.suggest('mem')['terms']),
+            ['memcache', 'memory'])
+        self.failUnless(memcache.get(
+            searchindex.dictionary_memcache_key('Article')))
+        article.title = 'Datastore tuning'
+        article.put()
+        suggestions = models.blog.Article.suggest('mem')
+        self.failUnlessEqual(suggestions['suggestions'], [])
+        self.failUnlessEqual(models.blog.Article.suggest('data')['terms'],
+                             ['datastore'])
+        article.delete()
+        self.failUnlessEqual(models.blog.Article.suggest('data')['terms'], [])
+
+    def testReindex(self):
+        article = models.blog.Article(
+            permalink='Reindexed', title='Reindexed', article_type='article',
+            body='Stale index words', format='html')
+        article.put()
+        article = models.blog.Article.get(article.key())
+        self.failIf(article.index_is_stale())
+        self.failUnlessEqual(models.blog.Article.reindex(), (None, 1, 0))
+        old_version = search.SearchableEntity._FULL_TEXT_INDEX_VERSION
+        search.SearchableEntity._FULL_TEXT_INDEX_VERSION = old_version + 1
+        try:
+            article = models.blog.Article.get(article.key())
+            self.failUnless(article.index_is_stale())
+            self.failUnlessEqual(models.blog.Article.reindex(), (None, 1, 1))
+            self.failUnlessEqual(models.blog.Article.reindex(), (None, 1, 0))
+        finally:
+            search.SearchableEntity._FULL_TEXT_INDEX_VERSION = old_version
+        self.failUnlessEqual(models.blog.Article.search('stale words'),
+                             [article.key()])
+
+    def testQueryPlan(self):
+        common = range(100)
+        self.failUnlessEqual(searchindex.plan([common, [5, 7], [7]], 100),
+                             ([[7], [5, 7]], [common]))
+        self.failUnlessEqual(searchindex.plan([common, range(60)], 100),
+                             ([range(60)], [common]))
+        self.failUnlessEqual(searchindex.plan([common, []], 100), ([], []))
+        self.failUnlessEqual(searchindex.plan([common, range(60)], 10),
+                             ([range(60), common], []))
+        singles = [[id] for id in range(searchindex.MAX_QUERY_TERMS + 2)]
+        narrowing, filters = searchindex.plan(singles, 10)
+        self.failUnlessEqual(len(narrowing), searchindex.MAX_QUERY_TERMS)
+        self.failUnlessEqual(len(filters), 2)
+        # Filtering lists still rule out matches
+        self.failUnlessEqual(searchindex.filter_ids([5, 7], [common[6:]]),
+                             [7])
+        self.failUnlessEqual(searchindex.filter_ids([5, 7], [[6], common]),
+                             [])
+        handler, request, response = self.createHandler(
+            blog.SearchHandler, '/search', {'QUERY_STRING': 's=the+and'})
+        handler.get()
+        self.failUnlessEqual(self.render_calls[0]['articles'], [])
+        self.failUnless(self.render_calls[0]['search_error_message'])
+
+    def testSnippets(self):
+        article = models.blog.Article(
+            permalink='Snippets', title='Snippets', article_type='article',
+            body='Body', format='html',
+            html='<p>Tuning <b>memcache</b> &amp; pages</p><pre>memcache</pre>')
+        article.put()
+        self.failUnlessEqual(
+            searchindex.snippets([article.key()], 'memcached'),
+            ['Tuning <mark>memcache</mark> &amp; pages'])
+        self.failUnlessEqual(searchindex.snippets([article.key()], 'other'),
+                             [None])
+
+    def testRelated(self):
+        def make(title, body):
+            article = models.blog.Article(permalink=title, title=title,
+                                          article_type='article', body=body,
+                                          format='html')
+            article.put()
+            return article.key()
+        datastore = make('Datastore', 'Datastore queries, indexes, entities')
+        queries = make('Queries', 'Datastore queries and composite indexes')
+        make('Gardening', 'Planting tomatoes, watering gardens')
+        self.failUnlessEqual(similarity.related(models.blog.Article,
+                                                datastore), [])
+        self.failUnlessEqual(similarity.build(models.blog.Article),
+                             (None, 3, 3))
+        self.failUnlessEqual(similarity.related(models.blog.Article,
+                                                datastore), [queries])
+        self.failUnlessEqual(
+            similarity.similar_search(models.blog.Article, 'indexes')[0],
+            datastore)
+
+    def testStreamSanitizer(self):
+        def normalized(html):
+            return sanitizer.entity_matcher.sub(sanitizer.convert_entity, html)
+        samples = ['<p>No comment</p>',
+                   '<p>One<p>Two <b>bold <i>both</b> italic',
+                   '<ul><li>One<li>Two</ul><table><tr><td>Cell</table>',
+                   '<a href="http://example.com/" title="x">link</a>',
+                   '<img src="http://example.com/a.png" alt="a">',
+                   '<pre>  spaced\n  out  </pre><br/>&amp; &copy; &#169;',
+                   '<object><param name="m" value="v"><embed wmode="w">',
+                   '<p style="color: red" onclick="x()">Styled</p>']
+        option_sets = [{}, {'trusted_source': True},
+                       {'allow_attributes': ['href', 'src'],
+                        'blacklist_tags': ['img']}]
+        for html in samples:
+            for options in option_sets:
+                self.failUnlessEqual(
+                    normalized(sanitizer.stream_sanitize_html(html, **options)),
+                    normalized(sanitizer.sanitize_html(html, **options)))
+        for html, options in [('<p>Hi<script>alert(1)</script></p>', {}),
+                              ('<a href="javascript:alert(1)">x</a>',
+                               {'trusted_source': True})]:
+            self.failUnlessRaises(sanitizer.DangerousHTMLError,
+                                  sanitizer.sanitize_html, html, **options)
+            self.failUnlessRaises(sanitizer.DangerousHTMLError,
+                                  sanitizer.stream_sanitize_html, html,
+                                  **options)
+        self.failUnlessEqual(
+            sanitizer.stream_sanitize_html('<p>&lt;script&gt;</p>'),
+            '<p>&lt;script&gt;</p>')
+        self.failUnlessEqual(
+            sanitizer.stream_sanitize_html('<style>a > b{}</style>',
+                                           trusted_source=True),
+            '<style>a > b{}</style>')
+
+    def testStreamSanitizerFuzz(self):
+        # Generated markup must sanitize the same both ways, once
+        # entities are normalized.
+        def sanitized(sanitize, html, options):
+            try:
+                return sanitizer.entity_matcher.sub(
+                    sanitizer.convert_entity, sanitize(html, **options))
+            except sanitizer.DangerousHTMLError:
+                return None
+        tags = ['p', 'b', 'i', 'a', 'div', 'span', 'ul', 'li', 'table',
+                'tr', 'td', 'pre', 'br', 'img', 'script', 'font', 'blink',
+                'textarea', 'object', 'em', 'style']
+        attributes = ['href="http://ok"', 'href="/rel"', 'src="http://img"',
+                      'title="t &amp; u"', 'onclick="x()"', 'style="s"',
+                      'class="c"', "href='javascript:x'"]
+        texts = [' ', '\n', '  \n ', '&amp;', '&lt;', '&nbsp;', '&bogus;',
+                 'AT&T', 'hello', 'x < y', 'caf\xe9', 'a>b', 'a > b{}']
+        option_sets = [{}, {'trusted_source': True},
+                       {'allow_tags': ['p', 'a'], 'blacklist_tags': ['a']}]
+        rand = random.Random(7)
+        for i in range(500):
+            parts = []
+            for j in range(rand.randint(1, 15)):
+                chance = rand.random()
+                tag = rand.choice(tags)
+                if chance < 0.35:
+                    if rand.random() < 0.4:
+                        tag += ' ' + rand.choice(attributes)
+                    parts.append('<%s>' % tag)
+                elif chance < 0.6:
+                    parts.append('</%s>' % tag)
+                else:
+                    parts.append(rand.choice(texts))
+            html = ''.join(parts)
+            for options in option_sets:
+                self.failUnlessEqual(
+                    sanitized(sanitizer.stream_sanitize_html, html, options),
+                    sanitized(sanitizer.sanitize_html, html, options))
+
+    def testArticleCache(self):
+        self.failUnlessEqual(
+            models.blog.Article.get_by_permalink('Missing'), None)
+        article = models.blog.Article(
+            permalink='Missing', title='Missing', article_type='article',
+            body='Body', format='html')
+        article.put()
+        cached = models.blog.Article.get_by_permalink('Missing')
+        self.failUnlessEqual(cached.key(), article.key())
+        article.title = 'Found'
+        article.put()
+        self.failUnlessEqual(
+            models.blog.Article.get_by_permalink('Missing').title, 'Found')
+
 
 if __name__ == '__main__':
     unittest.main()
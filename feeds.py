@@ -0,0 +1,265 @@
+# The MIT License
+# 
+# Copyright (c) 2008 William T. Katz
+# 
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to 
+# deal in the Software without restriction, including without limitation 
+# the rights to use, copy, modify, merge, publish, distribute, sublicense, 
+# and/or sell copies of the Software, and to permit persons to whom the 
+# Software is furnished to do so, subject to the following conditions:
+# 
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+# 
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING
+# FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER 
+# DEALINGS IN THE SOFTWARE.
+
+"""Builds and maintains the Atom feed documents.
+
+The head feed at config.BLOG['master_atom_url'] is stored prebuilt in
+an AtomFeed entity.  Publishing, editing or deleting a blog entry
+splices that one entry into the stored document; comments never
+touch it.  Older entries are reachable through monthly archive
+documents linked with rel="prev-archive" and rel="next-archive"
+(RFC 5005), so the head feed never grows past AtomFeed.HEAD_SIZE.
+
+Every feed, including the per-tag feeds, is assembled from rendered
+<entry> fragments cached by article key and updated time.
+"""
+__author__ = 'William T. Katz'
+
+import logging
+import os
+import urllib
+
+from google.appengine.api import memcache
+from google.appengine.ext import db
+from google.appengine.ext.webapp import template
+
+import config
+import models.blog
+import view
+
+HEAD_KEY_NAME = 'head'
+HEAD_MEMCACHE_KEY = 'AtomFeedHead'
+
+def render_template(name, params):
+    view_path = view.find_file(view.templates, "bloog/blog/" + name)
+    params.update({ "blog": config.BLOG })
+    return template.render(os.path.join("views", view_path), params,
+                           debug=config.DEBUG)
+
+def rfc3339(date):
+    return date.strftime('%Y-%m-%dT%H:%M:%SZ')
+
+def archive_url(year, month):
+    return "%s/feeds/archive/%d/%d.xml" % (config.BLOG['root_url'], 
+                                           year, month)
+
+def utf8(tag):
+    if isinstance(tag, unicode):
+        return tag.encode('utf-8')
+    return tag
+
+def tag_feed_url(tag):
+    return "%s/tag/%s/atom.xml" % (config.BLOG['root_url'], 
+                                   urllib.quote(utf8(tag)))
+
+def render_entry(article):
+    "Renders the Atom <entry> for an article"
+    return render_template("atom_entry.xml", { "article": article })
+
+def fragment_memcache_key(article_key, updated):
+    return 'AtomEntry%s_%s' % (article_key, updated.isoformat())
+
+def get_entries(refs, articles=None):
+    """Returns (key string, published, updated, entry xml) tuples.
+
+    Rendered entries are cached by article key and updated time, and
+    every feed is assembled from that cache, so an article is only
+    fetched and rendered again after it changes.
+
+    Args:
+      refs: list of (article key, published, updated) tuples
+      articles: optional dict of already loaded Articles by key string
+    """
+    articles = dict(articles or {})
+    cache_keys = [fragment_memcache_key(ref[0], ref[2]) for ref in refs]
+    cached = memcache.get_multi(cache_keys)
+    missing = [ref[0] for ref, cache_key in zip(refs, cache_keys)
+               if cache_key not in cached and str(ref[0]) not in articles]
+    if missing:
+        for article in db.get(missing):
+            if article:
+                articles[str(article.key())] = article
+    rendered = {}
+    entries = []
+    for ref, cache_key in zip(refs, cache_keys):
+        xml = cached.get(cache_key)
+        if xml is None:
+            article = articles.get(str(ref[0]))
+            if not article:
+                continue
+            xml = render_entry(article)
+            rendered[cache_key] = xml
+        entries.append((str(ref[0]), ref[1], ref[2], xml))
+    if rendered:
+        memcache.set_multi(rendered)
+    return entries
+
+def summary_refs(summaries):
+    return [(summary.article_key(), summary.published, summary.updated)
+            for summary in summaries]
+
+def make_entry(article):
+    """Renders an article's entry and replaces its cached fragment.
+
+    Edits don't have to change the updated time that fragments are
+    keyed by, so a written article is always rendered again.
+    """
+    xml = render_entry(article)
+    memcache.set(fragment_memcache_key(article.key(), article.updated), xml)
+    return (str(article.key()), article.published, article.updated, xml)
+
+def render_document(entries, params):
+    """Wraps rendered entries in an Atom <feed>.
+
+    Args:
+      entries: (key string, published, updated, entry xml) tuples
+      params: extra template params, e.g. archive links
+    """
+    updated = ''
+    if entries:
+        updated = rfc3339(max([entry[2] for entry in entries]))
+    params.update({ "blog_updated_timestamp": updated,
+                    "entries_xml": ''.join([entry[3] for entry in entries]) })
+    return render_template("atom.xml", params)
+
+def head_params(entries):
+    params = { "self_url": config.BLOG['root_url'] + 
+                           config.BLOG['master_atom_url'] }
+    if entries:
+        oldest = entries[-1][1]
+        # Archive for the oldest month in the head feed, which may 
+        # overlap the head.  Clients reconcile entries by id.
+        params["prev_archive_url"] = archive_url(oldest.year, oldest.month)
+    return params
+
+def save_head(feed):
+    entries = feed.get_entries()
+    feed.document = db.Text(render_document(entries, head_params(entries)))
+    feed.put()
+    memcache.set(HEAD_MEMCACHE_KEY, feed.document)
+
+def rebuild_head():
+    """Builds the head feed from a query on the newest blog entries."""
+    summaries = db.Query(models.blog.ArticleSummary). \
+                   filter('article_type =', 'blog entry'). \
+                   order('-published'). \
+                   fetch(limit=models.blog.AtomFeed.HEAD_SIZE)
+    feed = models.blog.AtomFeed(key_name=HEAD_KEY_NAME)
+    feed.set_entries(get_entries(summary_refs(summaries)))
+    save_head(feed)
+    return feed
+
+def get_head_document():
+    document = memcache.get(HEAD_MEMCACHE_KEY)
+    if document is None:
+        feed = models.blog.AtomFeed.get_by_key_name(HEAD_KEY_NAME)
+        if feed is None:
+            feed = rebuild_head()
+        document = feed.document
+        memcache.set(HEAD_MEMCACHE_KEY, document)
+    return document
+
+def update_entry(article):
+    "Call after an article is published or edited."
+    # Tag feeds hold all article types.  Render first, so a rebuilt
+    # head feed gets the new fragment too.
+    entry = make_entry(article)
+    clear_documents(article)
+    if article.article_type != 'blog entry':
+        return
+    feed = models.blog.AtomFeed.get_by_key_name(HEAD_KEY_NAME)
+    if feed is None:
+        rebuild_head()
+    elif feed.splice(entry):
+        save_head(feed)
+
+def remove_entry(article):
+    "Call after an article is deleted."
+    clear_documents(article)
+    if article.article_type != 'blog entry':
+        return
+    feed = models.blog.AtomFeed.get_by_key_name(HEAD_KEY_NAME)
+    if feed is None or feed.remove(str(article.key())):
+        # Refill the slot that opened up at the end of the feed.
+        rebuild_head()
+
+def clear_documents(article):
+    "Clears cached archive and tag feeds that could hold the article"
+    memcache.delete_multi(
+        [archive_memcache_key(article.published.year, 
+                              article.published.month)] +
+        [tag_memcache_key(tag) for tag in article.tags])
+
+def archive_memcache_key(year, month):
+    return 'AtomArchive%04d%02d' % (year, month)
+
+def get_archive_document(year, month):
+    """Returns the archive document for a month, or None if the month
+    has no articles."""
+    memcache_key = archive_memcache_key(year, month)
+    document = memcache.get(memcache_key)
+    if document is not None:
+        return document
+    archive = models.blog.ArchiveMonth.get_month(year, month)
+    if not archive:
+        return None
+    summaries = models.blog.ArticleSummary.get_for_articles(
+                    archive.article_keys)
+    entries = get_entries(summary_refs(
+        [summary for summary in summaries 
+         if summary.article_type == 'blog entry']))
+
+    # Link to the neighboring months that have articles.
+    months = [(m['year'], m['month']) 
+              for m in models.blog.ArchiveMonth.list()]
+    months.sort()
+    params = { "is_archive": True,
+               "self_url": archive_url(year, month),
+               "head_url": config.BLOG['root_url'] + 
+                           config.BLOG['master_atom_url'] }
+    if (year, month) in months:
+        i = months.index((year, month))
+        if i > 0:
+            params["prev_archive_url"] = archive_url(*months[i-1])
+        if i < len(months) - 1:
+            params["next_archive_url"] = archive_url(*months[i+1])
+    document = render_document(entries, params)
+    memcache.set(memcache_key, document)
+    return document
+
+def tag_memcache_key(tag):
+    return 'AtomTag' + utf8(tag)
+
+def get_tag_document(tag):
+    """Returns a feed of the newest articles with the tag."""
+    memcache_key = tag_memcache_key(tag)
+    document = memcache.get(memcache_key)
+    if document is not None:
+        return document
+    summaries = db.Query(models.blog.ArticleSummary). \
+                   filter('tags =', tag).order('-published'). \
+                   fetch(limit=models.blog.AtomFeed.HEAD_SIZE)
+    entries = get_entries(summary_refs(summaries))
+    document = render_document(entries, { "self_url": tag_feed_url(tag),
+                                           "tag": tag })
+    memcache.set(memcache_key, document)
+    return document
@@ -56,8 +56,12 @@ from google.appengine.api import urlfetch
 from handlers import restful
 from utils import authorized
 from utils import sanitizer
+from utils.external import simplejson
 import models
+import models.searchindex
+import models.similarity
 import view
+import feeds
 import config
 
 import legacy_aliases   # This can be either manually created or 
@@ -70,21 +74,22 @@ permalink_funcs = {
                         str(date.month) + "/" + get_friendly_url(title)
 }
 
+# Precomputed aliases are matched case-insensitively, so fold them once
+# per instance instead of on every request.
+legacy_redirects = dict([(alias.lower(), permalink) for alias, permalink
+                         in legacy_aliases.redirects.iteritems()])
+
 # We allow a mapping from some old url pattern to the current query 
 #  using a regex's matched string.
-def legacy_id_mapping(path, legacy_program):
-    if legacy_program:
-        if legacy_program == 'Drupal':
-            url_match = re.match('node/(\d+)/?$', path)
-            if url_match:
-                return db.Query(models.blog.Article). \
-                    filter('legacy_id =', url_match.group(1)). \
-                    get()
-        elif legacy_program == 'Serendipity':
-            url_match = re.match('archives/(\d+)-.*\.html$', path)
-            if url_match:
-                return db.Query(models.blog.Article). \
-                    filter('legacy_id =', url_match.group(1)).get()
+#   Drupal:      node/<id>
+#   Serendipity: archives/<id>-<title>.html
+legacy_id_pattern = re.compile('(?:node/(\d+)/?|archives/(\d+)-.*\.html)$')
+
+def legacy_id_for_path(path, legacy_program):
+    if legacy_program in ['Drupal', 'Serendipity']:
+        url_match = legacy_id_pattern.match(path)
+        if url_match:
+            return url_match.group(1) or url_match.group(2)
     return None
 
 # Module methods to handle incoming data
@@ -98,18 +103,11 @@ def get_format(format_string):
         format_string = 'html'
     return format_string
 
-def get_tag_key(tag_name):
-    obj = models.blog.Tag.get_or_insert(tag_name)
-    return obj.key()
-
-def process_tag(tag_name, tags):
-    # Check tag_name against all 'name' values in tags and coerce
+def process_tag(tag_name, canonical_names):
+    # Coerce tag_name to the case of an existing tag, if any.
+    # canonical_names maps lowercased tag names to existing names.
     tag_name = tag_name.strip()
-    lowercase_name = tag_name.lower()
-    for tag in tags:
-        if lowercase_name == tag['name'].lower():
-            return tag['name']
-    return tag_name
+    return canonical_names.get(tag_name.lower(), tag_name)
 
 def get_tags(tags_string):
     logging.debug("get_tags: tag_string = %s", tags_string)
@@ -117,7 +115,9 @@ def get_tags(tags_string):
         from models.blog import Tag
         tags = Tag.list()
         logging.debug("  tags = %s", tags)
-        return [process_tag(s, tags) 
+        canonical_names = dict([(tag['name'].lower(), tag['name']) 
+                                for tag in tags])
+        return [process_tag(s, canonical_names) 
                 for s in tags_string.split(",") if s != '']
     return None
     
@@ -144,10 +144,11 @@ def get_sanitizer_func(handler, **kwargs):
         kwlist.update({ 'encoding': match_obj.group('charset').lower() })
     logging.debug("Content-type: %s", handler.request.headers['CONTENT_TYPE'])
     logging.debug("In sanitizer: %s", kwlist)
-    return lambda html : sanitizer.sanitize_html(html, **kwlist)
+    return lambda html : sanitizer.stream_sanitize_html(html, **kwlist)
 
 def do_sitemap_ping():
-    form_fields = { "sitemap": "%s/sitemap.xml" % (config.BLOG['root_url'],) }
+    form_fields = { "sitemap": "%s/sitemap_index.xml" % 
+                                   (config.BLOG['root_url'],) }
     urlfetch.fetch(url="http://www.google.com/webmasters/tools/ping",
                    payload=urllib.urlencode(form_fields),
                    method=urlfetch.GET)
@@ -176,21 +177,22 @@ def process_article_edit(handler, permalink):
 
     if property_hash:
         if 'tags' in property_hash:
-            property_hash['tag_keys'] = [get_tag_key(name) 
-                                         for name in property_hash['tags']]
+            property_hash['tag_keys'] = models.blog.Tag.get_or_insert_many(
+                                            property_hash['tags'])
         article = db.Query(models.blog.Article).filter('permalink =', permalink).get()
         before_tags = set(article.tag_keys)
         for key,value in property_hash.iteritems():
             setattr(article, key, value)
         after_tags = set(article.tag_keys)
-        for removed_tag in before_tags - after_tags:
-            db.get(removed_tag).counter.decrement()
-        for added_tag in after_tags - before_tags:
-            db.get(added_tag).counter.increment()
         process_embedded_code(article)
         article.put()
+        models.blog.Tag.update_counts(removed_keys=before_tags - after_tags,
+                                      added_keys=after_tags - before_tags)
+        feeds.update_entry(article)
         restful.send_successful_response(handler, '/' + article.permalink)
-        view.invalidate_cache()
+        # Tag counts show on every page.
+        view.invalidate_cache(handler, article,
+                              site_wide=before_tags != after_tags)
     else:
         handler.error(400)
 
@@ -208,8 +210,8 @@ def process_article_submission(handler, article_type):
 
     if property_hash:
         if 'tags' in property_hash:
-            property_hash['tag_keys'] = [get_tag_key(name) 
-                                         for name in property_hash['tags']]
+            property_hash['tag_keys'] = models.blog.Tag.get_or_insert_many(
+                                            property_hash['tags'])
         property_hash['format'] = 'html'   # For now, convert all to HTML
         property_hash['article_type'] = article_type
         article = models.blog.Article(**property_hash)
@@ -218,11 +220,11 @@ def process_article_submission(handler, article_type):
              'amazon_items': handler.request.get('amazon_items')})
         process_embedded_code(article)
         article.put()
-        for key in article.tag_keys:
-            db.get(key).counter.increment()
+        models.blog.Tag.update_counts(added_keys=article.tag_keys)
+        feeds.update_entry(article)
         do_sitemap_ping()
         restful.send_successful_response(handler, '/' + article.permalink)
-        view.invalidate_cache()
+        view.invalidate_cache(handler)
     else:
         handler.error(400)
 
@@ -274,13 +276,7 @@ def process_comment_submission(handler, article):
         property_hash['thread'] = thread_string
         del property_hash['key']
 
-    # Get and store some pieces of information from parent article.
-    # TODO: See if this overhead can be avoided
-    if not article.num_comments:
-        article.num_comments = 1
-    else:
-        article.num_comments += 1
-    property_hash['article'] = article.put()
+    property_hash['article'] = article.key()
 
     try:
         comment = models.blog.Comment(**property_hash)
@@ -289,6 +285,9 @@ def process_comment_submission(handler, article):
         logging.debug("Bad comment: %s", property_hash)
         handler.error(400)
         return
+    # The count lives in the article's summary so the article itself,
+    # and its full-text index, isn't rewritten for every comment.
+    models.blog.ArticleSummary.add_comment(article)
         
     # Notify the author of a new comment (from matteocrippa.it)
     if config.BLOG['send_comment_notification']:
@@ -307,10 +306,12 @@ def process_comment_submission(handler, article):
         { 'comment': comment, "use_gravatars": config.BLOG["use_gravatars"] },
         debug=config.DEBUG)
     handler.response.out.write(response)
-    view.invalidate_cache()
+    view.invalidate_cache(handler, article, site_wide=False)
 
 def render_article(handler, article):
     if article:
+        article.num_comments = models.blog.ArticleSummary.comment_count(
+                                   article)
         # Check if client is requesting javascript and
         # return json if javascript is #1 in Accept header.
         try:
@@ -367,8 +368,8 @@ class RootHandler(restful.Controller):
         page = view.ViewPage()
         page.render_query(
             self, 'articles', 
-            db.Query(models.blog.Article). \
-               filter('article_type =', 'blog entry').order('-published'))
+            lambda: db.Query(models.blog.ArticleSummary). \
+                        filter('article_type =', 'blog entry'))
 
     @authorized.role("admin")
     def post(self):
@@ -381,9 +382,9 @@ class ArticlesHandler(restful.Controller):
         page = view.ViewPage()
         page.render_query(
             self, 'articles',
-            db.Query(models.blog.Article). \
-               filter('article_type =', 'article').order('title'),
-            num_limit=20)
+            lambda: db.Query(models.blog.ArticleSummary). \
+                        filter('article_type =', 'article'),
+            num_limit=20, order='title')
 
 # Articles are off root url
 # TODO -- Make it DRY by combining Article/MonthHandler
@@ -391,24 +392,25 @@ class ArticleHandler(restful.Controller):
     def get(self, path):
         logging.debug("ArticleHandler#get on path (%s)", path)
         # Handle precomputed legacy aliases
-        # TODO: Use hash for case-insensitive lookup
-        for alias in legacy_aliases.redirects:
-            if path.lower() == alias.lower():
-                self.redirect(legacy_aliases.redirects[alias])
-                return
+        permalink = legacy_redirects.get(path.lower())
+        if permalink:
+            self.redirect(permalink)
+            return
+
+        # This lets you map arbitrary URL patterns like /node/3
+        #  to article properties, e.g. 3 -> legacy_id property
+        legacy_id = legacy_id_for_path(path, 
+                                       config.BLOG["legacy_blog_software"])
+        if legacy_id:
+            permalink = models.blog.Article.permalink_for_legacy_id(legacy_id)
+            if permalink:
+                if config.BLOG["legacy_entry_redirect"]:
+                    self.redirect('/' + permalink)
+                    return
+                path = permalink
 
         # Check undated pages
-        article = db.Query(models.blog.Article). \
-                     filter('permalink =', path).get()
-
-        if not article:
-            # This lets you map arbitrary URL patterns like /node/3
-            #  to article properties, e.g. 3 -> legacy_id property
-            article = legacy_id_mapping(path,
-                                        config.BLOG["legacy_blog_software"])
-            if article and config.BLOG["legacy_entry_redirect"]:
-                self.redirect('/' + article.permalink)
-                return
+        article = models.blog.Article.get_by_permalink(path)
         render_article(self, article)
 
     @restful.methods_via_query_allowed    
@@ -443,8 +445,10 @@ class ArticleHandler(restful.Controller):
                     title = ''
                 logging.debug('Deleting %s %s', model_class, title)
                 targets[0].delete()
+                if isinstance(targets[0], models.blog.Article):
+                    feeds.remove_entry(targets[0])
                 self.response.out.write('Deleted ' + model_class + ' ' + title)
-                view.invalidate_cache()
+                view.invalidate_cache(self)
             else:
                 self.response.set_status(204, 'No more ' + model_class + ' entities')
                 
@@ -460,10 +464,10 @@ class ArticleHandler(restful.Controller):
         else:
             article = db.Query(models.blog.Article). \
                          filter('permalink =', path).get()
-            for key in article.tag_keys:
-                db.get(key).counter.decrement()
             article.delete()
-            view.invalidate_cache()
+            models.blog.Tag.update_counts(removed_keys=article.tag_keys)
+            feeds.remove_entry(article)
+            view.invalidate_cache(self)
             restful.send_successful_response(self, "/")
 
 # Blog entries are dated articles
@@ -472,9 +476,8 @@ class BlogEntryHandler(restful.Controller):
         logging.debug("BlogEntryHandler#get for year %s, "
                       "month %s, and perm_link %s", 
                       year, month, perm_stem)
-        article = db.Query(models.blog.Article). \
-                     filter('permalink =', 
-                            year + '/' + month + '/' + perm_stem).get()
+        article = models.blog.Article.get_by_permalink(
+                      year + '/' + month + '/' + perm_stem)
         render_article(self, article)
 
     @restful.methods_via_query_allowed    
@@ -501,69 +504,127 @@ class BlogEntryHandler(restful.Controller):
         logging.debug("Deleting blog entry %s", permalink)
         article = db.Query(models.blog.Article). \
                      filter('permalink =', permalink).get()
-        for key in article.tag_keys:
-            db.get(key).counter.decrement()
         article.delete()
-        view.invalidate_cache()
+        models.blog.Tag.update_counts(removed_keys=article.tag_keys)
+        feeds.remove_entry(article)
+        view.invalidate_cache(self)
         restful.send_successful_response(self, "/")
 
+def decode_tag(encoded_tag):
+    return re.sub('(%25|%)(\d\d)', 
+                  lambda cmatch: chr(string.atoi(cmatch.group(2), 16)),                 
+                  encoded_tag)   # No urllib.unquote in AppEngine?
+
 class TagHandler(restful.Controller):
     def get(self, encoded_tag):
-        tag =  re.sub('(%25|%)(\d\d)', 
-                      lambda cmatch: chr(string.atoi(cmatch.group(2), 16)),                 
-                      encoded_tag)   # No urllib.unquote in AppEngine?
+        tag = decode_tag(encoded_tag)
         page = view.ViewPage()
         page.render_query(
             self, 'articles', 
-            db.Query(models.blog.Article).filter('tags =',        
-                                                 tag).order('-published'), 
-                                                {'tag': tag})
+            lambda: db.Query(models.blog.ArticleSummary). \
+                        filter('tags =', tag),
+            {'tag': tag, 'tag_feed_url': feeds.tag_feed_url(tag)})
+
+class TagAtomHandler(webapp.RequestHandler):
+    def get(self, encoded_tag):
+        tag = decode_tag(encoded_tag)
+        logging.debug("Sending Atom feed for tag %s", tag)
+        self.response.headers['Content-Type'] = 'application/atom+xml'
+        self.response.out.write(feeds.get_tag_document(tag))
+
+def get_search_results(search_term):
+    """Returns a get_func for render_key_list that gives each summary
+    a snippet of its article around the search terms."""
+    def get_results(article_keys):
+        summaries = models.blog.ArticleSummary.get_for_articles(article_keys)
+        snippets = models.searchindex.snippets(
+            [summary.article_key() for summary in summaries], search_term)
+        for summary, snippet in zip(summaries, snippets):
+            summary.snippet = snippet
+        return summaries
+    return get_results
 
 class SearchHandler(restful.Controller):
     def get(self):
-        from google.appengine.api import datastore_errors
         search_term = self.request.get("s")
         query_string = 's=' + urllib.quote_plus(search_term) + '&'
+        params = {'search_term': search_term, 'search_string': query_string,
+                  'query_string': query_string}
         page = view.ViewPage()
-        try:
-            page.render_query(
-                self, 'articles', 
-                models.blog.Article.all().search(search_term). \
-                    order('-published'), 
-                {'search_term': search_term, 'query_string': query_string})
-        except datastore_errors.NeedIndexError:
-            page.render(self, {'search_term': search_term,
-                               'search_error_message': """
-                               Sorry, full-text searches are currently limited
-                               to single words until a later AppEngine update.
-                               """})
+        like = self.request.get("like")
+        if like.isdigit():
+            # More like this article
+            article = models.blog.Article.get_by_id(int(like))
+            keys = article and models.similarity.related(models.blog.Article,
+                                                         article.key()) or []
+            params.update({'like_article': article,
+                           'query_string': 'like=%s&' % like})
+            if not keys:
+                params['search_error_message'] = \
+                    'No similar articles have been found yet.'
+            page.render_key_list(self, 'articles', keys, 
+                                 models.blog.ArticleSummary.get_for_articles,
+                                 params)
+            return
+        if not models.searchindex.parse_query(search_term):
+            # Nothing indexed can match, so skip the cache and datastore.
+            params.update({'articles': [], 'search_error_message':
+                'Search words need at least four letters and can\'t be '
+                'common words like "about" or "which".'})
+            page.render(self, params)
+            return
+        if self.request.get("order") == 'relevance':
+            order = 'relevance'
+            compute = lambda: models.searchindex.ranked_search(
+                                  models.blog.Article, search_term)
+            params.update({'by_relevance': True,
+                           'query_string': query_string + 'order=relevance&'})
+        elif self.request.get("order") == 'similar':
+            order = 'similar'
+            compute = lambda: models.similarity.similar_search(
+                                  models.blog.Article, search_term)
+            params.update({'by_similarity': True,
+                           'query_string': query_string + 'order=similar&'})
+        else:
+            order = 'published'
+            compute = lambda: models.searchindex.sorted_search(
+                                  models.blog.Article, search_term)
+        keys = models.searchindex.cached_keys(models.blog.Article, 
+                                              search_term, order, compute)
+        page.render_key_list(self, 'articles', keys, 
+                             get_search_results(search_term), params)
+
+class SuggestHandler(restful.Controller):
+    """Completes a search prefix as JSON, for search-as-you-type."""
+    def get(self):
+        suggestions = models.blog.Article.suggest(self.request.get("q"))
+        self.response.headers['Content-Type'] = 'application/json'
+        # Completions only change with the index, so let caches keep
+        # them by prefix for a while.
+        self.response.headers['Cache-Control'] = 'public, max-age=300'
+        self.response.out.write(simplejson.dumps(suggestions))
 
 class YearHandler(restful.Controller):
     def get(self, year):
         logging.debug("YearHandler#get for year %s", year)
-        start_date = datetime.datetime(string.atoi(year), 1, 1)
-        end_date = datetime.datetime(string.atoi(year), 12, 31, 23, 59, 59)
+        article_keys = []
+        for month in models.blog.ArchiveMonth.get_year(int(year)):
+            article_keys += month.article_keys
         page = view.ViewPage()
-        page.render_query(
-            self, 'articles', 
-            db.Query(models.blog.Article).order('-published'). \
-               filter('published >=', start_date). \
-               filter('published <=', end_date), 
+        page.render_key_list(
+            self, 'articles', article_keys, 
+            models.blog.ArticleSummary.get_for_articles,
             {'title': 'Articles for ' + year, 'year': year})
 
 class MonthHandler(restful.Controller):
     def get(self, year, month):
         logging.debug("MonthHandler#get for year %s, month %s", year, month)
-        start_date = datetime.datetime(string.atoi(year), 
-                                       string.atoi(month), 1)
-        end_date = datetime.datetime(string.atoi(year), 
-                                     string.atoi(month), 31, 23, 59, 59)
+        archive = models.blog.ArchiveMonth.get_month(int(year), int(month))
+        article_keys = archive and archive.article_keys or []
         page = view.ViewPage()
-        page.render_query(
-            self, 'articles', 
-            db.Query(models.blog.Article).order('-published'). \
-               filter('published >=', start_date). \
-               filter('published <=', end_date), 
+        page.render_key_list(
+            self, 'articles', article_keys,
+            models.blog.ArticleSummary.get_for_articles,
             {'title': 'Articles for ' + month + '/' + year, 
              'year': year, 'month': month})
 
@@ -577,27 +638,43 @@ class MonthHandler(restful.Controller):
 class AtomHandler(webapp.RequestHandler):
     def get(self):
         logging.debug("Sending Atom feed")
-        articles = db.Query(models.blog.Article). \
-                      filter('article_type =', 'blog entry'). \
-                      order('-published').fetch(limit=10)
-        updated = ''
-        if articles:
-            updated = articles[0].rfc3339_updated()
-        
         self.response.headers['Content-Type'] = 'application/atom+xml'
+        self.response.out.write(feeds.get_head_document())
+
+class AtomArchiveHandler(webapp.RequestHandler):
+    def get(self, year, month):
+        logging.debug("Sending Atom archive for %s/%s", year, month)
+        document = feeds.get_archive_document(int(year), int(month))
+        if document is None:
+            self.error(404)
+            return
+        self.response.headers['Content-Type'] = 'application/atom+xml'
+        self.response.out.write(document)
+
+class SitemapIndexHandler(webapp.RequestHandler):
+    def get(self):
+        logging.debug("Sending Sitemap index")
+        self.response.headers['Content-Type'] = 'text/xml'
         page = view.ViewPage()
-        page.render(self, {"blog_updated_timestamp": updated, 
-                           "articles": articles, "ext": "xml"})
+        page.render(self, {
+            "sitemaps": models.blog.SitemapChunk.list(),
+            "ext": "xml",
+            "root_url": config.BLOG['root_url']
+        })
 
 class SitemapHandler(webapp.RequestHandler):
-	def get(self):
-		logging.debug("Sending Sitemap")
-		articles = db.Query(models.blog.Article).order('-published').fetch(1000)
-		if articles:
-			self.response.headers['Content-Type'] = 'text/xml'
-			page = view.ViewPage()
-			page.render(self, {
-          "articles": articles,
-          "ext": "xml",
-          "root_url": config.BLOG['root_url']
-      })
+    def get(self, number):
+        logging.debug("Sending Sitemap chunk %s", number)
+        chunk = models.blog.SitemapChunk.get_by_key_name(
+                    models.blog.SitemapChunk.key_name_for(int(number)))
+        if not chunk:
+            self.error(404)
+            return
+        self.response.headers['Content-Type'] = 'text/xml'
+        page = view.ViewPage()
+        page.render(self, {
+            "urls": chunk.get_urls(),
+            "include_root": chunk.number == 0,
+            "ext": "xml",
+            "root_url": config.BLOG['root_url']
+        })
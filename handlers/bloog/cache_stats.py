@@ -36,13 +36,16 @@ from google.appengine.api import memcache
 
 from handlers import restful
 from utils import authorized
+from models import search
 import view
 
 class CacheStatsHandler(restful.Controller):
     @authorized.role("admin")
     def get(self):
         cache_stats = memcache.get_stats()
-        view.ViewPage(cache_time=0).render(self, {"stats": cache_stats})
+        view.ViewPage(cache_time=0).render(self, {
+            "stats": cache_stats,
+            "index_stats": search.INDEX_STATS })
 
     @authorized.role("admin")
     def delete(self):
@@ -0,0 +1,143 @@
+# The MIT License
+# 
+# Copyright (c) 2008 William T. Katz
+# 
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to 
+# deal in the Software without restriction, including without limitation 
+# the rights to use, copy, modify, merge, publish, distribute, sublicense, 
+# and/or sell copies of the Software, and to permit persons to whom the 
+# Software is furnished to do so, subject to the following conditions:
+# 
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+# 
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING
+# FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER 
+# DEALINGS IN THE SOFTWARE.
+
+"""
+jobs.py
+
+Admin-triggered maintenance jobs that walk the datastore in batches.
+
+Each POST runs batches until a time budget is used up, then responds
+with JSON describing progress.  Jobs are resumed by POSTing again with
+the returned 'start' key until 'done' is true, e.g.
+
+  curl -X POST -b <admin cookie> http://<app>/admin/backfill/article
+
+Reindex jobs keep a checkpoint in the datastore after every batch, so
+each POST resumes where the last one stopped, even if it timed out.
+They only rewrite entities whose search index is stale, e.g. after the
+tokenizer, stop words or unsearchable_properties changed.  POST with
+restart=1 to walk the kind again from the start.
+
+  curl -X POST -b <admin cookie> http://<app>/admin/reindex/article
+"""
+__author__ = "William T. Katz"
+
+import time
+import logging
+
+from google.appengine.ext import db
+
+from handlers import restful
+from utils import authorized
+from utils.external import simplejson
+import models.blog
+import models.searchindex
+import models.similarity
+
+# Leave plenty of headroom under the request deadline.
+TIME_BUDGET = 15.0
+BATCH_SIZE = 20
+
+# Each backfill function takes (start_key, batch_size) and returns
+# (key to resume from or None, number scanned, number written).
+BACKFILLS = {
+    'article': models.blog.Article.backfill_derived,
+    'summary': models.blog.ArticleSummary.backfill,
+    'archive': models.blog.ArchiveMonth.backfill,
+    'sitemap': models.blog.SitemapChunk.backfill,
+    'search': lambda start_key, batch_size: models.searchindex.backfill(
+                  models.blog.Article, start_key, batch_size),
+    'vectors': lambda start_key, batch_size: models.similarity.build(
+                   models.blog.Article, start_key, batch_size),
+}
+
+# Searchable models that can be reindexed, by lowercase name.
+REINDEXES = {
+    'article': models.blog.Article,
+}
+
+def run_batches(batch_func, start_key, time_budget=TIME_BUDGET):
+    """Calls batch_func(start_key) until finished or out of time.
+
+    batch_func must return a tuple of (key to resume from or None,
+    number scanned, number written).
+
+    Returns:
+      Dict of progress suitable for a JSON response.
+    """
+    start_time = time.time()
+    scanned = written = 0
+    next_key = start_key
+    while True:
+        next_key, num_scanned, num_written = batch_func(next_key)
+        scanned += num_scanned
+        written += num_written
+        if not next_key or time.time() - start_time > time_budget:
+            break
+    elapsed = time.time() - start_time
+    return { 'start': next_key and str(next_key) or None,
+             'done': next_key is None,
+             'scanned': scanned,
+             'written': written,
+             'seconds': round(elapsed, 2),
+             'per_second': elapsed and round(scanned / elapsed, 1) or 0 }
+
+def send_progress(handler, progress):
+    logging.info("Job progress on %s: %s", handler.request.path, progress)
+    handler.response.headers['Content-Type'] = 'application/json'
+    handler.response.out.write(simplejson.dumps(progress))
+
+class BackfillHandler(restful.Controller):
+    """Brings stored derived data (see SerializableModel) up to date."""
+    @authorized.role("admin")
+    def post(self, name):
+        backfill_func = BACKFILLS.get(name.lower())
+        if not backfill_func:
+            self.error(404)
+            return
+        start = self.request.get('start')
+        start_key = start and db.Key(start) or None
+        progress = run_batches(lambda key: backfill_func(key, BATCH_SIZE),
+                               start_key)
+        send_progress(self, progress)
+
+class ReindexHandler(restful.Controller):
+    """Rebuilds stale search indexes of a SearchableModel kind."""
+    @authorized.role("admin")
+    def post(self, name):
+        model_class = REINDEXES.get(name.lower())
+        if not model_class:
+            self.error(404)
+            return
+        kind = model_class.kind()
+        checkpoint = models.searchindex.ReindexCheckpoint.get_by_key_name(kind)
+        if not checkpoint or checkpoint.done or self.request.get('restart'):
+            checkpoint = models.searchindex.ReindexCheckpoint(key_name=kind)
+        def batch(start_key):
+            batch_start = time.time()
+            result = model_class.reindex(start_key, BATCH_SIZE)
+            checkpoint.add_batch(result[0], result[1], result[2],
+                                 time.time() - batch_start)
+            return result
+        progress = run_batches(batch, checkpoint.start_key())
+        progress.update(checkpoint.progress())
+        send_progress(self, progress)
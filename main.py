@@ -36,7 +36,7 @@ import wsgiref.handlers
 from firepython.middleware import FirePythonWSGI
 from google.appengine.ext import webapp
 from google.appengine.api import users
-from handlers.bloog import blog, contact, cache_stats, timings
+from handlers.bloog import blog, contact, cache_stats, timings, jobs
 
 # Import custom django libraries
 webapp.template.register_template_library('utils.django_libs.gravatar')
@@ -55,12 +55,19 @@ ROUTES = [
     ('/([12]\d\d\d)/(\d|[01]\d)/([-\w]+)/*$', blog.BlogEntryHandler),
     ('/admin/cache_stats/*$', cache_stats.CacheStatsHandler),
     ('/admin/timings/*$', timings.TimingHandler),
+    ('/admin/backfill/(\w+)/*$', jobs.BackfillHandler),
+    ('/admin/reindex/(\w+)/*$', jobs.ReindexHandler),
+    ('/search/suggest', blog.SuggestHandler),
     ('/search', blog.SearchHandler),
     ('/contact/*$', contact.ContactHandler),
+    ('/tag/(.*)/atom\.xml', blog.TagAtomHandler),
     ('/tag/(.*)', blog.TagHandler),
     (config.BLOG['master_atom_url'] + '/*$', blog.AtomHandler),
+    ('/feeds/archive/([12]\d\d\d)/(\d|[01]\d)\.xml', blog.AtomArchiveHandler),
     ('/articles', blog.ArticlesHandler),
-    ('/sitemap.xml', blog.SitemapHandler),
+    ('/sitemap.xml', blog.SitemapIndexHandler),
+    ('/sitemap_index.xml', blog.SitemapIndexHandler),
+    ('/sitemaps/(\d+)\.xml', blog.SitemapHandler),
     ('/(.*)', blog.ArticleHandler)]
 
 def main():
@@ -26,6 +26,8 @@ Extensions include:
 - Counter implemented with sharding to improve write performance
 - Memcached aggregation of entities
 - Serialization of designated properties to json and repr formats.
+- Derived properties that are computed at put() and stored.
+- A small in-process LRU cache for hot entities.
 """
 
 import datetime
@@ -110,9 +112,18 @@ class SerializableModel(db.Model):
     
     Use the class variable 'json_does_not_include' to declare properties
     that should *not* be included in json serialization.
+
+    Use the class variable 'derived_properties' to declare stored
+    properties whose values are computed from the rest of the entity.
+    It's a list of (property name, function) tuples, applied in order
+    just before the entity is written by put() or db.put().  Each
+    function takes the model instance and returns the property value.
+    Entities written before a derived property existed (or before its
+    function changed) can be brought up to date with backfill_derived().
     TODO -- Complete round-tripping
     """
     json_does_not_include = []
+    derived_properties = []
 
     def to_json(self, attr_list=[]):
         def to_entity(entity):
@@ -125,6 +136,87 @@ class SerializableModel(db.Model):
         values = to_dict(self, attr_list, to_entity)
         return simplejson.dumps(values)
 
+    def update_derived_properties(self):
+        for name, derive_func in self.__class__.derived_properties:
+            setattr(self, name, derive_func(self))
+
+    def derived_properties_stale(self):
+        for name, derive_func in self.__class__.derived_properties:
+            if getattr(self, name) != derive_func(self):
+                return True
+        return False
+
+    def _populate_internal_entity(self, *args, **kwargs):
+        """Wraps db.Model._populate_internal_entity(), which both put()
+        and db.put() go through, to store fresh derived properties."""
+        self.update_derived_properties()
+        return super(SerializableModel, self)._populate_internal_entity(
+                                                        *args, **kwargs)
+
+    @classmethod
+    def backfill_derived(cls, start_key=None, batch_size=20):
+        """Rewrites one batch of entities with stale derived properties.
+
+        Returns:
+          Tuple of (key to resume from or None when finished,
+                    number of entities scanned, number rewritten)
+        """
+        entities, next_key = fetch_batch(cls, start_key, batch_size)
+        stale = [obj for obj in entities if obj.derived_properties_stale()]
+        if stale:
+            db.put(stale)
+        return next_key, len(entities), len(stale)
+
+def fetch_batch(model_class, start_key=None, batch_size=20):
+    """Fetches the next batch of entities in key order after start_key.
+
+    Lets maintenance jobs walk a whole kind and resume where a previous
+    request left off.
+
+    Returns:
+      Tuple of (list of entities, key to resume from or None if
+      there are no more entities)
+    """
+    q = db.Query(model_class).order('__key__')
+    if start_key:
+        q.filter('__key__ >', start_key)
+    entities = q.fetch(limit=batch_size)
+    next_key = None
+    if len(entities) == batch_size:
+        next_key = entities[-1].key()
+    return entities, next_key
+
+class LRUCache(object):
+    """Keeps the most recently used values of an instance in memory.
+
+    Values live as long as the instance, so callers should store
+    something they can validate against memcache, like a version.
+    """
+    def __init__(self, size=100):
+        self.size = size
+        self.values = {}
+        self.order = []
+
+    def get(self, key, default=None):
+        if key not in self.values:
+            return default
+        self.order.remove(key)
+        self.order.append(key)
+        return self.values[key]
+
+    def set(self, key, value):
+        if key in self.values:
+            self.order.remove(key)
+        elif len(self.order) >= self.size:
+            del self.values[self.order.pop(0)]
+        self.values[key] = value
+        self.order.append(key)
+
+    def delete(self, key):
+        if key in self.values:
+            self.order.remove(key)
+            del self.values[key]
+
 class MemcachedModel(SerializableModel):
     """MemcachedModel adds memcached all() retrieval through list().
     
@@ -135,8 +227,12 @@ class MemcachedModel(SerializableModel):
     Currently, this class does not care about failed attempts
     to alter the datastore, so uncompleted deletes and puts
     will still clear the cache.
+
+    Set list_includes_properties to False when entities hold large
+    lists or blobs so that list() only caches the list_includes values.
     """
     list_includes = []
+    list_includes_properties = True
 
     def delete(self):
         super(MemcachedModel, self).delete()
@@ -148,8 +244,11 @@ class MemcachedModel(SerializableModel):
         return key
 
     def _to_repr(self):
+        init_dict_func = self._to_entity
+        if not self.__class__.list_includes_properties:
+            init_dict_func = lambda values: None
         return repr(to_dict(self, self.__class__.list_includes, 
-                    self._to_entity))
+                    init_dict_func))
 
     @classmethod
     def get_or_insert(cls, key_name, **kwds):
@@ -242,6 +341,34 @@ class Counter(object):
                                downward=True)
         return memcache.decr(self.memcache_key()) 
 
+    @classmethod
+    def adjust_many(cls, deltas, num_shards=5):
+        """Applies a dict of {counter name: delta} to many counters.
+
+        Uses one batch get and one batch put of shards instead of a
+        transaction per counter.  Since the shard updates aren't
+        transactional, only use this for counters that have a single
+        writer at a time, like tag counts changed by admin edits.
+        """
+        names = [name for name, delta in deltas.iteritems() if delta]
+        if not names:
+            return
+        num_shards = min(num_shards, Counter.MAX_SHARDS)
+        shard_names = ['Shard' + name + str(random.randint(1, num_shards))
+                       for name in names]
+        shards = CounterShard.get_by_key_name(shard_names)
+        for i, name in enumerate(names):
+            if shards[i] is None:
+                shards[i] = CounterShard(key_name=shard_names[i], name=name)
+            shards[i].count += deltas[name]
+        db.put(shards)
+        for name in names:
+            cache_key = cls(name).memcache_key()
+            if deltas[name] > 0:
+                memcache.incr(cache_key, deltas[name])
+            else:
+                memcache.decr(cache_key, -deltas[name])
+
 class CounterShard(db.Model):
     name = db.StringProperty(required=True)
     count = db.IntegerProperty(default=0)
@@ -20,7 +20,10 @@
 # FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER 
 # DEALINGS IN THE SOFTWARE.
 
+import datetime
 import logging
+import md5
+import time
 
 from google.appengine.api import memcache
 from google.appengine.ext import db
@@ -30,22 +33,109 @@ import models
 from models import search
 
 # Handle generation of thread strings
-def get_thread_string(article, cur_thread_string):
+MAX_COMMENTS_PER_LEVEL = 999
+
+class ThreadCounter(db.Model):
+    """Next-child counter for one level of a comment thread.
+
+    Counters are children of their Article so a new thread number can be
+    allocated in one small transaction on the article's entity group.
+    The key name is 'T' + the thread prefix, e.g. 'T' for top-level
+    comments and 'T001.' for replies to comment 001.
+    """
+    count = db.IntegerProperty(default=0)
+
+def count_thread_children(article, cur_thread_string):
+    """Counts existing comments on a thread level.  Only used to seed
+    counters for articles commented on before ThreadCounter existed."""
     min_str = cur_thread_string + '000'
     max_str = cur_thread_string + '999'
     q = db.GqlQuery("SELECT * FROM Comment " +
                     "WHERE article = :1 " +
                     "AND thread >= :2 AND thread <= :3",
                     article, min_str, max_str)
-    num_comments = q.count(999)
-    if num_comments > 998:
+    return q.count(MAX_COMMENTS_PER_LEVEL)
+
+def get_thread_string(article, cur_thread_string):
+    """Allocates the next thread string under cur_thread_string.
+
+    Returns None if the level is full or the allocation transaction
+    could not be committed.
+    """
+    key_name = 'T' + cur_thread_string
+    seed = 0
+    if ThreadCounter.get_by_key_name(key_name, parent=article) is None:
+        seed = count_thread_children(article, cur_thread_string)
+
+    def allocate():
+        counter = ThreadCounter.get_by_key_name(key_name, parent=article)
+        if counter is None:
+            counter = ThreadCounter(key_name=key_name, parent=article,
+                                    count=seed)
+        if counter.count >= MAX_COMMENTS_PER_LEVEL:
+            return None
+        counter.count += 1
+        counter.put()
+        return counter.count
+    try:
+        num = db.run_in_transaction(allocate)
+    except db.TransactionFailedError:
+        logging.error("Couldn't allocate thread string under '%s'",
+                      cur_thread_string)
+        return None
+    if num is None:
         return None         # Only allow 999 comments on each tree level
-    return cur_thread_string + "%03d" % (num_comments + 1)
+    return cur_thread_string + "%03d" % num
+
+# Functions for Article.derived_properties.  Each takes an Article.
+EXCERPT_WORDS = 68
+DESCRIPTION_CHARS = 150
+
+def html_has_media(article):
+    html = article.html or ''
+    return bool(article.embedded_code or '<img' in html or
+                '<code>' in html or '<pre>' in html)
+
+def html_length(article):
+    return len(article.html or '')
+
+def html_description(article):
+    "Tag-stripped start of the html for the meta description"
+    import re
+    text = re.sub(r'<[^>]*?>', '', article.html or '').replace("\n", "")
+    return text[0:DESCRIPTION_CHARS]
+
+def html_excerpt(article):
+    "Word-truncated html for listing pages"
+    from utils import template     # Configures django settings
+    from django.template.defaultfilters import truncatewords_html
+    return db.Text(truncatewords_html(article.html or '', EXCERPT_WORDS))
+
+def html_for_atom(article):
+    """Returns a string suitable for inclusion in Atom XML feed
+    
+    Internal html property should already have XHTML entities
+    converted into unicode.  However, ampersands are valid ASCII
+    and will cause issues with XML, so reconvert ampersands to
+    valid XML entities &amp;
+    """
+    import re
+    return db.Text(re.sub('&(?!amp;)', '&amp;', article.html or ''))
 
 class Article(search.SearchableModel):
     unsearchable_properties = ['permalink', 'legacy_id', 'article_type', 
-                               'excerpt', 'html', 'format', 'tag_keys']
+                               'excerpt', 'html', 'format', 'tag_keys',
+                               'description', 'excerpt_html', 'atom_html']
     json_does_not_include = ['assoc_dict']
+    positional_index = True
+    suggestions = True
+    snippet_property = 'html'
+    sort_property = 'published'
+    derived_properties = [('has_media', html_has_media),
+                          ('html_length', html_length),
+                          ('description', html_description),
+                          ('excerpt_html', html_excerpt),
+                          ('atom_html', html_for_atom)]
 
     permalink = db.StringProperty(required=True)
     # Useful for aliasing of old urls
@@ -67,7 +157,8 @@ class Article(search.SearchableModel):
                                             "markdown", "text"]))
     # Picked dict for sidelinks, associated Amazon items, etc.
     assoc_dict = db.BlobProperty()
-    # To prevent full query when just showing article headlines
+    # Comment count before counts moved to ArticleSummary.  Pages set it
+    # from the summary at read time; comment posts don't put it.
     num_comments = db.IntegerProperty(default=0)
     # Use keys instead of db.Category for consolidation of tag names
     tags = db.StringListProperty(default=[])
@@ -77,6 +168,12 @@ class Article(search.SearchableModel):
     # A list of languages for code embedded in article.
     # This lets us choose the proper javascript for pretty viewing.
     embedded_code = db.StringListProperty()
+    # Derived from html at put() so views don't recompute them.
+    has_media = db.BooleanProperty()
+    html_length = db.IntegerProperty()
+    description = db.StringProperty()
+    excerpt_html = db.TextProperty()
+    atom_html = db.TextProperty()
 
     def get_comments(self):
         """Return comments lexicographically sorted on thread string"""
@@ -109,30 +206,495 @@ class Article(search.SearchableModel):
         return self.updated.strftime('%Y-%m-%dT%H:%M:%SZ')
 
     def is_big(self):
-        guess_chars = len(self.html) + self.num_comments * 80
-        if guess_chars > 2000 or \
-           self.embedded_code or \
-           '<img' in self.html or \
-           '<code>' in self.html or \
-           '<pre>' in self.html:
-            return True
-        else:
-            return False
+        if self.has_media is None:
+            # Not yet backfilled
+            self.update_derived_properties()
+        guess_chars = self.html_length + self.num_comments * 80
+        return guess_chars > 2000 or self.has_media
 
     def next_comment_thread_string(self):
         'Returns thread string for next comment for this article'
         return get_thread_string(self, '')
 
+    def suggestion(self):
+        return {'title': self.title, 'url': '/' + self.permalink}
+
+    def put(self):
+        is_new = not self.is_saved()
+        key = super(Article, self).put()
+        ArticleSummary.put_for_articles([self])
+        if is_new:
+            ArchiveMonth.add_article(self)
+        SitemapChunk.update_article(self)
+        if self.legacy_id:
+            memcache.delete(Article.legacy_memcache_key(self.legacy_id))
+        self.uncache()
+        return key
+
+    def delete(self):
+        summary_key = ArticleSummary.key_for(self.key())
+        if self.legacy_id:
+            memcache.delete(Article.legacy_memcache_key(self.legacy_id))
+        self.uncache()
+        ArchiveMonth.remove_article(self)
+        SitemapChunk.remove_article(self)
+        super(Article, self).delete()
+        db.delete(summary_key)
+
+    # Articles read by permalink are cached in memcache as
+    #   'ArticlePath' + permalink -> (key string, version)
+    #   'Article' + key string -> (version, encoded entity)
+    # and decoded entities are kept per instance, checked by version.
+    # A permalink without an article is cached as '' for a short time
+    # so repeated probes of junk urls don't query.
+    MISSING_TIME = 300
+    local_cache = models.LRUCache(100)
+
+    @staticmethod
+    def path_memcache_key(permalink):
+        # Probed paths can be longer than a memcache key allows.
+        if isinstance(permalink, unicode):
+            permalink = permalink.encode('utf-8')
+        return 'ArticlePath' + md5.new(permalink).hexdigest()
+
+    @staticmethod
+    def entity_memcache_key(key_str):
+        return 'Article' + key_str
+
+    @classmethod
+    def get_by_permalink(cls, permalink):
+        """Returns the article at permalink or None, through the caches."""
+        path_key = cls.path_memcache_key(permalink)
+        ref = memcache.get(path_key)
+        if ref == '':
+            return None
+        if ref:
+            article = cls.get_cached(ref[0], ref[1])
+            if article:
+                return article
+        article = db.Query(cls).filter('permalink =', permalink).get()
+        if article is None:
+            memcache.set(path_key, '', cls.MISSING_TIME)
+            return None
+        key_str = str(article.key())
+        version = repr(time.time())
+        memcache.set_multi({
+            path_key: (key_str, version),
+            cls.entity_memcache_key(key_str): 
+                (version, db.model_to_protobuf(article).Encode()) })
+        cls.local_cache.set(key_str, (version, article))
+        return article
+
+    @classmethod
+    def get_cached(cls, key_str, version):
+        """Returns the cached article for key_str if it has version."""
+        local = cls.local_cache.get(key_str)
+        if local and local[0] == version:
+            return local[1]
+        data = memcache.get(cls.entity_memcache_key(key_str))
+        if not data or data[0] != version:
+            return None
+        article = db.model_from_protobuf(data[1])
+        cls.local_cache.set(key_str, (version, article))
+        return article
+
+    def uncache(self):
+        key_str = str(self.key())
+        memcache.delete_multi([Article.path_memcache_key(self.permalink),
+                               Article.entity_memcache_key(key_str)])
+        Article.local_cache.delete(key_str)
+
+    # Unmapped legacy ids are remembered briefly so probes of old urls
+    # don't query every time, while newly imported articles still show up.
+    LEGACY_MISS_TIME = 600
+
+    @staticmethod
+    def legacy_memcache_key(legacy_id):
+        return 'LegacyId' + legacy_id
+
+    @classmethod
+    def permalink_for_legacy_id(cls, legacy_id):
+        """Returns the permalink of the article imported with legacy_id.
+
+        Resolved ids are cached, so a legacy hit only costs a memcache get.
+        Returns None when no article has the id.
+        """
+        memcache_key = cls.legacy_memcache_key(legacy_id)
+        permalink = memcache.get(memcache_key)
+        if permalink is None:
+            article = db.Query(cls).filter('legacy_id =', legacy_id).get()
+            if article:
+                permalink = article.permalink
+                memcache.set(memcache_key, permalink)
+            else:
+                permalink = ''
+                memcache.set(memcache_key, permalink, cls.LEGACY_MISS_TIME)
+        return permalink or None
+
     def to_atom_xml(self):
-        """Returns a string suitable for inclusion in Atom XML feed
-        
-        Internal html property should already have XHTML entities
-        converted into unicode.  However, ampersands are valid ASCII
-        and will cause issues with XML, so reconvert ampersands to
-        valid XML entities &amp;
+        if self.atom_html is None:
+            return html_for_atom(self)
+        return self.atom_html
+
+class ArticleSummary(db.Model):
+    """The few Article properties shown on listing pages.
+
+    Listing queries read summaries so they don't have to deserialize
+    body, html, assoc_dict and the full-text index of every Article.
+    A summary is the child of its Article and is rewritten by every
+    Article.put().  Batch db.put() of Articles bypasses that, so follow
+    it with ArticleSummary.backfill().
+
+    The summary also owns the comment count.  Comment posts update it
+    with add_comment() so they never re-put and re-index the Article;
+    Article.num_comments only seeds summaries of older articles.
+    """
+    KEY_NAME = 'summary'
+
+    permalink = db.StringProperty(required=True)
+    title = db.StringProperty(required=True)
+    article_type = db.StringProperty(required=True)
+    published = db.DateTimeProperty()
+    updated = db.DateTimeProperty()
+    num_comments = db.IntegerProperty(default=0)
+    tags = db.StringListProperty(default=[])
+    excerpt_html = db.TextProperty()
+
+    @classmethod
+    def key_for(cls, article_key):
+        return db.Key.from_path(cls.kind(), cls.KEY_NAME, parent=article_key)
+
+    @classmethod
+    def from_article(cls, article, existing=None):
+        num_comments = article.num_comments
+        if existing:
+            num_comments = existing.num_comments
+        return cls(key_name=cls.KEY_NAME, parent=article,
+                   permalink=article.permalink,
+                   title=article.title,
+                   article_type=article.article_type,
+                   published=article.published,
+                   updated=article.updated,
+                   num_comments=num_comments,
+                   tags=article.tags,
+                   excerpt_html=article.excerpt_html)
+
+    @classmethod
+    def put_for_articles(cls, articles):
+        """Rewrites the summaries of articles, keeping comment counts.
+
+        Like add_comment(), each summary is read and put in a transaction
+        on its article's entity group, so a comment counted meanwhile
+        isn't lost.
+        """
+        def txn(article):
+            summary = cls.get(cls.key_for(article.key()))
+            cls.from_article(article, summary).put()
+        for article in articles:
+            db.run_in_transaction(txn, article)
+
+    @classmethod
+    def add_comment(cls, article):
+        """Increments the comment count of article and returns it."""
+        def txn():
+            summary = cls.get(cls.key_for(article.key()))
+            if summary is None:
+                summary = cls.from_article(article)
+            summary.num_comments = (summary.num_comments or 0) + 1
+            summary.put()
+            return summary.num_comments
+        return db.run_in_transaction(txn)
+
+    @classmethod
+    def comment_count(cls, article):
+        summary = cls.get(cls.key_for(article.key()))
+        if summary is None:
+            return article.num_comments or 0
+        return summary.num_comments
+
+    @classmethod
+    def backfill(cls, start_key=None, batch_size=20):
+        """Rewrites the summaries for one batch of Articles.
+
+        Returns:
+          Tuple of (key to resume from or None when finished,
+                    number of articles scanned, number of summaries put)
+        """
+        articles, next_key = models.fetch_batch(Article, start_key, 
+                                                batch_size)
+        if articles:
+            cls.put_for_articles(articles)
+        return next_key, len(articles), len(articles)
+
+    @classmethod
+    def get_for_articles(cls, article_keys):
+        """Batch gets the summaries of the given Articles, in order."""
+        summaries = db.get([cls.key_for(key) for key in article_keys])
+        return [summary for summary in summaries if summary]
+
+    def article_key(self):
+        return self.parent_key()
+
+class ArchiveMonth(models.MemcachedModel):
+    """Keys of the articles published in one month, newest first.
+
+    Year and month pages read these instead of running date-range
+    queries, and the archive sidebar is built from the cached list()
+    of month counts.  Key names look like 'M2008-07'.
+    """
+    list_includes = ['year', 'month', 'count']
+    list_includes_properties = False
+
+    year = db.IntegerProperty(required=True)
+    month = db.IntegerProperty(required=True)
+    article_keys = db.ListProperty(db.Key, default=[])
+    # Parallel to article_keys so insertions can keep the order.
+    published = db.ListProperty(datetime.datetime, default=[])
+
+    def get_count(self):
+        return len(self.article_keys)
+    count = property(get_count)
+
+    @classmethod
+    def key_name_for(cls, year, month):
+        return 'M%04d-%02d' % (year, month)
+
+    @classmethod
+    def get_month(cls, year, month):
+        return cls.get_by_key_name(cls.key_name_for(year, month))
+
+    @classmethod
+    def get_year(cls, year):
+        """Returns the year's months that have articles, newest first."""
+        months = cls.get_by_key_name([cls.key_name_for(year, month)
+                                      for month in range(12, 0, -1)])
+        return [month for month in months if month]
+
+    @classmethod
+    def get_archive_years(cls):
+        """Returns a list of dicts for each year with articles, newest
+        first, with 'year', 'count' and a list of 'months' dicts."""
+        years = {}
+        for month in cls.list():
+            month['date'] = datetime.date(month['year'], month['month'], 1)
+            year = years.setdefault(month['year'],
+                                    {'year': month['year'], 'count': 0, 
+                                     'months': []})
+            year['count'] += month['count']
+            year['months'].append(month)
+        years = years.values()
+        years.sort(key=lambda year: year['year'], reverse=True)
+        for year in years:
+            year['months'].sort(key=lambda month: month['month'], 
+                                reverse=True)
+        return years
+
+    @classmethod
+    def add_article(cls, article):
+        """Adds or repositions an article in its month.  Idempotent."""
+        key_name = cls.key_name_for(article.published.year,
+                                    article.published.month)
+        article_key = article.key()
+        def txn():
+            month = cls.get_by_key_name(key_name)
+            if month is None:
+                month = cls(key_name=key_name, 
+                            year=article.published.year,
+                            month=article.published.month)
+            if article_key in month.article_keys:
+                i = month.article_keys.index(article_key)
+                del month.article_keys[i]
+                del month.published[i]
+            i = 0
+            while i < len(month.published) and \
+                  month.published[i] >= article.published:
+                i += 1
+            month.article_keys.insert(i, article_key)
+            month.published.insert(i, article.published)
+            month.put()
+        db.run_in_transaction(txn)
+
+    @classmethod
+    def remove_article(cls, article):
+        key_name = cls.key_name_for(article.published.year,
+                                    article.published.month)
+        article_key = article.key()
+        def txn():
+            month = cls.get_by_key_name(key_name)
+            if month and article_key in month.article_keys:
+                i = month.article_keys.index(article_key)
+                del month.article_keys[i]
+                del month.published[i]
+                if month.article_keys:
+                    month.put()
+                else:
+                    month.delete()
+        db.run_in_transaction(txn)
+
+    @classmethod
+    def backfill(cls, start_key=None, batch_size=20):
+        """Adds one batch of existing Articles to the archive.
+
+        Returns:
+          Tuple of (key to resume from or None when finished,
+                    number of articles scanned, number of articles added)
         """
-        import re
-        return re.sub('&(?!amp;)', '&amp;', self.html)
+        articles, next_key = models.fetch_batch(Article, start_key, 
+                                                batch_size)
+        for article in articles:
+            cls.add_article(article)
+        return next_key, len(articles), len(articles)
+
+class SitemapChunk(models.MemcachedModel):
+    """Sitemap entries for a fixed-size block of articles.
+
+    New articles are appended to the last chunk, so the sitemap grows
+    without touching earlier chunks, and an edit only rewrites the one
+    chunk holding that article.  Entries are pickled (article key string,
+    permalink, updated) tuples so chunks never load Articles.  Key names
+    look like 'C0', 'C1', ...
+    """
+    SIZE = 500
+    list_includes = ['number', 'lastmod']
+    list_includes_properties = False
+
+    number = db.IntegerProperty(required=True)
+    # Lets us find the chunk holding an article.
+    article_keys = db.ListProperty(db.Key, default=[])
+    entries_blob = db.BlobProperty()
+    updated = db.DateTimeProperty()
+
+    def get_entries(self):
+        import pickle
+        if not self.entries_blob:
+            return []
+        return pickle.loads(self.entries_blob)
+
+    def set_entries(self, entries):
+        import pickle
+        self.entries_blob = pickle.dumps(entries)
+        self.article_keys = [db.Key(entry[0]) for entry in entries]
+        if entries:
+            self.updated = max([entry[2] for entry in entries])
+
+    def get_lastmod(self):
+        if self.updated:
+            return self.updated.strftime('%Y-%m-%dT%H:%M:%SZ')
+        return ''
+    lastmod = property(get_lastmod)
+
+    def get_urls(self):
+        "Returns dicts with 'loc' and 'lastmod' for the sitemap template"
+        return [{'loc': config.BLOG['root_url'] + '/' + permalink,
+                 'lastmod': updated.strftime('%Y-%m-%dT%H:%M:%SZ')}
+                for key, permalink, updated in self.get_entries()]
+
+    @classmethod
+    def key_name_for(cls, number):
+        return 'C%d' % number
+
+    @classmethod
+    def find_chunk(cls, article_key):
+        return db.Query(cls).filter('article_keys =', article_key).get()
+
+    @classmethod
+    def update_article(cls, article):
+        """Adds or updates an article's entry.  A chunk is only written
+        if the article's permalink or updated time changed."""
+        entry = (str(article.key()), article.permalink, article.updated)
+        chunk = cls.find_chunk(article.key())
+        if chunk:
+            key_name = chunk.key().name()
+        else:
+            last = db.Query(cls).order('-number').get()
+            number = last and last.number or 0
+            if last and len(last.article_keys) >= cls.SIZE:
+                number += 1
+            key_name = cls.key_name_for(number)
+        def txn():
+            chunk = cls.get_by_key_name(key_name)
+            if chunk is None:
+                chunk = cls(key_name=key_name, 
+                            number=int(key_name[1:]))
+            entries = chunk.get_entries()
+            if entry in entries:
+                return
+            entries = [old for old in entries if old[0] != entry[0]]
+            entries.append(entry)
+            chunk.set_entries(entries)
+            chunk.put()
+        db.run_in_transaction(txn)
+
+    @classmethod
+    def remove_article(cls, article):
+        chunk = cls.find_chunk(article.key())
+        if chunk:
+            key_name = chunk.key().name()
+            article_key = str(article.key())
+            def txn():
+                chunk = cls.get_by_key_name(key_name)
+                chunk.set_entries([entry for entry in chunk.get_entries()
+                                   if entry[0] != article_key])
+                chunk.put()
+            db.run_in_transaction(txn)
+
+    @classmethod
+    def backfill(cls, start_key=None, batch_size=20):
+        """Adds sitemap entries for one batch of existing Articles.
+
+        Returns:
+          Tuple of (key to resume from or None when finished,
+                    number of articles scanned, number of articles added)
+        """
+        articles, next_key = models.fetch_batch(Article, start_key, 
+                                                batch_size)
+        for article in articles:
+            cls.update_article(article)
+        return next_key, len(articles), len(articles)
+
+class AtomFeed(db.Model):
+    """A prebuilt Atom feed document and the entries it's built from.
+
+    Entries are kept as pickled (article key string, published, updated,
+    rendered <entry> xml) tuples, newest first, so publishing, editing
+    or deleting an article splices one entry instead of re-rendering
+    the feed.  The head feed uses key name 'head'.
+    """
+    HEAD_SIZE = 10
+
+    entries_blob = db.BlobProperty()
+    document = db.TextProperty()
+
+    def get_entries(self):
+        import pickle
+        if not self.entries_blob:
+            return []
+        return pickle.loads(self.entries_blob)
+
+    def set_entries(self, entries):
+        import pickle
+        self.entries_blob = pickle.dumps(entries)
+
+    def splice(self, entry):
+        """Inserts or replaces an entry in published order and drops
+        entries past HEAD_SIZE.  Returns False if the entry is too old
+        to be in the feed."""
+        entries = [old for old in self.get_entries() if old[0] != entry[0]]
+        i = 0
+        while i < len(entries) and entries[i][1] >= entry[1]:
+            i += 1
+        if i >= self.HEAD_SIZE:
+            return False
+        entries.insert(i, entry)
+        self.set_entries(entries[:self.HEAD_SIZE])
+        return True
+
+    def remove(self, key_str):
+        """Removes an entry.  Returns False if it wasn't in the feed."""
+        entries = self.get_entries()
+        kept = [entry for entry in entries if entry[0] != key_str]
+        self.set_entries(kept)
+        return len(kept) != len(entries)
 
 class Comment(models.SerializableModel):
     """Stores comments and their position in comment threads.
@@ -167,7 +729,9 @@ class Comment(models.SerializableModel):
 
     def next_child_thread_string(self):
         'Returns thread string for next child of this comment'
-        return get_thread_string(self.article, self.thread + '.')
+        # Use the stored key so we don't fetch the parent article.
+        article_key = Comment.article.get_value_for_datastore(self)
+        return get_thread_string(article_key, self.thread + '.')
 
 
 class Tag(models.MemcachedModel):
@@ -194,4 +758,33 @@ class Tag(models.MemcachedModel):
     def get_name(self):
         return self.key().name()
     name = property(get_name)
+
+    @classmethod
+    def get_or_insert_many(cls, names):
+        """Returns keys for the named tags, creating any missing tags
+        with one batch get and one batch put.
+
+        The Tag.list() cache isn't cleared here.  Follow with
+        update_counts(), which clears it once for the whole write.
+        """
+        keys = [db.Key.from_path(cls.kind(), name) for name in names]
+        missing = [cls(key_name=key.name())
+                   for key, tag in zip(keys, db.get(keys)) if tag is None]
+        if missing:
+            db.put(missing)
+        return keys
+
+    @classmethod
+    def update_counts(cls, removed_keys=[], added_keys=[]):
+        """Adjusts the counters of tags removed from and added to an
+        article, then clears the Tag.list() cache."""
+        deltas = {}
+        for key in removed_keys:
+            name = 'Tag' + key.name()
+            deltas[name] = deltas.get(name, 0) - 1
+        for key in added_keys:
+            name = 'Tag' + key.name()
+            deltas[name] = deltas.get(name, 0) + 1
+        models.Counter.adjust_many(deltas)
+        memcache.delete(cls.memcache_key())
     
\ No newline at end of file
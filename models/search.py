@@ -22,19 +22,28 @@ Note: This code is slightly altered from google.appengine.ext.search.
   cloud.  
   
 Changes by Bill Katz on original:
-  - Brought Query out from SearchableModel and renamed it FullTextQuery 
-    due to issues with scoping (?) and online shell app.
   - Added unsearchable_properties class variable that lets you remove
     string-based properties from indexing.
-  - Don't index over code inside pre with name 'code'.
+  - Don't index code blocks or markup, with an opt-in 'code:' field for
+    identifiers in code.
+  - Keep a fingerprint of the indexed text so puts that don't change it
+    skip tokenization, and only changed properties are re-tokenized.
+  - Replaced the per-entity keyword list property and its datastore
+    queries with the inverted index in models.searchindex, which also
+    ranks results.
+  - Skip markup when tokenizing, stem words, and memoize the per-word
+    work.
 
 Defines a SearchableModel subclass of db.Model that supports full text
-indexing and search, based on the datastore's existing indexes.
+indexing and search.
 
-Don't expect too much. First, there's no ranking, which is a killer drawback.
-There's also no exact phrase match, substring match, boolean operators,
-stemming, or other common full text search features. Finally, support for stop
-words (common words that are not indexed) is currently limited to English.
+Don't expect too much. Ranking is available through
+models.searchindex.ranked_search(), which scores matches with BM25.
+Words are indexed by their Porter stems (see utils/stemmer.py), skipping
+html markup.  Queries support "phrases" (with positional_index), prefix*
+words and OR.  There's no substring match or other common full text
+search features. Finally, support for stop words (common
+words that are not indexed) is currently limited to English.
 
 To be indexed, entities must be created and saved as SearchableModel
 instances, e.g.:
@@ -46,62 +55,74 @@ instances, e.g.:
   article = Article(text=...)
   article.save()
 
-To search the full text index, use the SearchableModel.all() method to get an
-instance of SearchableModel.Query, which subclasses db.Query. Use its search()
-method to provide a search query, in addition to any other filters or sort
-orders, e.g.:
+To search the full text index, use the SearchableModel.search() method.
+It returns the keys of all matching entities, e.g.:
 
-  query = article.all().search('a search query').filter(...).order(...)
-  for result in query:
-    ...
-
-The full text index is stored in a property named __searchable_text_index.
+  keys = Article.search('a search query')
+  keys = Article.search('datastore OR memcache')
+  keys = Article.search('"app engine" memc*')
 
+Words of a query must all match, and OR separates alternatives.
 
-In general, if you just want to provide full text search, you *don't* need to
-add any extra indexes to your index.yaml. However, if you want to use search()
-in a query *in addition to* an ancestor, filter, or sort order, you'll need to
-create an index in index.yaml with the __searchable_text_index property. For
-example:
-
-  - kind: Article
-    properties:
-    - name: __searchable_text_index
-    - name: date
-      direction: desc
-    ...
+Each indexed word keeps a posting list of the ids of entities that
+contain it, so searchable entities must have ids rather than key names.
+Since no index rows are stored with the entity, no index.yaml entries
+are needed.
 
-Note that using SearchableModel will noticeable increase the latency of save()
-operations, since it writes an index row for each indexable word. This also
-means that the latency of save() will increase roughly with the size of the
-properties in a given entity. Caveat hacker!
+Note that using SearchableModel increases the latency of save()
+operations whose searchable text changed, since posting lists of the
+changed words are rewritten. Caveat hacker!
 """
 
 import logging
+import md5
 import re
 import string
 import sys
 
 from google.appengine.api import datastore
-from google.appengine.api import datastore_errors
 from google.appengine.api import datastore_types
+from google.appengine.api import memcache
 from google.appengine.ext import db
-from google.appengine.datastore import datastore_pb
+
+from utils import stemmer
+
+# Counts of full text index work done by this instance since it started.
+#   puts: searchable entities written
+#   skipped: puts whose searchable text hadn't changed
+#   tokenized: properties tokenized
+#   reused: properties whose tokens came from the token cache
+#   dropped_terms: indexable words found only in code blocks and markup,
+#     so left out of the index
+INDEX_STATS = {'puts': 0, 'skipped': 0, 'tokenized': 0, 'reused': 0,
+               'dropped_terms': 0}
 
 class SearchableEntity(datastore.Entity):
   """A subclass of datastore.Entity that supports full text indexing.
 
-  Automatically indexes all string and Text properties, using the datastore's
-  built-in per-property indices. To search, use the SearchableQuery class and
-  its Search() method.
+  Automatically tokenizes all string and Text properties.  The words are
+  indexed by SearchableModel.put() in models.searchindex.
   """
   # Note that AppEngine servers will cache all imported modules including
   # the interior of a class definition.  So the following _FULL_TEXT_*
   # properties will be executed once and cached.
 
+  # Keyword list written by earlier versions.  It is removed from
+  # entities as they are reindexed.
   _FULL_TEXT_INDEX_PROPERTY = '__searchable_text_index'
 
+  # Holds the index version and a hash of each searchable property.
+  _FULL_TEXT_FINGERPRINT_PROPERTY = '__searchable_text_fingerprint'
+
+  # Bump when tokenizing changes so existing indexes are rebuilt.
+  _FULL_TEXT_INDEX_VERSION = 7
+
+  _TOKEN_MEMCACHE_PREFIX = 'SearchTokens'
+
   _FULL_TEXT_MIN_LENGTH = 4
+  # Longer words, like base64 data or long urls, aren't indexed, so a
+  # term always fits in the key name of its searchindex.TermPostings.
+  _FULL_TEXT_MAX_LENGTH = 64
 
   _FULL_TEXT_STOP_WORDS = frozenset([
    'a', 'about', 'according', 'accordingly', 'affected', 'affecting', 'after',
@@ -135,7 +156,49 @@ class SearchableEntity(datastore.Entity):
    'where', 'whether', 'which', 'while', 'who', 'whose', 'why', 'widely',
    'will', 'with', 'within', 'without', 'would', 'yet', 'you'])
 
-  _PUNCTUATION_REGEX = re.compile('[' + re.escape(string.punctuation) + ']')
+  # Part of the index version, so editing the stop words or word
+  # lengths marks existing indexes stale.
+  _FULL_TEXT_SETTINGS_HASH = md5.new(
+      ' '.join(sorted(_FULL_TEXT_STOP_WORDS)) +
+      ' %d %d' % (_FULL_TEXT_MIN_LENGTH, _FULL_TEXT_MAX_LENGTH)
+      ).hexdigest()[:8]
+
+  # Code blocks are kept out of the prose index.  Inline code stays in
+  # the prose, since it's usually a word of a sentence.
+  _CODE_BLOCK_REGEX = re.compile(r'<(pre|script|style)\b[^>]*>(.*?)'
+                                 r'</\1\s*>', re.DOTALL)
+  _INLINE_CODE_REGEX = re.compile(r'<code\b[^>]*>(.*?)</code\s*>', re.DOTALL)
+  _CODE_WORD_REGEX = re.compile(r'[a-z_][a-z0-9_]*')
+  _CODE_MIN_LENGTH = 3
+  _CODE_TERM_PREFIX = 'code:'
+
+  # Captured, so that split() returns the markup between the text.
+  _MARKUP_REGEX = re.compile(r'(<(?:!--.*?--|[/!?]?[a-z][^>]*)>|&#?\w+;)',
+                             re.DOTALL)
+  # Text is split as utf-8, lowercasing ascii and turning punctuation
+  # into spaces with str methods, which are several times faster than
+  # their unicode counterparts and a regex.  Every byte of a multibyte
+  # utf-8 character is above 0x7f, so only ascii is touched.  Other
+  # letters are lowercased once per distinct word, by _Stems.
+  _PUNCTUATION_TABLE = string.maketrans(string.punctuation,
+                                        ' ' * len(string.punctuation))
+
+  # For the plain text kept for result snippets.
+  _PLAIN_CODE_BLOCK_REGEX = re.compile(_CODE_BLOCK_REGEX.pattern,
+                                       re.DOTALL | re.IGNORECASE)
+  _PLAIN_MARKUP_REGEX = re.compile(r'<!--.*?-->|<[/!?]?[a-z][^>]*>',
+                                   re.DOTALL | re.IGNORECASE)
+  _PLAIN_ENTITIES = [('&lt;', '<'), ('&gt;', '>'), ('&quot;', '"'),
+                     ('&#39;', "'"), ('&nbsp;', ' '), ('&amp;', '&')]
+  _WORD_REGEX = re.compile(r'[^\s%s]+' % re.escape(string.punctuation),
+                           re.UNICODE)
+
+  # Memoizes word -> stem, or '' for words that aren't indexed, since
+  # blog text reuses a small vocabulary.  Words are utf-8.
+  _FULL_TEXT_TERMS = {}
+  # Memoizes word -> whether it is indexed, for counting dropped words.
+  _FULL_TEXT_INDEXABLE = {}
+  _FULL_TEXT_MAX_TERMS = 100000
 
   def __init__(self, kind_or_entity, *args, **kwargs):
     """Constructor. May be called as a copy constructor.
@@ -158,35 +221,144 @@ class SearchableEntity(datastore.Entity):
       super(SearchableEntity, self).__init__(kind_or_entity, *args, **kwargs)
 
   def _ToPb(self):
-    """Rebuilds the full text index, then delegates to the superclass.
+    """Tokenizes changed text for the index, then delegates to the
+    superclass.
+
+    If no searchable property changed since the index was built, the
+    index is kept as is.  Otherwise tokens of each property are looked
+    up in memcache by the property's hash, and only properties that
+    miss are tokenized.
 
     Returns:
       entity_pb.Entity
     """
+    INDEX_STATS['puts'] += 1
+    searchable = self._SearchableValues()
+    fingerprints = SearchableEntity._Fingerprints(searchable)
+    version = self._IndexVersion()
+    if self._IndexIsCurrent(fingerprints):
+      INDEX_STATS['skipped'] += 1
+      self._indexed_terms = None
+      return super(SearchableEntity, self)._ToPb()
+
     if SearchableEntity._FULL_TEXT_INDEX_PROPERTY in self:
       del self[SearchableEntity._FULL_TEXT_INDEX_PROPERTY]
 
-    index = set()
-    searchable = lambda (name, value): name not in self.unsearchable_properties
-    for (name, values) in filter(searchable, self.items()):
+    cache_keys = {}
+    for name, fingerprint in fingerprints.iteritems():
+      cache_keys[name] = SearchableEntity._TokenMemcacheKey(version,
+                                                            fingerprint)
+    cached = memcache.get_multi(cache_keys.values())
+    include_code = getattr(self, 'searchable_code', False)
+    positional = getattr(self, 'positional_index', False)
+    surface = getattr(self, 'suggestions', False)
+    tokenized = {}
+    results = []
+    for (name, values) in searchable.iteritems():
+      tokens = cached.get(cache_keys[name])
+      if not SearchableEntity._HasTokens(tokens, positional, surface):
+        tokens = SearchableEntity._TokenizeValues(values, include_code,
+                                                  positional, surface)
+        tokenized[cache_keys[name]] = tokens
+        INDEX_STATS['tokenized'] += 1
+        INDEX_STATS['dropped_terms'] += tokens[1]
+      else:
+        INDEX_STATS['reused'] += 1
+      results.append(tokens)
+    if tokenized:
+      memcache.set_multi(tokenized)
+    # Read by SearchableModel.put() to update the index, so each value
+    # is tokenized once per put.
+    (self._indexed_terms, self._dropped_terms, self._phrase_tokens,
+     self._surface_words) = SearchableEntity._JoinTokens(results,
+                                                         positional,
+                                                         surface)
+
+    self[SearchableEntity._FULL_TEXT_FINGERPRINT_PROPERTY] = \
+        SearchableEntity._FormatFingerprint(version, fingerprints)
+
+    return super(SearchableEntity, self)._ToPb()
+
+  def _SearchableValues(self):
+    """Returns a dict of property name -> list of strings to index."""
+    unsearchable = getattr(self, 'unsearchable_properties', [])
+    searchable = {}
+    for (name, values) in self.items():
+      if name.startswith('__searchable') or name in unsearchable:
+        continue
       if not isinstance(values, list):
         values = [values]
-      if (isinstance(values[0], basestring) and
+      if (values and isinstance(values[0], basestring) and
           not isinstance(values[0], datastore_types.Blob)):
-        for value in values:
-          index.update(SearchableEntity._FullTextIndex(value))
-
-    index_list = list(index)
-    if index_list:
-      self[SearchableEntity._FULL_TEXT_INDEX_PROPERTY] = index_list
+        searchable[name] = values
+    return searchable
+
+  @staticmethod
+  def _Fingerprints(searchable):
+    """Returns a dict of property name -> hash of its values."""
+    fingerprints = {}
+    for name, values in searchable.iteritems():
+      fingerprints[name] = SearchableEntity._Fingerprint(values)
+    return fingerprints
+
+  def _IndexIsCurrent(self, fingerprints):
+    """Returns True if the stored index was built by this index version
+    from values with the given fingerprints."""
+    version, old_fingerprints = SearchableEntity._ParseFingerprint(
+        self.get(SearchableEntity._FULL_TEXT_FINGERPRINT_PROPERTY))
+    return version == self._IndexVersion() and \
+           old_fingerprints == fingerprints
+
+  @staticmethod
+  def _Fingerprint(values):
+    """Returns a hash of a property's list of string values."""
+    digest = md5.new()
+    for value in values:
+      if isinstance(value, unicode):
+        value = value.encode('utf-8')
+      digest.update(value)
+      digest.update('\x00')
+    return digest.hexdigest()
+
+  def _IndexVersion(self):
+    """Returns the tokenizer version and options the index is built with."""
+    version = 'v%d.%s' % (SearchableEntity._FULL_TEXT_INDEX_VERSION,
+                          SearchableEntity._FULL_TEXT_SETTINGS_HASH)
+    if getattr(self, 'searchable_code', False):
+      version += '+code'
+    return version
+
+  @staticmethod
+  def _FormatFingerprint(version, fingerprints):
+    parts = [version]
+    for name in sorted(fingerprints):
+      parts.append('%s:%s' % (name, fingerprints[name]))
+    return datastore_types.Text(' '.join(parts))
+
+  @staticmethod
+  def _ParseFingerprint(text):
+    """Returns (index version string, dict of property name -> hash).
+
+    Entities indexed before fingerprints were kept return (None, None).
+    """
+    if not text:
+      return None, None
+    parts = text.split()
+    fingerprints = {}
+    for part in parts[1:]:
+      name, fingerprint = part.rsplit(':', 1)
+      fingerprints[name] = fingerprint
+    return parts[0], fingerprints
 
-    return super(SearchableEntity, self)._ToPb()
+  @classmethod
+  def _TokenMemcacheKey(cls, version, fingerprint):
+    return '%s%s_%s' % (cls._TOKEN_MEMCACHE_PREFIX, version, fingerprint)
 
   @classmethod
   def _FullTextIndex(cls, text):
     """Returns a set of keywords appropriate for full text indexing.
 
-    See SearchableQuery.Search() for details.
+    See _FullTextTerms() for details.
 
     Args:
       text: string
@@ -194,128 +366,382 @@ class SearchableEntity(datastore.Entity):
     Returns:
       set of strings
     """
+    return set(cls._FullTextTerms(text))
 
-    if text:
-      datastore_types.ValidateString(text, 'text', max_len=sys.maxint)
-      # TODO -- Remove embedded code blogs marked by 'pre' tags
-      # and name="code"
-      text = cls._PUNCTUATION_REGEX.sub(' ', text)
-      words = text.lower().split()
+  @classmethod
+  def _FullTextTerms(cls, text, include_code=False):
+    """Returns the stems of indexable words of text in order, with repeats.
 
-      words = set(words)
+    Only prose is indexed.  Code blocks (pre, script and style elements)
+    are dropped.  If include_code is set, identifiers in code blocks and
+    inline code elements are also indexed unstemmed as 'code:' terms.
+    Other markup is skipped.  Words shorter than _FULL_TEXT_MIN_LENGTH
+    or longer than _FULL_TEXT_MAX_LENGTH and stop words are dropped
+    before stemming.  Queries go through the same function, so 'cached'
+    finds 'caching'.
 
-      words -= cls._FULL_TEXT_STOP_WORDS
-      for word in list(words):
-        if len(word) < cls._FULL_TEXT_MIN_LENGTH:
-          words.remove(word)
+    Args:
+      text: string
+      include_code: whether to index identifiers in code
 
-    else:
-      words = set()
+    Returns:
+      list of strings
+    """
+    return cls._Tokenize(text, include_code)[0]
 
-    return words
+  @classmethod
+  def _Tokenize(cls, text, include_code=False):
+    """Returns (_FullTextTerms(text, include_code), number of distinct
+    indexable words that only the code blocks and markup of text
+    held)."""
+    words, stems, code_terms, dropped = cls._Analyze(text, include_code)
+    return filter(None, stems) + code_terms, dropped
 
+  @classmethod
+  def _Analyze(cls, text, include_code=False):
+    """Returns (prose words of text, their stems or '' for words that
+    aren't indexed, list of code terms, number of distinct indexable
+    words that only the code blocks and markup of text held)."""
+    words, code_terms, removed_words = cls._SplitWords(text, include_code)
+    stems = cls._StemList(words)
+    dropped = 0
+    if removed_words:
+      dropped = cls._CountIndexable(set(removed_words).difference(words))
+    return words, stems, code_terms, dropped
 
-class SearchableQuery(datastore.Query):
-  """A subclass of datastore.Query that supports full text search.
+  @classmethod
+  def _SplitWords(cls, text, include_code=False):
+    """Returns (utf-8 words of the prose of text, lowercased in ascii,
+    list of code terms, words of the code blocks and markup left out)."""
+    if not text:
+      return [], [], []
+    datastore_types.ValidateString(text, 'text', max_len=sys.maxint)
+    if isinstance(text, unicode):
+      text = text.encode('utf-8')
+    text = text.lower()
+    code_terms = []
+    removed = []
+    if '<' in text or '&' in text:
+      if '<' in text:
+        text, code_terms, removed = cls._SplitCode(text, include_code)
+      pieces = cls._MARKUP_REGEX.split(text)
+      text = ' '.join(pieces[::2])
+      removed += pieces[1::2]
+    words = text.translate(cls._PUNCTUATION_TABLE).split()
+    removed_words = ' '.join(removed).translate(cls._PUNCTUATION_TABLE).split()
+    return words, code_terms, removed_words
 
-  Only searches over entities that were created and stored using the
-  SearchableEntity or SearchableModel classes.
-  """
+  @classmethod
+  def _PhraseTokens(cls, text):
+    """Returns the words of the prose of text in order, stemmed if they
+    are indexed and as they are otherwise.
 
-  def Search(self, search_query):
-    """Add a search query. This may be combined with filters.
+    Phrases are matched on these, so their short and stop words count.
+    """
+    words = cls._SplitWords(text)[0]
+    return cls._PhraseTokensOf(words, cls._StemList(words))
 
-    Note that keywords in the search query will be silently dropped if they
-    are stop words or too short, ie if they wouldn't be indexed.
+  @staticmethod
+  def _PhraseTokensOf(words, stems):
+    return [stem or word.decode('utf-8').lower()
+            for word, stem in zip(words, stems)]
 
-    Args:
-     search_query: string
-
-    Returns:
-      # this query
-      SearchableQuery
+  @classmethod
+  def _TokenizeValues(cls, values, include_code=False, positional=False,
+                      surface=False):
+    """Returns (terms, number of dropped words, phrase tokens, dict of
+    term -> surface word) of a property's values.
+
+    The phrase tokens, with None between values so a phrase can't span
+    two of them, are only collected if positional is set, and the
+    surface words, the first prose word indexed as each term, only if
+    surface is set.  Otherwise they are None.
     """
-    datastore_types.ValidateString(search_query, 'search query')
-    self._search_query = search_query
-    return self
+    terms = []
+    dropped = 0
+    tokens = None
+    if positional:
+      tokens = []
+    surface_words = None
+    if surface:
+      surface_words = {}
+    for value in values:
+      words, stems, code_terms, value_dropped = cls._Analyze(value,
+                                                             include_code)
+      terms += filter(None, stems)
+      terms += code_terms
+      dropped += value_dropped
+      if positional:
+        if tokens:
+          tokens.append(None)
+        tokens += cls._PhraseTokensOf(words, stems)
+      if surface:
+        for word, stem in zip(words, stems):
+          if stem and stem not in surface_words:
+            surface_words[stem] = word.decode('utf-8').lower()
+    return terms, dropped, tokens, surface_words
+
+  @staticmethod
+  def _HasTokens(tokens, positional, surface):
+    """Returns True if cached _TokenizeValues() results hold what an
+    entity with these options indexes."""
+    return (tokens is not None and len(tokens) == 4 and
+            not (positional and tokens[2] is None) and
+            not (surface and tokens[3] is None))
+
+  @staticmethod
+  def _JoinTokens(results, positional, surface):
+    """Returns (terms, number of dropped words, phrase tokens, surface
+    words) of all properties from their _TokenizeValues() results."""
+    terms = []
+    dropped = 0
+    tokens = None
+    if positional:
+      tokens = []
+    surface_words = None
+    if surface:
+      surface_words = {}
+    for result in results:
+      terms += result[0]
+      dropped += result[1]
+      if positional:
+        if tokens and result[2]:
+          tokens.append(None)
+        tokens += result[2]
+      if surface:
+        for stem, word in result[3].iteritems():
+          surface_words.setdefault(stem, word)
+    return terms, dropped, tokens, surface_words
 
-  def _ToPb(self, limit=None, offset=None):
-    """Adds filters for the search query, then delegates to the superclass.
+  @classmethod
+  def _StemList(cls, words):
+    """Returns the stems of words, or '' for words that aren't indexed,
+    in order."""
+    # The memo almost always holds every word, so the usual cost is one
+    # map() of dict lookups, and only a miss checks for new words.
+    try:
+      return map(cls._FULL_TEXT_TERMS.__getitem__, words)
+    except KeyError:
+      return map(cls._Stems(words).__getitem__, words)
 
-    Raises BadFilterError if a filter on the index property already exists.
+  @classmethod
+  def _Stems(cls, words):
+    """Returns a dict of word -> stem, or '' for words that aren't
+    indexed, holding at least the given words."""
+    stems = cls._FULL_TEXT_TERMS
+    new_words = set(words).difference(stems)
+    if len(stems) + len(new_words) > cls._FULL_TEXT_MAX_TERMS:
+      stems.clear()
+      new_words = set(words)
+    for word in new_words:
+      text = cls._IndexableText(word)
+      stems[word] = text and stemmer.stem(text)
+    return stems
 
-    Args:
-      # an upper bound on the number of results returned by the query.
-      limit: int
-      # number of results that match the query to skip.  limit is applied
-      # after the offset is fulfilled.
-      offset: int
+  @classmethod
+  def _CountIndexable(cls, words):
+    """Returns how many of words would be indexed.
 
-    Returns:
-      datastore_pb.Query
+    Only counted for stats, so markup and code words are checked, but
+    not stemmed, and the checks are memoized apart from the stems.
     """
-    if SearchableEntity._FULL_TEXT_INDEX_PROPERTY in self:
-      raise datastore_errors.BadFilterError(
-        '%s is a reserved name.' % SearchableEntity._FULL_TEXT_INDEX_PROPERTY)
+    indexable = cls._FULL_TEXT_INDEXABLE
+    try:
+      return len(filter(None, map(indexable.__getitem__, words)))
+    except KeyError:
+      new_words = set(words).difference(indexable)
+      if len(indexable) + len(new_words) > cls._FULL_TEXT_MAX_TERMS:
+        indexable.clear()
+        new_words = set(words)
+      for word in new_words:
+        indexable[word] = bool(cls._IndexableText(word))
+      return len(filter(None, map(indexable.__getitem__, words)))
 
-    pb = super(SearchableQuery, self)._ToPb(limit=limit, offset=offset)
+  @classmethod
+  def _IndexableText(cls, word):
+    """Returns word as lowercase unicode if it is indexed, or u''."""
+    if isinstance(word, str):
+      word = word.decode('utf-8').lower()
+    if (cls._FULL_TEXT_MIN_LENGTH <= len(word) <=
+        cls._FULL_TEXT_MAX_LENGTH and
+        word not in cls._FULL_TEXT_STOP_WORDS):
+      return word
+    return u''
 
-    if hasattr(self, '_search_query'):
-      keywords = SearchableEntity._FullTextIndex(self._search_query)
-      for keyword in keywords:
-        filter = pb.add_filter()
-        filter.set_op(datastore_pb.Query_Filter.EQUAL)
-        prop = filter.add_property()
-        prop.set_name(SearchableEntity._FULL_TEXT_INDEX_PROPERTY)
-        prop.mutable_value().set_stringvalue(keyword)
+  @classmethod
+  def _SplitCode(cls, text, include_code):
+    """Returns (text without code blocks, list of code terms, list of
+    the removed blocks with their tags)."""
+    blocks = []
+    removed = []
+    def remove_block(match):
+      blocks.append(match.group(2))
+      removed.append(match.group())
+      return ' '
+    text = cls._CODE_BLOCK_REGEX.sub(remove_block, text)
+    code_terms = []
+    if include_code:
+      for code in blocks + cls._INLINE_CODE_REGEX.findall(text):
+        code_terms += [cls._CODE_TERM_PREFIX + word for word
+                       in cls._CODE_WORD_REGEX.findall(code)
+                       if cls._CODE_MIN_LENGTH <= len(word) <=
+                          cls._FULL_TEXT_MAX_LENGTH]
+    return text, code_terms, removed
 
-    return pb
+  @classmethod
+  def _PlainText(cls, html):
+    """Returns the prose of html as plain text, without code blocks."""
+    text = cls._PLAIN_CODE_BLOCK_REGEX.sub(' ', html or '')
+    text = cls._PLAIN_MARKUP_REGEX.sub(' ', text)
+    for entity, char in cls._PLAIN_ENTITIES:
+      text = text.replace(entity, char)
+    return ' '.join(text.split())
 
-class FullTextQuery(db.Query):
-  """A subclass of db.Query that supports full text search."""
-  _search_query = None
+  @classmethod
+  def _TermOffsets(cls, text):
+    """Returns a dict of term -> sorted offsets of its words in plain
+    text, using the same terms as _FullTextTerms()."""
+    offsets = {}
+    terms = cls._FULL_TEXT_TERMS
+    for match in cls._WORD_REGEX.finditer(text):
+      word = match.group().lower()
+      if word not in terms:
+        terms = cls._Stems([word])
+      term = terms.get(word)
+      if term:
+        offsets.setdefault(term, []).append(match.start())
+    return offsets
 
-  def search(self, search_query):
-    """Adds a full text search to this query.
+  @classmethod
+  def _WordEnd(cls, text, offset):
+    """Returns the end of the word starting at offset in plain text."""
+    return cls._WORD_REGEX.match(text, offset).end()
 
-    Args:
-      search_query, a string containing the full text search query.
+  def _IndexedTerms(self):
+    """Returns (indexable words of all searchable properties, number of
+    words dropped with their code blocks and markup, phrase tokens or
+    None, dict of term -> surface word or None), as _ToPb() finds them.
 
-    Returns:
-      self
+    Surface words are the forms suggest() offers instead of the stems.
     """
-    self._search_query = search_query
-    return self
+    include_code = getattr(self, 'searchable_code', False)
+    positional = getattr(self, 'positional_index', False)
+    surface = getattr(self, 'suggestions', False)
+    results = [SearchableEntity._TokenizeValues(values, include_code,
+                                                positional, surface)
+               for values in self._SearchableValues().itervalues()]
+    return SearchableEntity._JoinTokens(results, positional, surface)
 
-  def _get_query(self):
-    """Wraps db.Query._get_query() and injects SearchableQuery."""
-    query = db.Query._get_query(self, _query_class=SearchableQuery)
-    if self._search_query:
-      query.Search(self._search_query)
-    return query
 
 import models
+from models import searchindex
 
 class SearchableModel(models.SerializableModel):
   """A subclass of db.Model that supports full text search and indexing.
 
-  Automatically indexes all string-based properties. To search, use the all()
-  method to get a FullTextQuery, then use its search() method.
+  Automatically indexes all string-based properties. To search, use the
+  search() class method.
   
   Looks for a class variable, unsearchable_properties, and if set, removes
   indexing on those properties.  Note that only properties with string
   base types are indexed in any case.
+
+  Code blocks in indexed text are left out unless the class variable
+  searchable_code is set.  Their identifiers are then searchable with
+  'code:name' query words.
+
+  Set positional_index to store the positions of all words, so quoted
+  phrases in queries are matched word for word.
+
+  Set suggestions to complete search prefixes with suggest(), from the
+  indexed terms and the values returned by suggestion().
+
+  Set snippet_property to the name of an html property to keep its
+  plain text and term offsets for searchindex.snippets().
+
+  Set sort_property to the name of a property to keep its values for
+  ordering matches with searchindex.sorted_search().
   """
   unsearchable_properties = []
+  searchable_code = False
+  positional_index = False
+  suggestions = False
+  snippet_property = None
+  sort_property = None
 
   def _populate_internal_entity(self):
     """Wraps db.Model._populate_internal_entity() and injects
     SearchableEntity."""
-    entity = db.Model._populate_internal_entity(self,
+    entity = super(SearchableModel, self)._populate_internal_entity(
                                             _entity_class=SearchableEntity)
     entity.unsearchable_properties = self.__class__.unsearchable_properties
+    entity.searchable_code = self.__class__.searchable_code
+    entity.positional_index = self.__class__.positional_index
+    entity.suggestions = self.__class__.suggestions
     return entity
 
+  def put(self):
+    """Wraps db.Model.put() and updates the index if the searchable
+    text changed."""
+    key = super(SearchableModel, self).put()
+    terms = getattr(self._entity, '_indexed_terms', None)
+    if terms is not None:
+      searchindex.update_document(self, terms, self._entity._dropped_terms,
+                                  positions=self._entity._phrase_tokens,
+                                  words=self._entity._surface_words)
+    if self.sort_property:
+      searchindex.update_sort_value(self.kind(), self.key().id(),
+                                    getattr(self, self.sort_property))
+    searchindex.bump_generation(self.kind())
+    if terms is not None and self.suggestions:
+      searchindex.refresh_dictionary(self.kind())
+    return key
+
+  def delete(self):
+    searchindex.remove_document(self)
+    super(SearchableModel, self).delete()
+    searchindex.bump_generation(self.kind())
+    if self.suggestions:
+      searchindex.refresh_dictionary(self.kind())
+
+  def suggestion(self):
+    """Returns a dict with a 'title' offered by suggest(), or None."""
+    return None
+
+  def index_is_stale(self):
+    """Returns True if put() would rebuild this entity's index, e.g.
+    after the tokenizer, stop words or unsearchable_properties changed."""
+    entity = self._populate_internal_entity()
+    return not entity._IndexIsCurrent(
+        SearchableEntity._Fingerprints(entity._SearchableValues()))
+
+  @classmethod
+  def reindex(cls, start_key=None, batch_size=20):
+    """Reindexes the stale entities of one batch in key order.
+
+    Only the index is updated; put() overrides of subclasses aren't
+    called.
+
+    Returns:
+      Tuple of (key to resume from or None when finished,
+                number of entities scanned, number reindexed)
+    """
+    entities, next_key = models.fetch_batch(cls, start_key, batch_size)
+    stale = [entity for entity in entities if entity.index_is_stale()]
+    for entity in stale:
+      db.Model.put(entity)
+      terms = getattr(entity._entity, '_indexed_terms', None)
+      if terms is not None:
+        searchindex.update_document(entity, terms,
+                                    entity._entity._dropped_terms,
+                                    positions=entity._entity._phrase_tokens,
+                                    words=entity._entity._surface_words)
+    if stale:
+      searchindex.bump_generation(cls.kind())
+      if cls.suggestions:
+        searchindex.refresh_dictionary(cls.kind())
+    return next_key, len(entities), len(stale)
+
   @classmethod
   def from_entity(cls, entity):
     """Wraps db.Model.from_entity() and injects SearchableEntity."""
@@ -324,6 +750,12 @@ class SearchableModel(models.SerializableModel):
     return super(SearchableModel, cls).from_entity(entity)
 
   @classmethod
-  def all(cls):
-    """Returns a FullTextQuery for this kind."""
-    return FullTextQuery(cls)
+  def search(cls, search_query):
+    """Returns keys of the entities matching search_query, by id."""
+    return searchindex.search_keys(cls, search_query)
+
+  @classmethod
+  def suggest(cls, prefix):
+    """Returns completions of prefix from the term dictionary held in
+    instance memory."""
+    return searchindex.suggest(cls, prefix)
@@ -0,0 +1,1270 @@
+# The MIT License
+# 
+# Copyright 2008 William T Katz
+# 
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+# 
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+# 
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+# THE SOFTWARE.
+
+"""Inverted index and relevance ranking for full-text search.
+
+SearchableModel.put() hands the terms it indexed to update_document(),
+which keeps:
+- TermPostings, the posting list and document frequency of one term of
+  a kind.  A posting list is the sorted ids of entities with the term,
+  stored as varint-encoded gaps, with the term's frequency in each.
+- SearchDocument, a child of each searchable entity with its term
+  frequencies and length.
+- SearchCorpus, one per kind, with the number of documents and their
+  total length.  It is the parent of the kind's TermPostings,
+  PrefixShards and DocumentLengths, so they are updated together in one
+  transaction.
+- DocumentLengths, the length of each document of a kind, so rank()
+  scores matches from the posting lists without getting documents.
+- PrefixShard, the sorted terms of a kind sharing their first
+  PREFIX_KEY_LENGTH characters, for expanding prefix queries like memc*.
+  It is only written when a term first appears or last disappears.
+- SortList, the values of sort_property of a kind's entities, for models
+  that set it, so sorted_search() orders matches without getting them.
+
+Entities of models with positional_index also store the positions of
+their words in SearchDocument, so "quoted phrases" are checked after
+posting lists are intersected.  Positions count every word of the
+prose, including stop words and short words, so a phrase matches word
+for word.  Each property is positioned apart, so phrases can't span
+two of them.
+
+Only the posting lists of terms whose frequency in an entity changed
+are rewritten, so a put costs the same however large the corpus grows.  Queries
+intersect sorted posting lists in memory, planned by plan() to start
+from the rarest term.  Terms too common to narrow the results only
+filter the matches of the rarer ones, by binary search, and
+ranked_search() scores the matches with BM25.
+
+Models with a snippet_property keep its plain text and the offsets of
+its terms in SearchDocument, from which snippets() cuts a window around
+the query's terms with the words highlighted.
+
+Result lists are cached in memcache by normalized query by cached_keys().
+Every put or delete of a searchable entity bumps its kind's generation,
+which invalidates them.
+
+Models with suggestions also keep a SuggestionList of their entities'
+suggestion() values and a SearchDictionary of the words the most common
+terms were written as, with their document frequencies.  adjust_corpus()
+updates the SearchDictionary with the posting lists.  suggest()
+completes prefixes from a TermDictionary held in instance memory, which
+refresh_dictionary() builds from those two entities when an entity is
+written and shares through memcache.  If memcache loses it, instances
+keep what they have, and only an instance without one reads the two
+entities back.
+
+Since a kind's index is one entity group, its updates are serialized,
+which is plenty for entities written by one admin at a time.  Entities
+written with db.put() bypass SearchableModel.put(), so follow those
+with backfill().
+"""
+
+import bisect
+import cgi
+import heapq
+import logging
+import math
+import md5
+import pickle
+import re
+import time
+import zlib
+
+from google.appengine.api import memcache
+from google.appengine.ext import db
+
+import models
+from utils import stemmer
+
+# Most entities in one datastore call.
+MAX_BATCH_SIZE = 500
+
+# Standard BM25 parameters.
+BM25_K1 = 1.2
+BM25_B = 0.75
+
+# Ranked results kept.
+MAX_RESULTS = 100
+# Most matches scored by rank() and checked for phrases, so a query of
+# common words costs the same however large the corpus grows.
+MAX_RANKED_DOCS = 2000
+MAX_PHRASE_DOCS = 500
+
+PREFIX_KEY_LENGTH = 2
+MIN_PREFIX_LENGTH = 3
+# Most terms a prefix query expands to, so its cost stays bounded.
+MAX_PREFIX_TERMS = 50
+
+# Most posting lists intersected for one part of a query.  The rarest
+# are used, since they narrow the results the most, and the rest only
+# filter them.
+MAX_QUERY_TERMS = 8
+# Terms in more than this share of documents hardly narrow a search, so
+# they only filter the matches of rarer terms once a kind has
+# MIN_PLANNED_DOCS.
+COMMON_TERM_RATIO = 0.5
+MIN_PLANNED_DOCS = 50
+
+# Characters of plain text shown around matches in a result snippet.
+SNIPPET_LENGTH = 200
+SNIPPET_LEAD = 40
+
+SUGGESTED_TERMS = 8
+SUGGESTED_TITLES = 5
+# Words kept in a SearchDictionary, the most common first, so it stays
+# well under the entity and memcache size limits.
+MAX_DICTIONARY_WORDS = 10000
+# Seconds an instance uses its term dictionary before checking memcache
+# for a newer one.
+DICTIONARY_CHECK_TIME = 10
+
+class SearchDocument(db.Model):
+    KEY_NAME = 'search'
+
+    length = db.IntegerProperty(default=0)
+    # Distinct indexable words left out because only code blocks and
+    # markup held them.
+    dropped_terms = db.IntegerProperty(default=0)
+    terms_blob = db.BlobProperty()
+    positions_blob = db.BlobProperty()
+    # Plain text of the model's snippet_property, with the offsets of
+    # its terms, for result snippets.
+    text = db.TextProperty()
+    offsets_blob = db.BlobProperty()
+
+    @classmethod
+    def key_for(cls, entity_key):
+        return db.Key.from_path(cls.kind(), cls.KEY_NAME, parent=entity_key)
+
+    def get_terms(self):
+        """Returns a dict of term -> frequency in the document."""
+        if not self.terms_blob:
+            return {}
+        return pickle.loads(self.terms_blob)
+
+    def set_terms(self, frequencies):
+        self.terms_blob = db.Blob(pickle.dumps(frequencies, 2))
+
+    def get_positions(self):
+        """Returns a dict of token -> encoded positions, or None if the
+        document has no positional index."""
+        if not self.positions_blob:
+            return None
+        return pickle.loads(self.positions_blob)
+
+    def set_positions(self, tokens):
+        """Stores the positions of phrase tokens, a list in document
+        order with None between properties."""
+        positions = {}
+        for position, token in enumerate(tokens):
+            if token is not None:
+                positions.setdefault(token, []).append(position)
+        for term in positions:
+            positions[term] = encode_postings(positions[term])
+        self.positions_blob = db.Blob(pickle.dumps(positions, 2))
+
+    def get_offsets(self):
+        """Returns a dict of term -> encoded offsets in text."""
+        if not self.offsets_blob:
+            return {}
+        return pickle.loads(self.offsets_blob)
+
+    def set_text(self, html):
+        """Stores the plain text of html and the offsets of its terms."""
+        from models import search
+        if not html:
+            self.text = self.offsets_blob = None
+            return
+        self.text = db.Text(search.SearchableEntity._PlainText(html))
+        offsets = search.SearchableEntity._TermOffsets(self.text)
+        for term in offsets:
+            offsets[term] = encode_postings(offsets[term])
+        self.offsets_blob = db.Blob(pickle.dumps(offsets, 2))
+
+class SearchCorpus(db.Model):
+    """Key name is the kind of the searchable entities."""
+    num_docs = db.IntegerProperty(default=0)
+    total_length = db.IntegerProperty(default=0)
+
+    def average_length(self):
+        if not self.num_docs:
+            return 0.0
+        return float(self.total_length) / self.num_docs
+
+def corpus_key_for(kind):
+    return db.Key.from_path(SearchCorpus.kind(), kind)
+
+class TermPostings(db.Model):
+    """Posting list of one term.  A child of the kind's SearchCorpus."""
+    df = db.IntegerProperty(default=0)
+    postings_blob = db.BlobProperty()
+    # Frequencies of the term, parallel to the ids.
+    frequencies_blob = db.BlobProperty()
+
+    @staticmethod
+    def key_name_for(term):
+        # Key names can't start with a digit.
+        return 't:' + term
+
+    @classmethod
+    def key_for(cls, kind, term):
+        return db.Key.from_path(cls.kind(), cls.key_name_for(term),
+                                parent=corpus_key_for(kind))
+
+    def get_ids(self):
+        """Returns the sorted ids of entities with the term."""
+        return decode_postings(self.postings_blob or '')
+
+    def get_frequencies(self, ids):
+        """Returns the frequencies of the term in ids, from get_ids()."""
+        if not self.frequencies_blob:
+            # Indexed before frequencies were stored.
+            return [1] * len(ids)
+        return decode_numbers(self.frequencies_blob)
+
+    def set_ids(self, ids, frequencies):
+        self.df = len(ids)
+        self.postings_blob = db.Blob(encode_postings(ids))
+        self.frequencies_blob = db.Blob(encode_numbers(frequencies))
+
+class DocumentLengths(db.Model):
+    """Lengths of the documents of a kind.  A child of the kind's
+    SearchCorpus with the key name 'lengths'."""
+    KEY_NAME = 'lengths'
+
+    lengths_blob = db.BlobProperty()
+
+    @classmethod
+    def key_for(cls, kind):
+        return db.Key.from_path(cls.kind(), cls.KEY_NAME,
+                                parent=corpus_key_for(kind))
+
+    def get_lengths(self):
+        """Returns a dict of id -> length."""
+        if not self.lengths_blob:
+            return {}
+        return pickle.loads(zlib.decompress(self.lengths_blob))
+
+    def set_lengths(self, lengths):
+        self.lengths_blob = db.Blob(zlib.compress(pickle.dumps(lengths, 2)))
+
+class PrefixShard(db.Model):
+    """Sorted terms with the same first PREFIX_KEY_LENGTH characters.  A
+    child of the kind's SearchCorpus."""
+    terms_blob = db.BlobProperty()
+
+    @staticmethod
+    def key_name_for(term):
+        return 'p:' + term[:PREFIX_KEY_LENGTH]
+
+    def get_terms(self):
+        """Returns the sorted list of terms."""
+        if not self.terms_blob:
+            return []
+        return pickle.loads(self.terms_blob)
+
+    def set_terms(self, terms):
+        self.terms_blob = db.Blob(pickle.dumps(terms, 2))
+
+class SuggestionList(db.Model):
+    """Key name is the kind.  Holds a pickled dict of id -> suggestion."""
+    suggestions_blob = db.BlobProperty()
+
+    def get_suggestions(self):
+        if not self.suggestions_blob:
+            return {}
+        return pickle.loads(self.suggestions_blob)
+
+    def set_suggestions(self, suggestions):
+        self.suggestions_blob = db.Blob(pickle.dumps(suggestions, 2))
+
+class SearchDictionary(db.Model):
+    """Words for the terms of a kind, for suggestions.  A child of the
+    kind's SearchCorpus with the key name 'dictionary'."""
+    KEY_NAME = 'dictionary'
+
+    entries_blob = db.BlobProperty()
+
+    @classmethod
+    def key_for(cls, kind):
+        return db.Key.from_path(cls.kind(), cls.KEY_NAME,
+                                parent=corpus_key_for(kind))
+
+    def get_entries(self):
+        """Returns a dict of term -> (word, document frequency)."""
+        if not self.entries_blob:
+            return {}
+        return pickle.loads(zlib.decompress(self.entries_blob))
+
+    def set_entries(self, entries):
+        if len(entries) > MAX_DICTIONARY_WORDS:
+            common = heapq.nlargest(MAX_DICTIONARY_WORDS, entries.iteritems(),
+                                    key=lambda item: item[1][1])
+            entries = dict(common)
+        self.entries_blob = db.Blob(zlib.compress(pickle.dumps(entries, 2)))
+
+class SortList(db.Model):
+    """Key name is the kind.  Holds a pickled dict of id -> value of the
+    kind's sort_property."""
+    values_blob = db.BlobProperty()
+
+    def get_values(self):
+        if not self.values_blob:
+            return {}
+        return pickle.loads(self.values_blob)
+
+    def set_values(self, values):
+        self.values_blob = db.Blob(pickle.dumps(values, 2))
+
+def batches(items):
+    """Yields slices of items small enough for one datastore call."""
+    for start in xrange(0, len(items), MAX_BATCH_SIZE):
+        yield items[start:start + MAX_BATCH_SIZE]
+
+def get_in_batches(keys):
+    entities = []
+    for batch in batches(keys):
+        entities += db.get(batch)
+    return entities
+
+def encode_numbers(numbers):
+    """Encodes numbers 7 bits per byte, high bit continues."""
+    chars = []
+    for number in numbers:
+        while number > 0x7f:
+            chars.append(chr(0x80 | (number & 0x7f)))
+            number >>= 7
+        chars.append(chr(number))
+    return ''.join(chars)
+
+def decode_numbers(encoded):
+    numbers = []
+    number = shift = 0
+    for char in encoded:
+        byte = ord(char)
+        number |= (byte & 0x7f) << shift
+        if byte & 0x80:
+            shift += 7
+        else:
+            numbers.append(number)
+            number = shift = 0
+    return numbers
+
+def encode_postings(ids):
+    """Encodes sorted ids as gaps with encode_numbers().
+
+    Also used for term positions, which may start at 0.
+    """
+    gaps = []
+    last = 0
+    for id in ids:
+        gaps.append(id - last)
+        last = id
+    return encode_numbers(gaps)
+
+def decode_postings(encoded):
+    ids = decode_numbers(encoded)
+    for i in xrange(1, len(ids)):
+        ids[i] += ids[i - 1]
+    return ids
+
+def intersect(lists):
+    """Returns the ids in all of the sorted lists, sorted.
+
+    The shortest list is walked first, so the work is bounded by the
+    rarest term.
+    """
+    if not lists:
+        return []
+    lists = sorted(lists, key=len)
+    result = lists[0]
+    for other in lists[1:]:
+        if not result:
+            break
+        # Walk the shorter list, binary searching the longer one.
+        matches = []
+        low = 0
+        for id in result:
+            low = bisect.bisect_left(other, id, low)
+            if low == len(other):
+                break
+            if other[low] == id:
+                matches.append(id)
+        result = matches
+    return result
+
+def union(lists):
+    ids = set()
+    for ids_list in lists:
+        ids.update(ids_list)
+    return sorted(ids)
+
+def term_frequencies(terms):
+    frequencies = {}
+    for term in terms:
+        frequencies[term] = frequencies.get(term, 0) + 1
+    return frequencies
+
+def get_document_frequencies(kind, terms):
+    """Returns a dict of term -> document frequency for the terms."""
+    terms = list(terms)
+    entities = get_in_batches([TermPostings.key_for(kind, term)
+                               for term in terms])
+    frequencies = {}
+    for term, term_postings in zip(terms, entities):
+        frequencies[term] = term_postings and term_postings.df or 0
+    return frequencies
+
+def get_postings(kind, terms):
+    """Returns (dict of term -> sorted ids of entities with the term,
+    number of documents of kind), with one batch get."""
+    terms = list(terms)
+    entities = get_in_batches([TermPostings.key_for(kind, term)
+                               for term in terms] + [corpus_key_for(kind)])
+    postings = {}
+    for term, term_postings in zip(terms, entities):
+        postings[term] = term_postings and term_postings.get_ids() or []
+    return postings, entities[-1] and entities[-1].num_docs or 0
+
+def adjust_corpus(kind, doc_id, docs_delta, length_delta, frequencies,
+                  length=None, rebuild=False, words=None):
+    """Adds doc_id to, updates it in or removes it from the posting
+    lists of terms.
+
+    Only the TermPostings of the terms are read and written, in one
+    transaction on the kind's SearchCorpus, so concurrent puts can't
+    lose each other's postings.
+
+    Args:
+      kind: kind of the searchable entity
+      doc_id: id of the searchable entity
+      docs_delta: change in number of documents
+      length_delta: change in total length of documents
+      frequencies: dict of term -> the document's new frequency of the
+        term, 0 if it lost it
+      length: new length of the document, or None if it was removed
+      rebuild: if True, also adds gained terms to the prefix shards
+      words: for models with suggestions, a dict of term -> word the
+        document wrote it as, and the SearchDictionary is updated too
+    """
+    corpus_key = corpus_key_for(kind)
+    terms = frequencies.keys()
+    keys = [corpus_key, DocumentLengths.key_for(kind)] + \
+           [TermPostings.key_for(kind, term) for term in terms]
+    if words is not None:
+        keys.append(SearchDictionary.key_for(kind))
+
+    def txn():
+        entities = get_in_batches(keys)
+        if words is not None:
+            dictionary = entities.pop() or SearchDictionary(
+                key_name=SearchDictionary.KEY_NAME, parent=corpus_key)
+            entries = dictionary.get_entries()
+        corpus = entities[0] or SearchCorpus(key_name=kind)
+        document_lengths = entities[1] or DocumentLengths(
+            key_name=DocumentLengths.KEY_NAME, parent=corpus_key)
+        lengths = document_lengths.get_lengths()
+        corpus.num_docs += docs_delta
+        corpus.total_length += length_delta
+        if length is None:
+            lengths.pop(doc_id, None)
+        else:
+            lengths[doc_id] = length
+        document_lengths.set_lengths(lengths)
+        changed = [corpus, document_lengths]
+        gone = []
+        new_terms = []
+        gone_terms = []
+        for term, term_postings in zip(terms, entities[2:]):
+            frequency = frequencies[term]
+            if term_postings is None:
+                if not frequency:
+                    continue
+                term_postings = TermPostings(
+                    key_name=TermPostings.key_name_for(term),
+                    parent=corpus_key)
+                new_terms.append(term)
+            elif frequency and rebuild:
+                new_terms.append(term)
+            ids = term_postings.get_ids()
+            term_frequencies = term_postings.get_frequencies(ids)
+            position = bisect.bisect_left(ids, doc_id)
+            present = position < len(ids) and ids[position] == doc_id
+            if frequency and not present:
+                ids.insert(position, doc_id)
+                term_frequencies.insert(position, frequency)
+            elif frequency and term_frequencies[position] != frequency:
+                term_frequencies[position] = frequency
+            elif not frequency and present:
+                del ids[position]
+                del term_frequencies[position]
+            elif words is None or term in entries:
+                continue
+            else:
+                # Only the dictionary lacks the term, e.g. in a backfill.
+                term_postings = None
+            if words is not None:
+                # Terms keep the word they were first seen as.
+                word = term in entries and entries[term][0] or words.get(term)
+                if ids and word:
+                    entries[term] = (word, len(ids))
+                elif term in entries:
+                    del entries[term]
+            if term_postings is None:
+                continue
+            if ids:
+                term_postings.set_ids(ids, term_frequencies)
+                changed.append(term_postings)
+            else:
+                gone.append(term_postings.key())
+                gone_terms.append(term)
+        if words is not None:
+            dictionary.set_entries(entries)
+            changed.append(dictionary)
+        changed += update_prefixes(kind, new_terms, gone_terms)
+        for batch in batches(changed):
+            db.put(batch)
+        for batch in batches(gone):
+            db.delete(batch)
+    db.run_in_transaction(txn)
+
+def update_prefixes(kind, new_terms, gone_terms):
+    """Returns the PrefixShards changed by terms appearing or going away.
+
+    The caller puts them, in the transaction this is called in.
+    """
+    changes = {}
+    for term in new_terms:
+        changes.setdefault(PrefixShard.key_name_for(term),
+                           ([], []))[0].append(term)
+    for term in gone_terms:
+        changes.setdefault(PrefixShard.key_name_for(term),
+                           ([], []))[1].append(term)
+    key_names = changes.keys()
+    corpus_key = corpus_key_for(kind)
+    prefix_shards = PrefixShard.get_by_key_name(key_names, parent=corpus_key)
+    for i, key_name in enumerate(key_names):
+        if prefix_shards[i] is None:
+            prefix_shards[i] = PrefixShard(key_name=key_name,
+                                           parent=corpus_key)
+        added, removed = changes[key_name]
+        terms = set(prefix_shards[i].get_terms())
+        terms.update(added)
+        terms.difference_update(removed)
+        prefix_shards[i].set_terms(sorted(terms))
+    return prefix_shards
+
+def expand_prefixes(kind, prefixes):
+    """Returns a dict of prefix -> up to MAX_PREFIX_TERMS indexed terms
+    starting with it."""
+    prefixes = list(prefixes)
+    key_names = [PrefixShard.key_name_for(prefix) for prefix in prefixes]
+    prefix_shards = PrefixShard.get_by_key_name(key_names,
+                                                parent=corpus_key_for(kind))
+    expansions = {}
+    for prefix, prefix_shard in zip(prefixes, prefix_shards):
+        terms = prefix_shard and prefix_shard.get_terms() or []
+        start = bisect.bisect_left(terms, prefix)
+        matches = []
+        for term in terms[start:start + MAX_PREFIX_TERMS]:
+            if not term.startswith(prefix):
+                break
+            matches.append(term)
+        expansions[prefix] = matches
+    return expansions
+
+def update_document(entity, terms, dropped_terms=0, rebuild=False,
+                    positions=None, words=None):
+    """Indexes entity's terms.
+
+    Args:
+      entity: a saved SearchableModel with an id
+      terms: list of the words indexed, in order and with repeats
+      dropped_terms: number of words left out with code blocks and markup
+      rebuild: if True, adds the entity to the posting lists of all its
+        terms, not only the terms whose frequency changed
+      positions: for models with positional_index, the phrase tokens of
+        the entity, found when terms were
+      words: for models with suggestions, a dict of term -> the word
+        suggest() offers for it, found when terms were
+    """
+    frequencies = term_frequencies(terms)
+    document = SearchDocument.get(SearchDocument.key_for(entity.key()))
+    if document is None:
+        document = SearchDocument(key_name=SearchDocument.KEY_NAME, 
+                                  parent=entity)
+        old_frequencies = {}
+        docs_delta = 1
+    else:
+        old_frequencies = document.get_terms()
+        docs_delta = 0
+    changes = {}
+    for term, frequency in frequencies.iteritems():
+        if rebuild or old_frequencies.get(term) != frequency:
+            changes[term] = frequency
+    for term in old_frequencies:
+        if term not in frequencies:
+            changes[term] = 0
+    suggestions = getattr(entity, 'suggestions', False)
+    if not suggestions:
+        words = None
+    adjust_corpus(entity.kind(), entity.key().id(), docs_delta,
+                  len(terms) - document.length, changes, len(terms),
+                  rebuild, words)
+    document.length = len(terms)
+    document.dropped_terms = dropped_terms
+    document.set_terms(frequencies)
+    if getattr(entity, 'positional_index', False):
+        document.set_positions(positions)
+    else:
+        document.positions_blob = None
+    snippet_property = getattr(entity, 'snippet_property', None)
+    if snippet_property:
+        document.set_text(getattr(entity, snippet_property))
+    document.put()
+    if suggestions:
+        update_suggestion(entity.kind(), entity.key().id(),
+                          entity.suggestion())
+
+def update_suggestion(kind, doc_id, suggestion):
+    """Stores doc_id's suggestion, removing it if suggestion is None."""
+    suggestion_list = SuggestionList.get_by_key_name(kind) or \
+                      SuggestionList(key_name=kind)
+    suggestions = suggestion_list.get_suggestions()
+    if suggestions.get(doc_id) == suggestion:
+        return
+    if suggestion is None:
+        del suggestions[doc_id]
+    else:
+        suggestions[doc_id] = suggestion
+    suggestion_list.set_suggestions(suggestions)
+    suggestion_list.put()
+
+def update_sort_value(kind, doc_id, value):
+    """Stores doc_id's sort value, removing it if value is None."""
+    def txn():
+        sort_list = SortList.get_by_key_name(kind) or \
+                    SortList(key_name=kind)
+        values = sort_list.get_values()
+        if values.get(doc_id) == value:
+            return
+        if value is None:
+            del values[doc_id]
+        else:
+            values[doc_id] = value
+        sort_list.set_values(values)
+        sort_list.put()
+    db.run_in_transaction(txn)
+
+def remove_document(entity):
+    if not entity.is_saved():
+        return
+    suggestions = getattr(entity, 'suggestions', False)
+    document = SearchDocument.get(SearchDocument.key_for(entity.key()))
+    if document:
+        changes = dict.fromkeys(document.get_terms(), 0)
+        words = None
+        if suggestions:
+            words = {}
+        adjust_corpus(entity.kind(), entity.key().id(), -1,
+                      -document.length, changes, words=words)
+        document.delete()
+    if suggestions:
+        update_suggestion(entity.kind(), entity.key().id(), None)
+    if getattr(entity, 'sort_property', None):
+        update_sort_value(entity.kind(), entity.key().id(), None)
+
+def bm25(frequency, length, average_length, idf):
+    norm = 1.0 - BM25_B
+    if average_length:
+        norm += BM25_B * length / average_length
+    return idf * frequency * (BM25_K1 + 1) / (frequency + BM25_K1 * norm)
+
+def rank(kind, terms, ids, limit=MAX_RESULTS):
+    """Returns up to limit of the sorted ids, most relevant to terms
+    first.
+
+    Scores come from the frequencies stored in the terms' posting lists
+    and from DocumentLengths, so no SearchDocument is read.  Only the
+    first MAX_RANKED_DOCS ids are scored.
+    """
+    if not ids:
+        return []
+    ids = ids[:MAX_RANKED_DOCS]
+    terms = list(terms)
+    entities = get_in_batches([corpus_key_for(kind),
+                               DocumentLengths.key_for(kind)] +
+                              [TermPostings.key_for(kind, term)
+                               for term in terms])
+    corpus, document_lengths = entities[:2]
+    if not corpus:
+        return ids[:limit]
+    average_length = corpus.average_length()
+    lengths = document_lengths and document_lengths.get_lengths() or {}
+    scores = dict.fromkeys(ids, 0.0)
+    for term_postings in entities[2:]:
+        if not term_postings:
+            continue
+        df = term_postings.df
+        idf = math.log(1.0 + (corpus.num_docs - df + 0.5) / (df + 0.5))
+        term_ids = term_postings.get_ids()
+        for id, frequency in zip(term_ids,
+                                 term_postings.get_frequencies(term_ids)):
+            if id in scores:
+                scores[id] += bm25(frequency, lengths.get(id, average_length),
+                                   average_length, idf)
+    # nlargest keeps a heap of at most limit entries.
+    return heapq.nlargest(limit, ids, key=scores.__getitem__)
+
+OR_REGEX = re.compile(r'\s+OR\s+')
+PHRASE_REGEX = re.compile(r'"([^"]*)"?')
+PREFIX_REGEX = re.compile(r'(\w+)\*', re.UNICODE)
+CODE_QUERY_REGEX = re.compile(r'\bcode:(\w+)')
+
+class Alternative(object):
+    """One OR-separated part of a query, all of which must match."""
+    def __init__(self):
+        self.terms = set()
+        self.phrases = []
+        self.prefixes = set()
+
+    def is_empty(self):
+        return not self.terms and not self.prefixes
+
+    def normalized(self):
+        parts = sorted(self.terms)
+        parts += sorted(['"%s"' % ' '.join(phrase)
+                         for phrase in self.phrases])
+        parts += sorted([prefix + '*' for prefix in self.prefixes])
+        return ' '.join(parts)
+
+def parse_query(search_query):
+    """Returns a list of Alternatives.
+
+    Words within an alternative must all match, and alternatives are
+    separated by OR.  "Quoted words" must appear in order, word for
+    word, in models with positional_index.  memc* matches indexed terms
+    starting with the stem of memc, and 'code:name' matches an
+    identifier in code of models with searchable_code.  Words that
+    aren't indexed are dropped, and so are phrases without any.
+    """
+    from models import search
+    terms_for = search.SearchableEntity._FullTextTerms
+    alternatives = []
+    for part in OR_REGEX.split(search_query):
+        alternative = Alternative()
+        for phrase in PHRASE_REGEX.findall(part):
+            terms = terms_for(phrase)
+            tokens = search.SearchableEntity._PhraseTokens(phrase)
+            if terms and len(tokens) > 1:
+                alternative.phrases.append(tokens)
+            alternative.terms.update(terms)
+        part = PHRASE_REGEX.sub(' ', part)
+        for prefix in PREFIX_REGEX.findall(part):
+            # Terms are stems, so happy* has to look for happi.
+            prefix = stemmer.stem(prefix.lower())
+            if len(prefix) >= MIN_PREFIX_LENGTH:
+                alternative.prefixes.add(prefix)
+        part = PREFIX_REGEX.sub(' ', part)
+        for name in CODE_QUERY_REGEX.findall(part):
+            alternative.terms.add(search.SearchableEntity._CODE_TERM_PREFIX +
+                                  name.lower())
+        alternative.terms.update(terms_for(CODE_QUERY_REGEX.sub(' ', part)))
+        if not alternative.is_empty():
+            alternatives.append(alternative)
+    return alternatives
+
+def has_phrase(positions, phrase):
+    """True if the tokens of phrase appear at consecutive positions."""
+    following = []
+    for token in phrase:
+        if token not in positions:
+            return False
+        following.append(set(decode_postings(positions[token])))
+    for start in following[0]:
+        for offset in range(1, len(phrase)):
+            if start + offset not in following[offset]:
+                break
+        else:
+            return True
+    return False
+
+def verify_phrases(kind, ids, phrases):
+    """Returns the ids whose documents contain all the phrases.
+
+    Documents without positions are assumed to match.  Only the first
+    MAX_PHRASE_DOCS ids are checked.
+    """
+    ids = ids[:MAX_PHRASE_DOCS]
+    documents = get_in_batches([
+        SearchDocument.key_for(db.Key.from_path(kind, id)) for id in ids])
+    matches = []
+    for id, document in zip(ids, documents):
+        positions = document and document.get_positions()
+        if positions is None:
+            matches.append(id)
+            continue
+        for phrase in phrases:
+            if not has_phrase(positions, phrase):
+                break
+        else:
+            matches.append(id)
+    return matches
+
+def plan(lists, num_docs):
+    """Returns (posting lists worth intersecting, rarest first, the
+    posting lists that only filter their intersection).
+
+    Terms too common to narrow the results filter, except the rarest
+    one, and so do the lists beyond MAX_QUERY_TERMS.  Empty lists to
+    intersect mean nothing can match.
+    """
+    lists = sorted(lists, key=len)
+    if not lists or not lists[0]:
+        return [], []
+    narrowing = lists[:1]
+    filters = []
+    most = COMMON_TERM_RATIO * num_docs
+    for ids in lists[1:]:
+        if len(narrowing) == MAX_QUERY_TERMS or \
+           num_docs >= MIN_PLANNED_DOCS and len(ids) > most:
+            filters.append(ids)
+        else:
+            narrowing.append(ids)
+    return narrowing, filters
+
+def filter_ids(ids, lists):
+    """Returns the sorted ids that are in all of the sorted lists.
+
+    Each id is looked up by binary search, so long lists cost little
+    once ids is short.
+    """
+    for other in lists:
+        if not ids:
+            break
+        ids = [id for id in ids if contains(other, id)]
+    return ids
+
+def contains(ids, id):
+    """Returns True if the sorted list ids holds id."""
+    position = bisect.bisect_left(ids, id)
+    return position < len(ids) and ids[position] == id
+
+def expand_query(kind, alternatives):
+    """Returns expand_prefixes() of the prefixes of all alternatives."""
+    prefixes = set()
+    for alternative in alternatives:
+        prefixes.update(alternative.prefixes)
+    return expand_prefixes(kind, prefixes)
+
+def match(kind, alternatives, expansions=None):
+    """Returns sorted ids of entities matching the parsed query.
+
+    Args:
+      kind: kind of the searchable entities
+      alternatives: list of Alternatives from parse_query()
+      expansions: the query's expand_query(), if the caller has it
+    """
+    if not alternatives:
+        return []
+    if expansions is None:
+        expansions = expand_query(kind, alternatives)
+    all_terms = set()
+    for alternative in alternatives:
+        all_terms.update(alternative.terms)
+    for terms in expansions.values():
+        all_terms.update(terms)
+    postings, num_docs = get_postings(kind, all_terms)
+    results = []
+    for alternative in alternatives:
+        lists = [postings[term] for term in alternative.terms]
+        for prefix in alternative.prefixes:
+            lists.append(union([postings[term]
+                                for term in expansions[prefix]]))
+        narrowing, filters = plan(lists, num_docs)
+        ids = filter_ids(intersect(narrowing), filters)
+        if ids and alternative.phrases:
+            ids = verify_phrases(kind, ids, alternative.phrases)
+        results.append(ids)
+    return union(results)
+
+def search_keys(model_class, search_query):
+    """Returns keys of model_class entities matching search_query."""
+    kind = model_class.kind()
+    return [db.Key.from_path(kind, id)
+            for id in match(kind, parse_query(search_query))]
+
+def ranked_search(model_class, search_query, limit=MAX_RESULTS):
+    """Returns keys of full-text matches ordered by BM25 relevance.
+
+    Terms that prefixes of the query expanded to count too.
+    """
+    alternatives = parse_query(search_query)
+    kind = model_class.kind()
+    expansions = expand_query(kind, alternatives)
+    terms = set()
+    for alternative in alternatives:
+        terms.update(alternative.terms)
+    for expanded in expansions.values():
+        terms.update(expanded)
+    ids = rank(kind, terms, match(kind, alternatives, expansions), limit)
+    return [db.Key.from_path(kind, id) for id in ids]
+
+def sorted_search(model_class, search_query, limit=None):
+    """Returns keys of the matches, or of up to limit of them, highest
+    value of model_class.sort_property first.
+
+    Matches are ordered by the stored SortList, so none are fetched.
+    Those without a sort value come last.  All matches are returned by
+    default, so paging through the list reaches the oldest; only their
+    ids are cached by cached_keys().
+    """
+    kind = model_class.kind()
+    ids = match(kind, parse_query(search_query))
+    sort_list = SortList.get_by_key_name(kind)
+    values = sort_list and sort_list.get_values() or {}
+    sort_key = lambda id: (id in values, values.get(id))
+    if limit is None:
+        ids = sorted(ids, key=sort_key, reverse=True)
+    else:
+        ids = heapq.nlargest(limit, ids, key=sort_key)
+    return [db.Key.from_path(kind, id) for id in ids]
+
+def normalize_query(alternatives):
+    """Returns a string that is the same for equivalent parsed queries."""
+    return ' OR '.join(sorted([alternative.normalized()
+                               for alternative in alternatives]))
+
+def best_window(matches, length):
+    """Returns the start of the window of length characters holding the
+    most distinct terms, then the most matches.
+
+    Args:
+      matches: sorted list of (offset, term)
+    """
+    best = best_score = None
+    counts = {}
+    first = 0
+    for offset, term in matches:
+        counts[term] = counts.get(term, 0) + 1
+        while matches[first][0] <= offset - length:
+            old_term = matches[first][1]
+            counts[old_term] -= 1
+            if not counts[old_term]:
+                del counts[old_term]
+            first += 1
+        score = (len(counts), sum(counts.itervalues()))
+        if score > best_score:
+            best, best_score = matches[first][0], score
+    return best
+
+def make_snippet(document, terms, prefixes=()):
+    """Returns html of a window of document's text around the query
+    terms, with the matching words in <mark>, or None if none match.
+
+    Works from the offsets stored with the document, so the text is
+    only scanned for word ends in the window.
+    """
+    from models import search
+    text = document and document.text
+    if not text:
+        return None
+    offsets = document.get_offsets()
+    matches = []
+    for term, encoded in offsets.iteritems():
+        if term in terms or [prefix for prefix in prefixes
+                             if term.startswith(prefix)]:
+            matches += [(offset, term) for offset in decode_postings(encoded)]
+    if not matches:
+        return None
+    matches.sort()
+    start = best_window(matches, SNIPPET_LENGTH - SNIPPET_LEAD)
+    if start > SNIPPET_LEAD:
+        start = text.find(' ', start - SNIPPET_LEAD, start) + 1 or start
+    else:
+        start = 0
+    end = start + SNIPPET_LENGTH
+    if end < len(text):
+        end = text.rfind(' ', start, end) + 1 or end
+    else:
+        end = len(text)
+    parts = []
+    if start:
+        parts.append('... ')
+    position = start
+    for offset, term in matches:
+        if offset < position or offset >= end:
+            continue
+        word_end = search.SearchableEntity._WordEnd(text, offset)
+        parts += [cgi.escape(text[position:offset]), '<mark>',
+                  cgi.escape(text[offset:word_end]), '</mark>']
+        position = word_end
+    parts.append(cgi.escape(text[position:end].rstrip()))
+    if end < len(text):
+        parts.append(' ...')
+    return ''.join(parts)
+
+def snippets(keys, search_query):
+    """Returns snippets for the search results with keys, in order, or
+    None for those without one."""
+    terms = set()
+    prefixes = set()
+    for alternative in parse_query(search_query):
+        terms.update(alternative.terms)
+        prefixes.update(alternative.prefixes)
+    if not keys or not (terms or prefixes):
+        return [None] * len(keys)
+    documents = get_in_batches([SearchDocument.key_for(key) for key in keys])
+    return [make_snippet(document, terms, prefixes)
+            for document in documents]
+
+def generation_memcache_key(kind):
+    return 'SearchGeneration' + kind
+
+def bump_generation(kind):
+    """Invalidates cached results for kind.
+
+    Returns the new generation, or None if it was evicted.
+    """
+    # If the generation was evicted, the next read starts a new one.
+    return memcache.incr(generation_memcache_key(kind))
+
+def start_generation(kind):
+    """Returns the generation of kind, starting one if there is none."""
+    # Milliseconds, so a restarted generation can't repeat one
+    # that is still stored with results.
+    generation_key = generation_memcache_key(kind)
+    memcache.add(generation_key, int(time.time() * 1000))
+    return memcache.get(generation_key)
+
+def cached_keys(model_class, search_query, order, compute):
+    """Returns the keys compute() finds for search_query, through memcache.
+
+    Results are stored as (generation, ids) under the normalized query,
+    so a repeated search costs one memcache call.
+
+    Args:
+      model_class: the searchable model
+      search_query: query as typed by the user
+      order: name of the result order, part of the cache key
+      compute: function returning the list of keys
+    """
+    kind = model_class.kind()
+    normalized = normalize_query(parse_query(search_query))
+    if isinstance(normalized, unicode):
+        normalized = normalized.encode('utf-8')
+    generation_key = generation_memcache_key(kind)
+    results_key = 'SearchResults%s_%s_%s' % (kind, order,
+                                             md5.new(normalized).hexdigest())
+    cached = memcache.get_multi([generation_key, results_key])
+    generation = cached.get(generation_key)
+    if generation is None:
+        generation = start_generation(kind)
+    results = cached.get(results_key)
+    if results and results[0] == generation:
+        return [db.Key.from_path(kind, id) for id in results[1]]
+    keys = compute()
+    memcache.set(results_key, (generation, [key.id() for key in keys]))
+    return keys
+
+class TermDictionary(object):
+    """Sorted words of a kind's terms with their document frequencies,
+    and suggestions indexed by the words of their titles."""
+    def __init__(self, data):
+        """
+        Args:
+          data: (version, compressed pickle of (sorted list of words,
+            parallel list of document frequencies, list of suggestion
+            dicts with a 'title')), as built by refresh_dictionary()
+        """
+        self.data = data
+        self.version = data[0]
+        if data[1]:
+            words, frequencies, suggestions = \
+                pickle.loads(zlib.decompress(data[1]))
+        else:
+            words, frequencies, suggestions = [], [], []
+        self.words = words
+        self.frequencies = frequencies
+        self.suggestions = suggestions
+        title_words = []
+        for i, suggestion in enumerate(suggestions):
+            for word in suggestion['title'].lower().split():
+                title_words.append((word, i))
+        title_words.sort()
+        self.title_words = title_words
+        self.checked = time.time()
+        self.completions = models.LRUCache(500)
+
+    def complete(self, prefix):
+        """Returns (words, suggestions) starting with prefix.
+
+        Words are the SUGGESTED_TERMS in the most documents, and
+        suggestions have a title word starting with prefix.
+        """
+        completion = self.completions.get(prefix)
+        if completion is None:
+            completion = (self.complete_words(prefix),
+                          self.complete_titles(prefix))
+            self.completions.set(prefix, completion)
+        return completion
+
+    def complete_words(self, prefix):
+        start = bisect.bisect_left(self.words, prefix)
+        end = bisect.bisect_left(self.words, prefix + u'\uffff', start)
+        best = heapq.nlargest(SUGGESTED_TERMS, xrange(start, end),
+                              key=self.frequencies.__getitem__)
+        return [self.words[i] for i in best]
+
+    def complete_titles(self, prefix):
+        start = bisect.bisect_left(self.title_words, (prefix,))
+        indices = []
+        for word, i in self.title_words[start:]:
+            if not word.startswith(prefix) or \
+               len(indices) == SUGGESTED_TITLES:
+                break
+            if i not in indices:
+                indices.append(i)
+        return [self.suggestions[i] for i in indices]
+
+# Term dictionaries of this instance by kind.
+dictionaries = {}
+
+def dictionary_memcache_key(kind):
+    return 'SearchDictionary' + kind
+
+def refresh_dictionary(kind, replace=True):
+    """Rebuilds the term dictionary of kind and stores it in memcache.
+
+    Reads the SearchDictionary and SuggestionList of kind in one batch
+    get.  Called after entities are written, and by get_dictionary() on
+    an instance that has none when memcache has none either.  Unless
+    replace is set, a dictionary a writer stored meanwhile is kept.
+    """
+    dictionary, suggestion_list = db.get([
+        SearchDictionary.key_for(kind),
+        db.Key.from_path(SuggestionList.kind(), kind)])
+    entries = dictionary and dictionary.get_entries() or {}
+    pairs = sorted(entries.values())
+    suggestions = suggestion_list and suggestion_list.get_suggestions() or {}
+    suggestions = [suggestions[id] for id in sorted(suggestions)]
+    data = (time.time(), zlib.compress(pickle.dumps(
+        ([word for word, df in pairs], [df for word, df in pairs],
+         suggestions), 2)))
+    if replace:
+        if not memcache.set(dictionary_memcache_key(kind), data):
+            logging.warning("Couldn't store the %s term dictionary in "
+                            "memcache", kind)
+    else:
+        memcache.add(dictionary_memcache_key(kind), data)
+    dictionaries[kind] = TermDictionary(data)
+    return dictionaries[kind]
+
+def get_dictionary(kind):
+    """Returns the term dictionary of kind from instance memory.
+
+    Every DICTIONARY_CHECK_TIME seconds, compares its version with
+    memcache and loads a newer one.  If memcache lost the dictionary,
+    e.g. to a flush, this instance keeps what it has and offers it back
+    to memcache.  An instance without one rebuilds it from the stored
+    SearchDictionary and SuggestionList.
+    """
+    dictionary = dictionaries.get(kind)
+    if dictionary and time.time() - dictionary.checked < \
+       DICTIONARY_CHECK_TIME:
+        return dictionary
+    memcache_key = dictionary_memcache_key(kind)
+    data = memcache.get(memcache_key)
+    if data is None:
+        if dictionary:
+            if dictionary.data[1]:
+                memcache.add(memcache_key, dictionary.data)
+            dictionary.checked = time.time()
+        else:
+            dictionary = refresh_dictionary(kind, replace=False)
+    elif dictionary and dictionary.version == data[0]:
+        dictionary.checked = time.time()
+    else:
+        dictionary = dictionaries[kind] = TermDictionary(data)
+    return dictionary
+
+def suggest(model_class, prefix):
+    """Returns a dict of 'terms' and 'suggestions' completing prefix."""
+    prefix = prefix.strip().lower()
+    if not prefix:
+        return {'terms': [], 'suggestions': []}
+    words, suggestions = get_dictionary(model_class.kind()).complete(prefix)
+    return {'terms': words, 'suggestions': suggestions}
+
+class ReindexCheckpoint(db.Model):
+    """Progress of a reindex of one kind, which is the key name."""
+    start = db.StringProperty()
+    done = db.BooleanProperty(default=False)
+    scanned = db.IntegerProperty(default=0)
+    written = db.IntegerProperty(default=0)
+    seconds = db.FloatProperty(default=0.0)
+    started = db.DateTimeProperty(auto_now_add=True)
+    updated = db.DateTimeProperty(auto_now=True)
+
+    def start_key(self):
+        return self.start and db.Key(self.start) or None
+
+    def add_batch(self, next_key, scanned, written, seconds):
+        """Records a finished batch and puts the checkpoint."""
+        self.start = next_key and str(next_key) or None
+        self.done = next_key is None
+        self.scanned += scanned
+        self.written += written
+        self.seconds += seconds
+        self.put()
+
+    def progress(self):
+        return { 'start': self.start,
+                 'done': self.done,
+                 'total_scanned': self.scanned,
+                 'total_written': self.written,
+                 'total_seconds': round(self.seconds, 2),
+                 'total_per_second': self.seconds and
+                                     round(self.scanned / self.seconds, 1)
+                                     or 0 }
+
+def backfill(model_class, start_key=None, batch_size=20):
+    """Rebuilds the index entries of one batch of entities.
+
+    Returns:
+      Tuple of (key to resume from or None when finished,
+                number of entities scanned, number of documents put)
+    """
+    entities, next_key = models.fetch_batch(model_class, start_key, 
+                                            batch_size)
+    for entity in entities:
+        terms, dropped, positions, words = \
+            entity._populate_internal_entity()._IndexedTerms()
+        update_document(entity, terms, dropped, rebuild=True,
+                        positions=positions, words=words)
+        if entity.sort_property:
+            update_sort_value(entity.kind(), entity.key().id(),
+                              getattr(entity, entity.sort_property))
+    if entities and model_class.suggestions:
+        refresh_dictionary(model_class.kind())
+    return next_key, len(entities), len(entities)
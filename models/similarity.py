@@ -0,0 +1,269 @@
+# The MIT License
+# 
+# Copyright 2008 William T Katz
+# 
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+# 
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+# 
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+# THE SOFTWARE.
+
+"""Related articles by similarity of hashed TF-IDF vectors.
+
+Each searchable entity's term frequencies, kept by searchindex at put(),
+are turned into a DIMENSIONS-long vector: every term adds its weighted
+frequency times its idf to one bucket picked by a hash of the term,
+with a sign from another bit of the hash, and the vector is scaled to
+unit length.  Signed hashing is a random projection, so it stands in
+for a trained reduction like a truncated SVD, which would need NumPy.
+
+build() is a resumable job (see handlers/bloog/jobs.py) that stores the
+vectors of a kind in VectorChunk entities, one per batch, and publishes
+them in VectorStore when the walk finishes.  Instances load a published
+build into one flat array of floats and answer related() and
+similar_search() with one pass of dot products over it.  Related ids
+are cached in memcache per build.
+"""
+
+import array
+import heapq
+import logging
+import math
+import operator
+import time
+import zlib
+
+from google.appengine.api import memcache
+from google.appengine.ext import db
+
+import models
+from models import searchindex
+
+DIMENSIONS = 128
+MAX_RELATED = 10
+# Seconds an instance uses its vectors before checking for a new build.
+CHECK_TIME = 10
+
+class VectorStore(db.Model):
+    """Key name is the kind.  Tracks the published and pending builds."""
+    build = db.IntegerProperty(default=0)
+    num_chunks = db.IntegerProperty(default=0)
+    pending_build = db.IntegerProperty(default=0)
+    pending_chunks = db.IntegerProperty(default=0)
+
+class VectorChunk(db.Model):
+    """Vectors of one batch of a build, in id order."""
+    ids_blob = db.BlobProperty()
+    vectors_blob = db.BlobProperty()
+
+    @staticmethod
+    def key_name_for(kind, build, chunk):
+        return '%s:%d:%d' % (kind, build, chunk)
+
+    def get_ids(self):
+        return searchindex.decode_postings(self.ids_blob)
+
+    def get_vectors(self):
+        vectors = array.array('f')
+        vectors.fromstring(self.vectors_blob)
+        return vectors
+
+def hash_term(term):
+    """Returns (bucket, sign) of term."""
+    if isinstance(term, unicode):
+        term = term.encode('utf-8')
+    hashed = zlib.crc32(term) & 0xffffffff
+    return hashed % DIMENSIONS, (hashed >> 16) & 1 and 1.0 or -1.0
+
+def get_idfs(kind, terms):
+    """Returns a dict of term -> inverse document frequency."""
+    corpus = searchindex.SearchCorpus.get_by_key_name(kind)
+    num_docs = corpus and corpus.num_docs or 0
+    idfs = {}
+    for term, df in searchindex.get_document_frequencies(kind,
+                                                         terms).iteritems():
+        if df:
+            idfs[term] = math.log(1.0 + float(num_docs) / df)
+    return idfs
+
+def make_vector(frequencies, idfs):
+    """Returns the unit-length hashed TF-IDF vector of a dict of
+    term -> frequency, or None if no term has an idf."""
+    vector = array.array('f', [0.0]) * DIMENSIONS
+    for term, frequency in frequencies.iteritems():
+        if term in idfs:
+            bucket, sign = hash_term(term)
+            vector[bucket] += sign * (1.0 + math.log(frequency)) * idfs[term]
+    norm = math.sqrt(sum(map(operator.mul, vector, vector)))
+    if not norm:
+        return None
+    for i in xrange(DIMENSIONS):
+        vector[i] /= norm
+    return vector
+
+def build(model_class, start_key=None, batch_size=20):
+    """Stores the vectors of one batch of entities.
+
+    Starting without start_key begins a new build, which replaces the
+    published one when the last batch is stored.
+
+    Returns:
+      Tuple of (key to resume from or None when finished,
+                number of entities scanned, number of vectors stored)
+    """
+    kind = model_class.kind()
+    store = VectorStore.get_by_key_name(kind) or VectorStore(key_name=kind)
+    if start_key is None:
+        if store.pending_build > store.build:
+            # Drop the chunks of a build that was never finished.
+            db.delete([db.Key.from_path('VectorChunk',
+                           VectorChunk.key_name_for(kind, store.pending_build,
+                                                    chunk))
+                       for chunk in range(store.pending_chunks)])
+        store.pending_build = max(store.build, store.pending_build) + 1
+        store.pending_chunks = 0
+    entities, next_key = models.fetch_batch(model_class, start_key,
+                                            batch_size)
+    documents = db.get([searchindex.SearchDocument.key_for(entity.key())
+                        for entity in entities])
+    frequencies = [document and document.get_terms() or {}
+                   for document in documents]
+    terms = set()
+    for document_frequencies in frequencies:
+        terms.update(document_frequencies)
+    idfs = get_idfs(kind, terms)
+    ids = []
+    vectors = array.array('f')
+    for entity, document_frequencies in zip(entities, frequencies):
+        vector = make_vector(document_frequencies, idfs)
+        if vector:
+            ids.append(entity.key().id())
+            vectors.extend(vector)
+    changed = [store]
+    if ids:
+        changed.append(VectorChunk(
+            key_name=VectorChunk.key_name_for(kind, store.pending_build,
+                                              store.pending_chunks),
+            ids_blob=db.Blob(searchindex.encode_postings(ids)),
+            vectors_blob=db.Blob(vectors.tostring())))
+        store.pending_chunks += 1
+    if next_key is None:
+        old_keys = [db.Key.from_path('VectorChunk',
+                        VectorChunk.key_name_for(kind, store.build, chunk))
+                    for chunk in range(store.num_chunks)]
+        store.build = store.pending_build
+        store.num_chunks = store.pending_chunks
+    db.put(changed)
+    if next_key is None:
+        if old_keys:
+            db.delete(old_keys)
+        # Cached similar_search() results came from the old build.
+        searchindex.bump_generation(kind)
+        logging.info("Published vectors of %s build %d", kind, store.build)
+    return next_key, len(entities), len(ids)
+
+class Vectors(object):
+    """A published build of a kind loaded into instance memory."""
+    def __init__(self, build, ids, vectors):
+        self.build = build
+        self.ids = ids
+        self.rows = dict([(id, i) for i, id in enumerate(ids)])
+        self.vectors = vectors
+        self.checked = time.time()
+
+    def vector_for(self, id):
+        row = self.rows.get(id)
+        if row is None:
+            return None
+        return self.vectors[row * DIMENSIONS:(row + 1) * DIMENSIONS]
+
+    def nearest(self, vector, limit, exclude=None):
+        """Returns ids of the limit vectors with the largest dot
+        product with vector, most similar first."""
+        vectors = self.vectors
+        def scored():
+            for i, id in enumerate(self.ids):
+                if id != exclude:
+                    start = i * DIMENSIONS
+                    yield (sum(map(operator.mul, vector,
+                                   vectors[start:start + DIMENSIONS])), id)
+        return [id for score, id in heapq.nlargest(limit, scored())
+                if score > 0.0]
+
+# Loaded builds of this instance by kind.
+loaded = {}
+
+def get_vectors(kind):
+    """Returns the published Vectors of kind, or None if none are built.
+
+    Checks for a newer build every CHECK_TIME seconds.
+    """
+    vectors = loaded.get(kind)
+    if vectors and time.time() - vectors.checked < CHECK_TIME:
+        return vectors
+    store = VectorStore.get_by_key_name(kind)
+    if not store or not store.build:
+        return None
+    if vectors and vectors.build == store.build:
+        vectors.checked = time.time()
+        return vectors
+    chunks = VectorChunk.get_by_key_name(
+        [VectorChunk.key_name_for(kind, store.build, chunk)
+         for chunk in range(store.num_chunks)])
+    ids = []
+    flat = array.array('f')
+    for chunk in chunks:
+        if chunk:
+            ids += chunk.get_ids()
+            flat.extend(chunk.get_vectors())
+    vectors = loaded[kind] = Vectors(store.build, ids, flat)
+    return vectors
+
+def related(model_class, key, limit=MAX_RELATED):
+    """Returns keys of the entities most similar to the one with key."""
+    kind = model_class.kind()
+    vectors = get_vectors(kind)
+    if not vectors:
+        return []
+    memcache_key = 'Related%s_%d_%d' % (kind, vectors.build, key.id())
+    ids = memcache.get(memcache_key)
+    if ids is None:
+        vector = vectors.vector_for(key.id())
+        if vector is None:
+            # Written since the build, so make its vector now.
+            document = searchindex.SearchDocument.get(
+                           searchindex.SearchDocument.key_for(key))
+            frequencies = document and document.get_terms() or {}
+            vector = make_vector(frequencies, get_idfs(kind, frequencies))
+        ids = vector and vectors.nearest(vector, limit, key.id()) or []
+        memcache.set(memcache_key, ids)
+    return [db.Key.from_path(kind, id) for id in ids]
+
+def similar_search(model_class, search_query, limit=searchindex.MAX_RESULTS):
+    """Returns keys of the entities most similar to the query's terms,
+    whether or not they contain all of them."""
+    kind = model_class.kind()
+    vectors = get_vectors(kind)
+    if not vectors:
+        return []
+    frequencies = {}
+    for alternative in searchindex.parse_query(search_query):
+        for term in alternative.terms:
+            frequencies[term] = 1
+    vector = make_vector(frequencies, get_idfs(kind, frequencies))
+    if not vector:
+        return []
+    return [db.Key.from_path(kind, id)
+            for id in vectors.nearest(vector, limit)]
@@ -23,6 +23,8 @@
 import logging
 import string
 import re
+from htmlentitydefs import name2codepoint
+from sgmllib import SGMLParser, SGMLParseError
 
 from external.BeautifulSoup import BeautifulSoup, Comment
 
@@ -138,3 +140,266 @@ def chop_up(text, chop_size=5):
         blocks += 1
     return [text[i*chop_size:min(chars,(i+1)*chop_size)] 
             for i in xrange(0, blocks)]
+
+# Tag nesting rules of BeautifulSoup, so both sanitizers repair
+# mis-nested html the same way.
+self_closing_tags = frozenset(BeautifulSoup.SELF_CLOSING_TAGS)
+preserve_whitespace_tags = frozenset(BeautifulSoup.PRESERVE_WHITESPACE_TAGS)
+quote_tags = frozenset(BeautifulSoup.QUOTE_TAGS)
+# Elements whose text browsers don't unescape, like <style>.
+raw_text_tags = frozenset(['script', 'style'])
+nestable_tags = BeautifulSoup.NESTABLE_TAGS
+reset_nesting_tags = frozenset(BeautifulSoup.RESET_NESTING_TAGS)
+markup_massage = BeautifulSoup.MARKUP_MASSAGE
+
+xml_special_chars = {'apos': "'", 'quot': '"', 'amp': '&',
+                     'lt': '<', 'gt': '>'}
+entity_matcher = re.compile(r'&(#\d+|#x[0-9a-fA-F]+|\w+);')
+hex_charref_matcher = re.compile(r'&(#x[0-9a-fA-F]+);')
+bare_ampersand_or_bracket = re.compile(
+    r'([<>]|&(?!#\d+;|#x[0-9a-fA-F]+;|\w+;))')
+escaped_chars = {'<': '&lt;', '>': '&gt;', '&': '&amp;'}
+
+def convert_entity(match):
+    """Replaces an entity in an attribute value like BeautifulSoup."""
+    name = match.group(1)
+    if name in name2codepoint:
+        return unichr(name2codepoint[name])
+    if name in xml_special_chars:
+        return xml_special_chars[name]
+    if name[0] == '#':
+        try:
+            if name[1] == 'x':
+                return unichr(int(name[2:], 16))
+            return unichr(int(name[1:]))
+        except ValueError:
+            pass
+    return u'&%s;' % name
+
+def escape_text(text):
+    return text.replace('&', '&amp;').replace('<', '&lt;') \
+               .replace('>', '&gt;')
+
+def format_attribute(name, value):
+    if '"' in value:
+        value = value.replace("'", '&squot;')
+        fmt = "%s='%s'"
+    else:
+        fmt = '%s="%s"'
+    return fmt % (name, bare_ampersand_or_bracket.sub(
+                            lambda match: escaped_chars[match.group(1)],
+                            value))
+
+class SanitizingParser(SGMLParser):
+    """Writes sanitized html while SGMLParser reads tags and text.
+
+    Keeps only a stack of open tag names, instead of a tree.  Method
+    names avoid the start_, end_ and do_ prefixes SGMLParser looks up
+    for tags.
+    """
+    def __init__(self, html, allow_tags, allow_attributes, trusted_source):
+        SGMLParser.__init__(self)
+        self.html = html
+        self.allow_tags = allow_tags
+        self.allow_attributes = allow_attributes
+        self.trusted_source = trusted_source
+        self.output = []
+        self.text = []
+        # (name, shown) of open tags
+        self.open_tags = []
+        self.quoted = []
+
+    def sanitized(self, markup):
+        for fix, replace in markup_massage:
+            markup = fix.sub(replace, markup)
+        self.feed(markup)
+        self.flush_text()
+        self.pop_tags(len(self.open_tags))
+        self.close()
+        return u''.join(self.output)
+
+    def flush_text(self):
+        if not self.text:
+            return
+        text = u''.join(self.text)
+        self.text = []
+        if self.quoted and '&' in text:
+            # SGMLParser leaves references in quoted text as they are.
+            text = entity_matcher.sub(convert_entity, text)
+        elif '&#x' in text:
+            # and doesn't know hexadecimal ones.
+            text = hex_charref_matcher.sub(convert_entity, text)
+        if not text.translate(BeautifulSoup.STRIP_ASCII_SPACES):
+            for name, shown in self.open_tags:
+                if name in preserve_whitespace_tags:
+                    break
+            else:
+                text = '\n' in text and u'\n' or u' '
+        if self.open_tags and self.open_tags[-1][0] in raw_text_tags and \
+           self.open_tags[-1][1]:
+            # Written as is, like BeautifulSoup does, but without a way
+            # to end the element early.
+            self.output.append(text.replace(u'</', u'<\\/'))
+        else:
+            self.output.append(escape_text(text))
+
+    def pop_tags(self, count):
+        for i in range(count):
+            name, shown = self.open_tags.pop()
+            if shown:
+                self.output.append(u'</%s>' % name)
+
+    def pop_to(self, name, inclusive=True):
+        for i in range(len(self.open_tags) - 1, -1, -1):
+            if self.open_tags[i][0] == name:
+                count = len(self.open_tags) - i
+                if not inclusive:
+                    count -= 1
+                self.pop_tags(count)
+                return
+
+    def smart_pop(self, name):
+        """Closes open tags a new tag can't nest in, like BeautifulSoup."""
+        reset_triggers = nestable_tags.get(name)
+        is_nestable = reset_triggers is not None
+        is_reset_nesting = name in reset_nesting_tags
+        for i in range(len(self.open_tags) - 1, -1, -1):
+            open_name = self.open_tags[i][0]
+            if open_name == name and not is_nestable:
+                self.pop_to(name)
+                return
+            if (is_nestable and open_name in reset_triggers) or \
+               (not is_nestable and is_reset_nesting and
+                open_name in reset_nesting_tags):
+                self.pop_to(open_name, inclusive=False)
+                return
+
+    def unknown_starttag(self, name, attrs):
+        if self.quoted:
+            self.handle_data('<%s%s>' % (name, ''.join(
+                [' %s="%s"' % (attr, val) for attr, val in attrs])))
+            return
+        self.flush_text()
+        self_closing = name in self_closing_tags
+        if not self_closing:
+            self.smart_pop(name)
+        shown = name in self.allow_tags
+        if not shown and name in danger_elements:
+            raise DangerousHTMLError(self.html)
+        ok_attrs = []
+        for attr, val in attrs:
+            if '&' in val:
+                val = entity_matcher.sub(convert_entity, val)
+            if attr == 'href' and not href_matcher.match(val) and \
+               not self.trusted_source:
+                continue
+            if attr in self.allow_attributes:
+                if attr in js_possible_attributes:
+                    if javascript_matcher.match(val):
+                        raise DangerousHTMLError(self.html)
+                ok_attrs.append(format_attribute(attr, val))
+        if shown:
+            self.output.append(u'<%s%s%s>' % (name,
+                                              ok_attrs and ' ' or '',
+                                              ' '.join(ok_attrs)))
+            if self_closing:
+                self.output[-1] = self.output[-1][:-1] + u' />'
+        if not self_closing:
+            self.open_tags.append((name, shown))
+        if name in quote_tags:
+            self.quoted.append(name)
+            self.literal = 1
+
+    def unknown_endtag(self, name):
+        if self.quoted and self.quoted[-1] != name:
+            self.handle_data('</%s>' % name)
+            return
+        self.flush_text()
+        self.pop_to(name)
+        if self.quoted and self.quoted[-1] == name:
+            self.quoted.pop()
+            self.literal = len(self.quoted) > 0
+
+    def handle_data(self, data):
+        self.text.append(data)
+
+    def handle_charref(self, ref):
+        try:
+            self.handle_data(unichr(int(ref)))
+        except ValueError:
+            self.handle_data(u'&#%s;' % ref)
+
+    def handle_entityref(self, ref):
+        if ref in name2codepoint:
+            self.handle_data(unichr(name2codepoint[ref]))
+        elif ref in xml_special_chars:
+            self.handle_data(xml_special_chars[ref])
+        else:
+            # Most likely a bare ampersand, as in AT&T
+            self.handle_data(u'&' + ref)
+
+    def convert_charref(self, name):
+        """Converts only ASCII references in attributes, like
+        BeautifulSoup."""
+        try:
+            n = int(name)
+        except ValueError:
+            return
+        if 0 <= n <= 127:
+            return self.convert_codepoint(n)
+
+    def handle_comment(self, text):
+        self.flush_text()
+
+    def handle_decl(self, data):
+        self.flush_text()
+
+    def handle_pi(self, data):
+        self.flush_text()
+
+    def parse_declaration(self, i):
+        if self.rawdata[i:i+9] == '<![CDATA[':
+            self.flush_text()
+            k = self.rawdata.find(']]>', i)
+            if k == -1:
+                return len(self.rawdata)
+            return k + 3
+        try:
+            return SGMLParser.parse_declaration(self, i)
+        except SGMLParseError:
+            rest = self.rawdata[i:]
+            self.handle_data(rest)
+            return i + len(rest)
+
+def stream_sanitize_html(html='<p>No comment</p>', encoding=None,
+                         allow_tags=[], allow_attributes=[],
+                         blacklist_tags=[], blacklist_attributes=[],
+                         trusted_source=False):
+    """Sanitizes HTML in one pass, without building a tree.
+
+    Takes the same arguments, keeps the same tags and attributes and
+    raises DangerousHTMLError in the same cases as sanitize_html(),
+    including BeautifulSoup's repair of mis-nested tags.  Unlike it,
+    text is re-escaped, so &lt;script&gt; stays text, and comments,
+    declarations, processing instructions and CDATA sections are
+    dropped.
+
+    Returns:
+      Sanitized version of html, as unicode
+    """
+    allow_tags = frozenset(allow_tags or acceptable_tags)
+    allow_attributes = frozenset(allow_attributes or acceptable_attributes)
+    allow_tags = allow_tags.difference(blacklist_tags)
+    # Like sanitize_html(), which filters attributes by blacklist_tags.
+    allow_attributes = allow_attributes.difference(blacklist_tags)
+    if trusted_source:
+        allow_attributes = allow_attributes.union(
+                               attributes_for_trusted_source)
+        allow_tags = allow_tags.union(tags_for_trusted_source)
+
+    markup = html
+    if not isinstance(markup, unicode) or encoding:
+        markup = markup.decode(encoding or 'latin-1', 'ignore')
+    parser = SanitizingParser(html, allow_tags, allow_attributes,
+                              trusted_source)
+    return parser.sanitized(markup)
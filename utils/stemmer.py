@@ -0,0 +1,162 @@
+# The MIT License
+# 
+# Copyright 2008 William T Katz
+# 
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+# 
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+# 
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+# THE SOFTWARE.
+
+"""Porter stemmer for English words.
+
+Implements the algorithm in M.F. Porter, "An algorithm for suffix
+stripping", Program 14(3), 1980, so that e.g. 'caching', 'cached' and
+'caches' all index as 'cach'.
+
+Words are expected in lowercase.  Callers that stem a lot of text
+should memoize, as the full-text tokenizer does.
+"""
+__author__ = 'William T. Katz'
+
+VOWELS = frozenset('aeiou')
+
+def _is_consonant(word, i):
+    char = word[i]
+    if char in VOWELS:
+        return False
+    if char == 'y':
+        return i == 0 or not _is_consonant(word, i - 1)
+    return True
+
+def _measure(stem):
+    """Returns m, the number of vowel-consonant sequences in stem."""
+    m = 0
+    previous_vowel = False
+    for i in range(len(stem)):
+        consonant = _is_consonant(stem, i)
+        if consonant and previous_vowel:
+            m += 1
+        previous_vowel = not consonant
+    return m
+
+def _has_vowel(stem):
+    for i in range(len(stem)):
+        if not _is_consonant(stem, i):
+            return True
+    return False
+
+def _ends_double_consonant(word):
+    return (len(word) >= 2 and word[-1] == word[-2] and 
+            _is_consonant(word, len(word) - 1))
+
+def _ends_cvc(word):
+    """True if word ends consonant-vowel-consonant, last not w, x or y."""
+    n = len(word)
+    return (n >= 3 and _is_consonant(word, n - 3) and 
+            not _is_consonant(word, n - 2) and _is_consonant(word, n - 1) 
+            and word[-1] not in 'wxy')
+
+def _replace_suffix(word, rules, min_measure):
+    """Applies the rule for the longest suffix of word in rules.
+
+    The replacement only happens if the stem left has a measure above
+    min_measure.  Shorter suffixes aren't tried after a failed match.
+    """
+    for suffix, replacement in rules:
+        if word.endswith(suffix):
+            stem = word[:-len(suffix)]
+            if _measure(stem) > min_measure:
+                return stem + replacement
+            return word
+    return word
+
+def _by_length(rules):
+    return sorted(rules, key=lambda rule: -len(rule[0]))
+
+STEP2_RULES = _by_length([
+    ('ational', 'ate'), ('tional', 'tion'), ('enci', 'ence'), 
+    ('anci', 'ance'), ('izer', 'ize'), ('abli', 'able'), ('alli', 'al'), 
+    ('entli', 'ent'), ('eli', 'e'), ('ousli', 'ous'), ('ization', 'ize'), 
+    ('ation', 'ate'), ('ator', 'ate'), ('alism', 'al'), 
+    ('iveness', 'ive'), ('fulness', 'ful'), ('ousness', 'ous'), 
+    ('aliti', 'al'), ('iviti', 'ive'), ('biliti', 'ble')])
+
+STEP3_RULES = _by_length([
+    ('icate', 'ic'), ('ative', ''), ('alize', 'al'), ('iciti', 'ic'), 
+    ('ical', 'ic'), ('ful', ''), ('ness', '')])
+
+STEP4_SUFFIXES = sorted([
+    'al', 'ance', 'ence', 'er', 'ic', 'able', 'ible', 'ant', 'ement', 
+    'ment', 'ent', 'ion', 'ou', 'ism', 'ate', 'iti', 'ous', 'ive', 'ize'], 
+    key=lambda suffix: -len(suffix))
+
+def _step1(word):
+    if word.endswith('sses') or word.endswith('ies'):
+        word = word[:-2]
+    elif word.endswith('s') and not word.endswith('ss'):
+        word = word[:-1]
+
+    if word.endswith('eed'):
+        if _measure(word[:-3]) > 0:
+            word = word[:-1]
+    else:
+        for suffix in ('ed', 'ing'):
+            if word.endswith(suffix) and _has_vowel(word[:-len(suffix)]):
+                word = word[:-len(suffix)]
+                if (word.endswith('at') or word.endswith('bl') or 
+                    word.endswith('iz')):
+                    word += 'e'
+                elif _ends_double_consonant(word) and word[-1] not in 'lsz':
+                    word = word[:-1]
+                elif _measure(word) == 1 and _ends_cvc(word):
+                    word += 'e'
+                break
+
+    if word.endswith('y') and _has_vowel(word[:-1]):
+        word = word[:-1] + 'i'
+    return word
+
+def _step4(word):
+    for suffix in STEP4_SUFFIXES:
+        if word.endswith(suffix):
+            stem = word[:-len(suffix)]
+            if suffix == 'ion' and not (stem.endswith('s') or 
+                                        stem.endswith('t')):
+                return word
+            if _measure(stem) > 1:
+                return stem
+            return word
+    return word
+
+def _step5(word):
+    if word.endswith('e'):
+        stem = word[:-1]
+        m = _measure(stem)
+        if m > 1 or (m == 1 and not _ends_cvc(stem)):
+            word = stem
+    if (word.endswith('ll') and _measure(word) > 1):
+        word = word[:-1]
+    return word
+
+def stem(word):
+    """Returns the Porter stem of a lowercase word."""
+    if len(word) <= 2:
+        return word
+    word = _step1(word)
+    word = _replace_suffix(word, STEP2_RULES, 0)
+    word = _replace_suffix(word, STEP3_RULES, 0)
+    word = _step4(word)
+    return _step5(word)
@@ -21,22 +21,32 @@
 # DEALINGS IN THE SOFTWARE.
 
 
+import base64
+import datetime
 import logging
 import os
 import re
 import string
 import time
+import urllib
 import urlparse
 
 from google.appengine.api import users
 from google.appengine.api import memcache
 
-from models.blog import Tag       # Might rethink if this is leaking into view
+from models.blog import Tag, ArchiveMonth   # Might rethink if this is 
+                                            # leaking into view
 from utils import template
+from utils.external import simplejson
 import config
 
 NUM_FULL_RENDERS = {}       # Cached data for some timings.
 
+MAX_PAGE_SIZE = 50
+# Most ties a page token may skip.  Tokens aren't signed, so a larger
+# skip would let a client make the datastore scan an unbounded offset.
+MAX_PAGE_SKIP = MAX_PAGE_SIZE * 2
+
 def do_build_tree(base, path, tree):
     for entry in os.listdir(os.path.join(base, path)):
         entry_path = os.path.join(path, entry)
@@ -62,8 +72,50 @@ def find_file(tree, path):
     else:
         return None
 
-def invalidate_cache():
-    memcache.flush_all()
+# Cached pages are stored with the page versions they were rendered at,
+# so a write invalidates them with an incr instead of flushing memcache,
+# which would also drop the feed, entity and search caches.  Every page
+# shows tags and archive months in its sidebar, so SITE_VERSION_KEY
+# covers all of them.  Listings, archives and search results also show
+# comment counts, so they're checked against LISTING_VERSION_KEY too.
+SITE_VERSION_KEY = 'PageVersionSite'
+LISTING_VERSION_KEY = 'PageVersionListing'
+
+def page_memcache_key(url):
+    return 'Page' + url
+
+def get_page_versions(cached):
+    """Returns (site version, listing version) from a get_multi result,
+    starting versions that memcache doesn't have."""
+    versions = []
+    for key in (SITE_VERSION_KEY, LISTING_VERSION_KEY):
+        version = cached.get(key)
+        if version is None:
+            # Milliseconds, so a restarted version can't repeat one
+            # that is still stored with pages.
+            memcache.add(key, int(time.time() * 1000))
+            version = memcache.get(key)
+        versions.append(version)
+    return tuple(versions)
+
+def invalidate_cache(handler, article=None, site_wide=True):
+    """Drops the cached pages a write changed.
+
+    Args:
+      handler: the request handler, whose host the page urls use
+      article: the article written or commented on, whose page is
+        deleted
+      site_wide: if False, only the article's page and the listings are
+        dropped, e.g. for a comment or an edit that kept the tags
+    """
+    if site_wide:
+        # If the version was evicted, the next read starts a new one.
+        memcache.incr(SITE_VERSION_KEY)
+        return
+    if article:
+        memcache.delete(page_memcache_key(handler.request.host_url + '/' +
+                                          urllib.quote(article.permalink)))
+    memcache.incr(LISTING_VERSION_KEY)
 
 def to_filename(camelcase_handler_str):
     filename = camelcase_handler_str[0].lower()
@@ -150,6 +202,101 @@ def get_view_file(handler, params={}):
                 return {'file': filename, 'dirs': template_dirs}
     return {'file': 'notfound.html', 'dirs': template_dirs}
 
+# Listings are paged by keyset rather than offset, so deep pages cost
+# the same as the first one.  A page starts at (value, skip): the first
+# entity whose sort property is at or past value, after skipping the
+# 'skip' entities with exactly that value that were on earlier pages.
+# Since the datastore orders ties by key, skip is only ever the size of
+# a group of ties.  Tokens in paging links are opaque strings holding
+# either a page start ('a') or the start of the page after the one
+# wanted ('b'), which is resolved when the link is followed.
+
+def encode_value(value):
+    if isinstance(value, datetime.datetime):
+        return ['d', value.isoformat()]
+    return ['s', value]
+
+def decode_value(encoded):
+    value_type, value = encoded
+    if value_type == 'd':
+        date_str, dot, micros = value.partition('.')
+        value = datetime.datetime.strptime(date_str, '%Y-%m-%dT%H:%M:%S')
+        return value.replace(microsecond=int(micros or 0))
+    return unicode(value)
+
+def encode_page_token(direction, start):
+    value, skip = start
+    return base64.urlsafe_b64encode(
+        simplejson.dumps([direction, encode_value(value), skip]))
+
+def decode_page_token(token):
+    """Returns (direction, (value, skip)) or None for a bad token."""
+    try:
+        direction, value, skip = simplejson.loads(
+                                    base64.urlsafe_b64decode(str(token)))
+        if direction not in ('a', 'b') or \
+           not 0 <= int(skip) <= MAX_PAGE_SKIP:
+            return None
+        return direction, (decode_value(value), int(skip))
+    except (TypeError, ValueError):
+        return None
+
+def get_page_size(limit_str, default_limit):
+    try:
+        limit = int(limit_str or default_limit)
+    except ValueError:
+        limit = default_limit
+    return max(1, min(limit, MAX_PAGE_SIZE))
+
+def fetch_page(query_func, prop, descending, start, limit):
+    """Fetches up to limit+1 entities beginning at page start.
+
+    Returns:
+      Tuple of (entities on this page, start of next page or None)
+    """
+    query = query_func()
+    skip = 0
+    if start:
+        value, skip = start
+        query.filter(prop + (descending and ' <=' or ' >='), value)
+    query.order((descending and '-' or '') + prop)
+    entities = query.fetch(limit+1, skip)
+    next_start = None
+    if len(entities) > limit:
+        entities.pop()
+        last_value = getattr(entities[-1], prop)
+        num_ties = len([entity for entity in entities 
+                        if getattr(entity, prop) == last_value])
+        if start and start[0] == last_value:
+            num_ties += skip
+        next_start = (last_value, num_ties)
+    return entities, next_start
+
+def find_page_before(query_func, prop, descending, start, limit):
+    """Returns the start of the page preceding the page at start,
+    or None if that's the first page."""
+    value, skip = start
+    query = query_func()
+    query.filter(prop + (descending and ' >' or ' <'), value)
+    query.order((not descending and '-' or '') + prop)
+    if skip > limit:
+        return (value, skip - limit)
+    if skip == limit:
+        if query.fetch(1):
+            return (value, 0)
+        return None
+    needed = limit - skip
+    # One extra tells us if the preceding page is the first one.
+    entities = query.fetch(needed+1)
+    if len(entities) <= needed:
+        return None
+    entities.pop()
+    first_value = getattr(entities[-1], prop)
+    num_on_page = len([entity for entity in entities 
+                       if getattr(entity, prop) == first_value])
+    num_ties = query_func().filter(prop + ' =', first_value).count()
+    return (first_value, num_ties - num_on_page)
+
 class ViewPage(object):
     def __init__(self, cache_time=None):
         """Each ViewPage has a variable cache timeout"""
@@ -170,6 +317,7 @@ class ViewPage(object):
         NUM_FULL_RENDERS[path] += 1     # This lets us see % of cached views
                                         # in /admin/timings (see timings.py)
         tags = Tag.list()
+        archive_years = ArchiveMonth.get_archive_years()
 
         # Define some parameters it'd be nice to have in views by default.
         template_params = {
@@ -180,7 +328,8 @@ class ViewPage(object):
             "login_url": users.create_login_url(handler.request.uri),
             "logout_url": users.create_logout_url(handler.request.uri),
             "blog": config.BLOG,
-            "blog_tags": tags
+            "blog_tags": tags,
+            "blog_archive_years": archive_years
         }
         template_params.update(config.PAGE)
         template_params.update(more_params)
@@ -188,11 +337,13 @@ class ViewPage(object):
                                debug=config.DEBUG, 
                                template_dirs=template_info['dirs'])
 
-    def render_or_get_cache(self, handler, template_info, template_params={}):
+    def render_or_get_cache(self, handler, template_info, template_params={},
+                            listing=False):
         """Checks if there's a non-stale cached version of this view, 
-           and if so, return it."""
+           and if so, return it.  Listings are also stale after a
+           comment."""
         user = users.get_current_user()
-        key = handler.request.url
+        key = page_memcache_key(handler.request.url)
         if self.cache_time and not user:
             # See if there's a cache within time.
             # The cache key suggests a problem with the url <-> function 
@@ -202,46 +353,87 @@ class ViewPage(object):
             #  "admin?", then it suggests these flags should be in url.               
             # TODO - Think about the above with respect to caching.
             try:
-                data = memcache.get(key)
+                cached = memcache.get_multi([SITE_VERSION_KEY,
+                                             LISTING_VERSION_KEY, key])
             except ValueError:
-                data = None
-            if data is not None:
-                return data
+                cached = {}
+            site_version, listing_version = get_page_versions(cached)
+            if not listing:
+                listing_version = None
+            data = cached.get(key)
+            if data is not None and \
+               data[:2] == (site_version, listing_version):
+                return data[2]
 
         output = self.full_render(handler, template_info, template_params)
         if self.cache_time and not user:
-            memcache.add(key, output, self.cache_time)
+            memcache.set(key, (site_version, listing_version, output),
+                         self.cache_time)
         return output
 
-    def render(self, handler, params={}):
+    def render(self, handler, params={}, listing=False):
         """
         Can pass overriding parameters within dict.  These parameters can 
         include:
             'ext': 'xml' (or any other format type)
+        Pass listing=True for pages showing comment counts of articles.
         """
         template_info = get_view_file(handler, params)
         logging.debug("Using template at %s", template_info['file'])
-        output = self.render_or_get_cache(handler, template_info, params)
+        output = self.render_or_get_cache(handler, template_info, params,
+                                          listing)
         handler.response.out.write(output)
 
-    def render_query(self, handler, model_name, query, params={},
+    def render_query(self, handler, model_name, query_func, params={},
                      num_limit=config.PAGE['articles_per_page'],
-                     num_offset=0):
+                     order='-published'):
         """
         Handles typical rendering of queries into datastore
-        with paging.
+        with keyset paging on the single sort property in 'order'.
+        query_func must return a new, unordered query each time it's
+        called since paging adds its own filters.
         """
-        limit = string.atoi(handler.request.get("limit") or str(num_limit))
-        offset = string.atoi(handler.request.get("offset") or str(num_offset))
-        # Trick is to ask for one more than you need to see if 'next' needed.
-        models = query.fetch(limit+1, offset)
+        limit = get_page_size(handler.request.get("limit"), num_limit)
+        descending = order.startswith('-')
+        prop = order.lstrip('-')
+        start = None
+        token = decode_page_token(handler.request.get("page"))
+        if token:
+            direction, start = token
+            if direction == 'b':
+                start = find_page_before(query_func, prop, descending, 
+                                         start, limit)
+        models, next_start = fetch_page(query_func, prop, descending, 
+                                        start, limit)
         render_params = {model_name: models, 'limit': limit}
-        if len(models) > limit:
+        if next_start:
+            render_params.update(
+                { 'next_offset': encode_page_token('a', next_start) })
+        if start:
+            render_params.update(
+                { 'prev_offset': encode_page_token('b', start) })
+        render_params.update(params)
+
+        self.render(handler, render_params, listing=True)
+
+    def render_key_list(self, handler, model_name, keys, get_func, 
+                        params={}, num_limit=config.PAGE['articles_per_page']):
+        """
+        Renders a page of a precomputed list of keys, e.g. from an
+        archive index.  Paging is by position in the list so only the
+        entities on the page are fetched, using get_func(keys).
+        """
+        limit = get_page_size(handler.request.get("limit"), num_limit)
+        try:
+            offset = max(0, int(handler.request.get("page") or 0))
+        except ValueError:
+            offset = 0
+        models = get_func(keys[offset:offset+limit])
+        render_params = {model_name: models, 'limit': limit}
+        if offset + limit < len(keys):
             render_params.update({ 'next_offset': str(offset+limit) })
-            models.pop()
         if offset > 0:
-            render_params.update({ 'prev_offset': str(offset-limit) })
+            render_params.update({ 'prev_offset': str(max(0, offset-limit)) })
         render_params.update(params)
 
-        self.render(handler, render_params)
-
+        self.render(handler, render_params, listing=True)